@@ -1,24 +1,15 @@
-from analytics import serializers, models
+from analytics import serializers, models, caches, classification, \
+    image_classification, polygons, prefetch, renditions, result_store, sendfile, stats, \
+    subregion_index, tiles, training
 from django.db import transaction
-from django.http import HttpResponse
+from django.db.models import Count, F, Prefetch
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404
-from django.db.models import Count
-from lungmap_client import lungmap_utils
 from rest_framework import generics, permissions, status, mixins
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from django.core.files.base import ContentFile
-from lung_map_utils import utils
-import numpy as np
-import pandas as pd
-import pickle
-# noinspection PyPackageRequirements
-import cv2
-# noinspection PyPackageRequirements
-import PIL
 import django_filters
-# noinspection PyPackageRequirements
-from sklearn.externals import joblib
+import os
 import rest_framework.serializers as drf_serializers
 
 
@@ -81,20 +72,44 @@ class ImageSetFilter(django_filters.rest_framework.FilterSet):
         fields = ['species', 'magnification', 'development_stage', 'probe']
 
 
+def get_image_set_queryset():
+    """
+    Image sets with the counts & relations needed by ImageSetSerializer, so
+    serializing doesn't query per row. Sub-region counts are read from the
+    denormalized stats tables rather than aggregated.
+    """
+    return models.ImageSet.objects.annotate(
+        image_count=Count('image', distinct=True),
+        images_with_subregion_count=Coalesce(F('stats__images_with_subregion_count'), 0),
+        subregion_count=Coalesce(F('stats__subregion_count'), 0)
+    ).select_related('trainedmodel').prefetch_related(
+        'imagesetprobemap_set__probe',
+        Prefetch(
+            'anatomy_stats',
+            queryset=models.ImageSetAnatomyStats.objects.select_related('anatomy')
+            .order_by('anatomy__name')
+        )
+    )
+
+
 class ImageSetList(generics.ListAPIView):
-    queryset = models.ImageSet.objects.all()
     serializer_class = serializers.ImageSetSerializer
     filter_class = ImageSetFilter
 
+    def get_queryset(self):
+        return get_image_set_queryset()
+
 
 class ImageSetDetail(generics.RetrieveAPIView):
     """
     Get an image set
     """
 
-    queryset = models.ImageSet.objects.all()
     serializer_class = serializers.ImageSetSerializer
 
+    def get_queryset(self):
+        return get_image_set_queryset()
+
 
 # noinspection PyClassHasNoInit
 class AnatomyProbeMapFilter(django_filters.rest_framework.FilterSet):
@@ -119,30 +134,24 @@ class ImageDetail(generics.RetrieveAPIView):
     serializer_class = serializers.ImageSerializer
 
     def retrieve(self, request, *args, **kwargs):
-        serializer_context = {
-            'request': request
-        }
+        """
+        Images are downloaded from LungMap in the background (see the
+        prefetch_images management command). Until an image is fetched this
+        responds with 202 & the image's fetch_status, so clients should poll.
+        """
         img = self.get_object()
-        try:
-            with transaction.atomic():
-                if img.image_orig_sha1 is None or img.image_orig_sha1 == '':
-                    suf, sha1, suf_jpeg = lungmap_utils.get_image_from_lungmap(img.source_url)
-                    img.image_orig = suf
-                    img.image_orig_sha1 = sha1
-                    img.image_jpeg = suf_jpeg
-                    img.save()
-                serializer = serializers.ImageSerializer(
-                    img,
-                    context=serializer_context
-                )
-                return Response(
-                    serializer.data,
-                    status=status.HTTP_200_OK
-                )
-        except Exception as e:
-            if hasattr(e, 'messages'):
-                return Response(data={'detail': e.messages}, status=400)
-            return Response(data={'detail': e}, status=400)
+        serializer = serializers.ImageSerializer(
+            img,
+            context={'request': request}
+        )
+
+        if img.image_orig_sha1:
+            return Response(serializer.data, status=status.HTTP_200_OK)
+
+        # somebody is waiting on this image, fetch it next
+        prefetch.prioritize_image(img)
+
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
 
 # noinspection PyClassHasNoInit
@@ -168,83 +177,124 @@ class TrainedModelCreate(generics.CreateAPIView):
     serializer_class = serializers.TrainedModelCreateSerializer
 
     def create(self, request, *args, **kwargs):
+        """
+        Training runs in the background (see the run_training_worker management
+        command), so this only validates the image set and queues a job. Poll
+        the returned job for progress.
+        """
         try:
             image_set = models.ImageSet.objects.get(id=request.data['imageset'])
-            images = image_set.image_set.prefetch_related('subregion_set')
-            training_data = []
-            subregions = models.Subregion.objects.filter(image__image_set=image_set)\
-                .values('anatomy__name') \
-                .annotate(total=Count('anatomy__name')) \
-                .order_by('anatomy__name')
-
-            if len(subregions) <= 1:
-                raise ValueError(
-                    """
-                    More than 1 anatomical structure is needed to train a model. Please 
-                    continue to create training data by segmenting new anatomical structures. 
-                    Once complete, a trained model can be created.
-                    """
-                )
-
-            for sub in subregions:
-                if sub['total'] < 4:
-                    raise ValueError(
-                        """
-                        In order to train a model, we require that each imageset have 
-                        at least 4 subregions for each anatomical structure. It seems 
-                        that within this imageset, the anatomical structure %s has 
-                        only %s subregion(s). Please either delete this subregion or 
-                        continue to build training data for this structure.
-                        """ % (sub['anatomy__name'], str(sub['total']))
-                    )
+            job = training.queue_training_job(image_set, user=request.user)
 
-            for image in images:
-                sub_regions = image.subregion_set.all()
+            return Response(
+                serializers.TrainingJobSerializer(job).data,
+                status=status.HTTP_202_ACCEPTED
+            )
+        except Exception as e:
+            if hasattr(e, 'messages'):
+                return Response(data={'detail': e.messages}, status=400)
 
-                if len(sub_regions) > 0:
-                    # noinspection PyUnresolvedReferences
-                    pil_image = PIL.Image.open(image.image_orig)
-                    image_as_numpy = np.asarray(pil_image)
+            return Response(data={'detail': str(e)}, status=400)
 
-                    # noinspection PyUnresolvedReferences
-                    sub_img = cv2.cvtColor(image_as_numpy, cv2.COLOR_RGB2HSV)
 
-                    for subregion in sub_regions:
-                        points = subregion.points.all()
-                        this_mask = np.empty((0, 2), dtype='int')
+# noinspection PyClassHasNoInit
+class TrainingJobFilter(django_filters.rest_framework.FilterSet):
+    class Meta:
+        model = models.TrainingJob
+        fields = ['imageset', 'status']
 
-                        for point in points:
-                            this_mask = np.append(this_mask, [[point.x, point.y]], axis=0)
 
-                        training_data.append(
-                            utils.generate_features(
-                                hsv_img_as_numpy=sub_img,
-                                polygon_points=this_mask,
-                                label=subregion.anatomy.name
-                            )
-                        )
+class TrainingJobList(generics.ListAPIView):
+    """
+    List training jobs
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = models.TrainingJob.objects.all()
+    serializer_class = serializers.TrainingJobSerializer
+    filter_class = TrainingJobFilter
 
-            pipe = utils.pipeline
-            training_data = pd.DataFrame(training_data)
-            pipe.fit(training_data.drop('label', axis=1), training_data['label'])
 
-            content = pickle.dumps(pipe)
-            pickled_model = ContentFile(content)
-            pickled_model.name = image_set.image_set_name + '.pkl'
+class TrainingJobDetail(generics.RetrieveAPIView):
+    """
+    Get the status & progress of a training job
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = models.TrainingJob.objects.all()
+    serializer_class = serializers.TrainingJobSerializer
 
-            final = models.TrainedModel(imageset=image_set, model_object=pickled_model)
-            final.save()
 
-            return Response(
-                serializers.TrainedModelSerializer(final).data,
-                status=status.HTTP_201_CREATED
-            )
-        except Exception as e:  # catch any exception to rollback changes
-            if hasattr(e, 'messages'):
-                return Response(data={'detail': e.messages}, status=400)
+class ClassificationJobCreate(generics.CreateAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = models.ClassificationJob.objects.all()
+    serializer_class = serializers.ClassificationJobCreateSerializer
+
+    def create(self, request, *args, **kwargs):
+        """
+        Automatic classification of a whole image runs in the background (see
+        the run_classification_worker management command), so this only
+        queues a job. Poll the returned job for progress & the regions found.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        image = get_object_or_404(models.Image, id=serializer.validated_data['image_id'])
 
+        try:
+            job = image_classification.queue_classification_job(image, user=request.user)
+        except ValueError as e:
             return Response(data={'detail': str(e)}, status=400)
 
+        return Response(
+            serializers.ClassificationJobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED
+        )
+
+
+# noinspection PyClassHasNoInit
+class ClassificationJobFilter(django_filters.rest_framework.FilterSet):
+    class Meta:
+        model = models.ClassificationJob
+        fields = ['image', 'trained_model', 'status']
+
+
+class ClassificationJobList(generics.ListAPIView):
+    """
+    List whole image classification jobs
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = models.ClassificationJob.objects.all()
+    serializer_class = serializers.ClassificationJobSerializer
+    filter_class = ClassificationJobFilter
+
+
+class ClassificationJobDetail(generics.RetrieveAPIView):
+    """
+    Get the status & progress of a whole image classification job, along
+    with the regions found once it is complete
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = models.ClassificationJob.objects.prefetch_related('regions')
+    serializer_class = serializers.ClassificationJobDetailSerializer
+
+
+# noinspection PyClassHasNoInit
+class ClassificationResultFilter(django_filters.rest_framework.FilterSet):
+    min_probability = django_filters.NumberFilter(name='probability', lookup_expr='gte')
+
+    class Meta:
+        model = models.ClassificationResult
+        fields = ['image', 'trained_model', 'anatomy', 'min_probability']
+
+
+class ClassificationResultList(generics.ListAPIView):
+    """
+    List stored classification results, e.g. of one image for a given anatomy
+    with ?image=1&anatomy=artery&min_probability=0.8
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = models.ClassificationResult.objects.order_by('-probability', 'id')
+    serializer_class = serializers.ClassificationResultSerializer
+    filter_class = ClassificationResultFilter
+
 
 class TrainedModelDetail(generics.RetrieveDestroyAPIView):
     """
@@ -254,19 +304,104 @@ class TrainedModelDetail(generics.RetrieveDestroyAPIView):
     queryset = models.TrainedModel.objects.all()
     serializer_class = serializers.TrainedModelSerializer
 
+    def perform_destroy(self, instance):
+        trained_model_id = instance.id
+        instance.delete()
+        caches.invalidate_trained_model(trained_model_id)
+
+
+# the JPEG of an image id only changes if the image is downloaded again,
+# which the ETag catches, so browsers may re-use it for a while without asking
+IMAGE_JPEG_CACHE_CONTROL = 'public, max-age=3600'
+
+# tiles & descriptors are addressed by the image SHA1, so they never change
+TILE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
 
-# noinspection PyUnusedLocal
 @api_view(['GET'])
 def get_image_jpeg(request, pk):
     """
     Get JPEG version of a single image
     """
-    image = get_object_or_404(models.Image, pk=pk)
-    if image.image_jpeg.name == '':
+    image = get_object_or_404(
+        models.Image.objects.only('image_jpeg', 'image_orig_sha1'),
+        pk=pk
+    )
+    if image.image_jpeg.name == '' or image.image_jpeg.name is None:
         content = {'image_jpeg': 'image not yet cached'}
         return Response(content, status=status.HTTP_404_NOT_FOUND)
-    else:
-        return HttpResponse(image.image_jpeg, content_type='image/jpeg')
+
+    return sendfile.file_response(
+        request,
+        image.image_jpeg.path,
+        'image/jpeg',
+        etag=image.image_orig_sha1 and image.image_orig_sha1 + '-jpeg',
+        cache_control=IMAGE_JPEG_CACHE_CONTROL
+    )
+
+
+@api_view(['GET'])
+def get_image_rendition(request, pk, size, image_format):
+    """
+    Get an image at the given size ('thumbnail', 'medium' or 'full') & in
+    the given format ('jpg' or 'webp'), see analytics.renditions
+    """
+    image = get_object_or_404(
+        models.Image.objects.only('image_jpeg', 'image_orig_sha1'),
+        pk=pk
+    )
+    if not image.image_orig_sha1 or not image.image_jpeg.name:
+        content = {'detail': 'image not yet cached'}
+        return Response(content, status=status.HTTP_404_NOT_FOUND)
+
+    if renditions.is_rendition(size, image_format):
+        path = renditions.rendition_path(image.image_orig_sha1, size, image_format)
+
+        if os.path.isfile(path):
+            return sendfile.file_response(
+                request,
+                path,
+                renditions.get_content_type(image_format),
+                etag='%s-%s-%s' % (image.image_orig_sha1, size, image_format),
+                cache_control=IMAGE_JPEG_CACHE_CONTROL
+            )
+
+    # the full size JPEG, also served for renditions not generated yet
+    return sendfile.file_response(
+        request,
+        image.image_jpeg.path,
+        'image/jpeg',
+        etag=image.image_orig_sha1 + '-jpeg',
+        cache_control=IMAGE_JPEG_CACHE_CONTROL
+    )
+
+
+@api_view(['GET'])
+def get_image_dzi(request, sha1):
+    """
+    Get the deep zoom (DZI) descriptor of an image's tile pyramid
+    """
+    return sendfile.file_response(
+        request,
+        tiles.dzi_path(sha1),
+        'application/xml',
+        etag=sha1 + '-dzi',
+        cache_control=TILE_CACHE_CONTROL
+    )
+
+
+@api_view(['GET'])
+def get_image_tile(request, sha1, level, col, row):
+    """
+    Get a single JPEG tile of an image's tile pyramid
+    """
+    return sendfile.file_response(
+        request,
+        tiles.tile_path(sha1, int(level), int(col), int(row)),
+        'image/jpeg',
+        etag='%s-%s-%s-%s' % (sha1, level, col, row),
+        cache_control=TILE_CACHE_CONTROL
+    )
 
 
 class ClassifySubRegion(generics.CreateAPIView):
@@ -277,42 +412,87 @@ class ClassifySubRegion(generics.CreateAPIView):
     def create(self, request, *args, **kwargs):
         image_id = request.data['image_id']
         points = request.data['points']
-        image_object = models.Image.objects.get(id=image_id)
-        image_set = models.ImageSet.objects.get(id=image_object.image_set_id)
-        this_model = joblib.load(image_set.trainedmodel.model_object)
-        this_mask = np.empty((0, 2), dtype='int')
-
-        for point in points:
-            this_mask = np.append(this_mask, [[point['x'], point['y']]], axis=0)
-        # noinspection PyUnresolvedReferences
-        pil_image = PIL.Image.open(image_object.image_orig)
-        image_as_numpy = np.asarray(pil_image)
-
-        # noinspection PyUnresolvedReferences
-        image_as_numpy = cv2.cvtColor(image_as_numpy, cv2.COLOR_RGB2HSV)
-        features = utils.generate_features(
-            hsv_img_as_numpy=image_as_numpy,
-            polygon_points=this_mask
+        image_object = models.Image.objects.select_related(
+            'image_set__trainedmodel'
+        ).get(id=image_id)
+
+        model_classes, probabilities = result_store.classify_polygons(
+            image_object,
+            [polygons.point_dicts_to_polygon(points)]
         )
-        features_data_frame = pd.DataFrame([features])
-        model_classes = list(this_model.named_steps['classification'].classes_)
-        probabilities = this_model.predict_proba(features_data_frame.drop('label', axis=1))
 
-        assert (len(model_classes) == probabilities.shape[1])
+        results = {
+            "results": classification.format_probabilities(model_classes, probabilities[0])
+        }
 
-        results = {"results": []}
-        results['results'].extend(
-            [{a: probabilities[0][i]} for i, a in enumerate(model_classes)]
+        return Response(results, status=status.HTTP_200_OK)
+
+
+class ClassifySubRegionBatch(generics.CreateAPIView):
+    """
+    Classify many polygons on a single image in one request. The response
+    holds one list of class probabilities per polygon, in request order.
+    Polygons classified before are read from the result store.
+    """
+    queryset = models.Image.objects.all()
+    serializer_class = serializers.ClassifyPolygonsSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        image_object = get_object_or_404(
+            models.Image.objects.select_related('image_set__trainedmodel'),
+            id=serializer.validated_data['image_id']
         )
 
+        if not hasattr(image_object.image_set, 'trainedmodel'):
+            return Response(
+                data={'detail': "Image set has no trained model"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        regions = [
+            polygons.point_dicts_to_polygon(p) for p in serializer.validated_data['polygons']
+        ]
+
+        if len(regions) == 0:
+            return Response({"results": []}, status=status.HTTP_200_OK)
+
+        model_classes, probabilities = result_store.classify_polygons(image_object, regions)
+
+        results = {
+            "results": [
+                classification.format_probabilities(model_classes, p) for p in probabilities
+            ]
+        }
+
         return Response(results, status=status.HTTP_200_OK)
 
 
 # noinspection PyClassHasNoInit
 class LungmapSubRegionFilter(django_filters.rest_framework.FilterSet):
+    # a viewport as "x_min,y_min,x_max,y_max", e.g. to only load the
+    # sub-regions visible in the image viewer
+    bbox = django_filters.CharFilter(method='filter_bbox')
+
     class Meta:
         model = models.Subregion
-        fields = ['image', 'anatomy']
+        fields = ['image', 'anatomy', 'bbox']
+
+    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    def filter_bbox(self, queryset, name, value):
+        try:
+            box = [int(float(v)) for v in value.split(',')]
+        except ValueError:
+            box = []
+
+        if len(box) != 4:
+            raise drf_serializers.ValidationError(
+                {'bbox': "Expected x_min,y_min,x_max,y_max"}
+            )
+
+        return subregion_index.intersecting_box(queryset, box)
 
 
 class SubregionList(
@@ -363,6 +543,19 @@ class SubregionList(
                 "Sub-regions already exist for this image / anatomy"
             )
 
+        # Fourth, a sub-region all but identical to another one on the image, of
+        # any anatomy, is a duplicate. Overlaps short of that are allowed.
+        duplicates = subregion_index.find_duplicates(
+            image_id,
+            [polygons.point_dicts_to_polygon(r['points']) for r in request.data]
+        )
+
+        if len(duplicates) > 0:
+            return Response(
+                data={'detail': subregion_index.describe_duplicates(duplicates)},
+                status=400
+            )
+
         sub_regions = []
 
         try:
@@ -378,21 +571,19 @@ class SubregionList(
                             "All sub-regions must reference the same anatomy class"
                         )
 
-                    subregion = models.Subregion.objects.create(
+                    points = sorted(r['points'], key=lambda p: p['order'])
+                    subregion = models.Subregion(
                         image_id=image_id,
                         anatomy_id=anatomy_id,
                         user_id=request.user.id
                     )
-
-                    for p in r['points']:
-                        models.Points.objects.create(
-                            subregion=subregion,
-                            x=p['x'],
-                            y=p['y'],
-                            order=p['order']
-                        )
+                    # the whole polygon is written with the sub-region's own INSERT
+                    subregion.set_polygon([[p['x'], p['y']] for p in points])
+                    subregion.save()
 
                     sub_regions.append(subregion)
+
+                stats.subregions_added(image, anatomy_id, len(sub_regions))
         except Exception as e:  # catch any exception to rollback changes
             # noinspection PyUnresolvedReferences
             return Response(data={'detail': e.message}, status=400)
@@ -441,15 +632,81 @@ class SubregionList(
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        regions = models.Subregion.objects.filter(anatomy=anatomy_id, image=image_id)
-        regions.delete()
+        with transaction.atomic():
+            regions = models.Subregion.objects.filter(anatomy=anatomy_id, image=image_id)
+            deleted, deleted_by_model = regions.delete()
+            stats.subregions_removed(
+                image,
+                anatomy_id,
+                deleted_by_model.get(models.Subregion._meta.label, 0)
+            )
 
         response_data = {'success': True}
 
         return Response(response_data, status=status.HTTP_200_OK)
 
 
+class SubregionIntersecting(generics.GenericAPIView):
+    """
+    Find the sub-regions of an image sharing pixels with a polygon, e.g. to
+    show a user drawing a new sub-region what it overlaps. Each sub-region
+    returned includes its intersection over union with the polygon.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = serializers.SubregionIntersectingSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        polygon = polygons.point_dicts_to_polygon(serializer.validated_data['points'])
+
+        if len(polygon) == 0:
+            return Response([], status=status.HTTP_200_OK)
+
+        queryset = models.Subregion.objects.filter(image=serializer.validated_data['image'])
+
+        if serializer.validated_data.get('anatomy') is not None:
+            queryset = queryset.filter(anatomy=serializer.validated_data['anatomy'])
+
+        results = []
+
+        for subregion, iou in subregion_index.intersecting_polygon(queryset, polygon):
+            data = serializers.SubregionSerializer(subregion).data
+            data['iou'] = iou
+            results.append(data)
+
+        return Response(results, status=status.HTTP_200_OK)
+
+
 class SubregionDetail(generics.RetrieveUpdateAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     queryset = models.Subregion.objects.all()
     serializer_class = serializers.SubregionSerializer
+
+    def perform_update(self, serializer):
+        old_image = serializer.instance.image
+        old_anatomy_id = serializer.instance.anatomy_id
+        packed_polygon = serializer.validated_data.get('polygon', serializer.instance.polygon)
+        image = serializer.validated_data.get('image', old_image)
+
+        duplicates = subregion_index.find_duplicates(
+            image.id,
+            [polygons.unpack_polygon(packed_polygon)],
+            exclude_ids=[serializer.instance.id]
+        )
+
+        if len(duplicates) > 0:
+            raise drf_serializers.ValidationError(
+                subregion_index.describe_duplicates(duplicates)
+            )
+
+        with transaction.atomic():
+            subregion = serializer.save()
+
+            stats.subregion_moved(
+                old_image,
+                old_anatomy_id,
+                subregion.image,
+                subregion.anatomy_id
+            )
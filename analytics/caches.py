@@ -0,0 +1,279 @@
+"""
+Per-worker (i.e. per gunicorn process) caches for objects that are
+expensive to load from MEDIA_ROOT on every request.
+"""
+from collections import OrderedDict
+from django.conf import settings
+import hashlib
+import numpy as np
+import os
+import tempfile
+import threading
+# noinspection PyPackageRequirements
+import cv2
+# noinspection PyPackageRequirements
+from sklearn.externals import joblib
+
+
+EVICTION_POLICIES = ('lru', 'fifo')
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping holding at most ``max_size`` worth of values.
+
+    By default every value has a size of 1, so ``max_size`` is simply an
+    entry count. Supply a ``size_func`` to budget by something else, e.g.
+    bytes. Once the budget is exceeded entries are evicted according to
+    ``policy``: 'lru' evicts the least recently used entry, 'fifo' evicts
+    the oldest inserted entry regardless of use.
+    """
+
+    def __init__(self, max_size, policy='lru', size_func=None):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(
+                "Unknown eviction policy '%s', choose from %s" % (policy, EVICTION_POLICIES)
+            )
+
+        self.max_size = max_size
+        self.policy = policy
+        self.size_func = size_func or (lambda value: 1)
+        self.current_size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key][0]
+            except KeyError:
+                return default
+
+            if self.policy == 'lru':
+                self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        size = self.size_func(value)
+
+        with self._lock:
+            if key in self._entries:
+                self.current_size -= self._entries.pop(key)[1]
+
+            # values larger than the whole budget are never cached
+            if size > self.max_size:
+                return
+
+            self._entries[key] = (value, size)
+            self.current_size += size
+
+            while self.current_size > self.max_size:
+                self.current_size -= self._entries.popitem(last=False)[1][1]
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.current_size -= self._entries.pop(key)[1]
+
+    def delete_matching(self, predicate):
+        """
+        Remove every entry whose key satisfies the given predicate
+        """
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self.current_size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_size = 0
+
+
+trained_model_cache = LRUCache(
+    max_size=getattr(settings, 'TRAINED_MODEL_CACHE_SIZE', 4),
+    policy=getattr(settings, 'TRAINED_MODEL_CACHE_POLICY', 'lru')
+)
+
+hsv_image_cache = LRUCache(
+    max_size=getattr(settings, 'HSV_IMAGE_CACHE_BYTES', 512 * 1024 * 1024),
+    size_func=lambda array: array.nbytes
+)
+
+
+def file_sha1(field_file, chunk_size=1024 * 1024):
+    """
+    Calculate the SHA1 of a stored file without reading it into memory at once
+    :param field_file: a Django FieldFile
+    :param chunk_size: number of bytes to read at a time
+    :return: hex digest string
+    """
+    sha1 = hashlib.sha1()
+    field_file.open('rb')
+
+    try:
+        for chunk in field_file.chunks(chunk_size=chunk_size):
+            sha1.update(chunk)
+    finally:
+        field_file.close()
+
+    return sha1.hexdigest()
+
+
+def get_trained_model(trained_model):
+    """
+    Returns the un-pickled sklearn pipeline for a TrainedModel instance,
+    loading it from MEDIA_ROOT only if this worker hasn't already done so.
+
+    Entries are keyed by both the TrainedModel id and the checksum of the
+    pickled file, so a replaced file is never served from a stale entry.
+    :param trained_model: analytics.models.TrainedModel instance
+    :return: fitted sklearn pipeline
+    """
+    checksum = trained_model.model_object_sha1
+
+    if not checksum:
+        # models trained before checksums were recorded, hash the file once &
+        # record it so later requests don't read the whole pickle again
+        checksum = file_sha1(trained_model.model_object)
+        type(trained_model).objects.filter(id=trained_model.id).update(
+            model_object_sha1=checksum
+        )
+        trained_model.model_object_sha1 = checksum
+
+    key = (trained_model.id, checksum)
+    pipeline = trained_model_cache.get(key)
+
+    if pipeline is None:
+        pipeline = joblib.load(trained_model.model_object)
+        trained_model_cache.set(key, pipeline)
+
+    return pipeline
+
+
+def invalidate_trained_model(trained_model_id):
+    """
+    Drop any cached pipelines for the given TrainedModel id in this worker.
+    Other workers will never request a deleted id again, so their entries
+    simply age out.
+    """
+    trained_model_cache.delete_matching(lambda key: key[0] == trained_model_id)
+
+
+def _hsv_cache_path(sha1):
+    cache_root = getattr(
+        settings,
+        'HSV_IMAGE_CACHE_ROOT',
+        os.path.join(settings.MEDIA_ROOT, 'hsv_cache')
+    )
+    return os.path.join(cache_root, sha1[:2], sha1 + '.npy')
+
+
+def _save_npy_atomic(path, array):
+    # write to a temp file in the same directory & rename so other
+    # workers never memory-map a partially written file
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.npy', delete=False) as f:
+        np.save(f, array)
+
+    os.replace(f.name, path)
+
+
+def decode_image(image_file):
+    """
+    Decode a stored TIFF the same way it is decoded at ingest (8-bit, 3
+    channels), see lungmap_utils.decode_lungmap_image
+    :param image_file: file path or file-like object (e.g. a FieldFile)
+    :return: BGR numpy array of shape (height, width, 3)
+    """
+    if isinstance(image_file, str):
+        data = np.fromfile(image_file, dtype=np.uint8)
+    else:
+        image_file.open('rb')
+
+        try:
+            data = np.frombuffer(image_file.read(), dtype=np.uint8)
+        finally:
+            image_file.close()
+
+    # noinspection PyUnresolvedReferences
+    bgr_image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    if bgr_image is None:
+        raise ValueError("Could not decode image %s" % image_file)
+
+    return bgr_image
+
+
+def decode_hsv_image(image_file):
+    """
+    Decode a stored TIFF and convert it to an HSV numpy array. The original
+    LungMap TIFFs & the RGB TIFFs stored by earlier versions give the same
+    result.
+    :param image_file: file path or file-like object (e.g. a FieldFile)
+    :return: numpy array of shape (height, width, 3)
+    """
+    # noinspection PyUnresolvedReferences
+    return cv2.cvtColor(decode_image(image_file), cv2.COLOR_BGR2HSV)
+
+
+def get_hsv_image(sha1, image_file):
+    """
+    Returns the HSV array for an image, decoding the TIFF only when neither
+    cache tier has it. The first tier is this worker's memory, bounded by
+    HSV_IMAGE_CACHE_BYTES. The second is a memory-mapped .npy file under
+    HSV_IMAGE_CACHE_ROOT, shared by every worker on the host.
+
+    Returned arrays are read-only as they are shared between callers.
+    :param sha1: SHA1 of the original image, used as the cache key
+    :param image_file: file path or file-like object of the original TIFF
+    :return: read-only numpy array of shape (height, width, 3)
+    """
+    if not sha1:
+        return decode_hsv_image(image_file)
+
+    hsv_image = hsv_image_cache.get(sha1)
+
+    if hsv_image is not None:
+        return hsv_image
+
+    path = _hsv_cache_path(sha1)
+
+    try:
+        hsv_image = np.load(path, mmap_mode='r')
+    except (IOError, ValueError):
+        hsv_image = decode_hsv_image(image_file)
+        hsv_image.setflags(write=False)
+        _save_npy_atomic(path, hsv_image)
+
+    hsv_image_cache.set(sha1, hsv_image)
+
+    return hsv_image
+
+
+def get_hsv_memmap(sha1, image_file):
+    """
+    Returns the HSV array for an image memory-mapped from its .npy file
+    under HSV_IMAGE_CACHE_ROOT, decoding the TIFF only if there is none yet.
+    Unlike get_hsv_image the array is never held in this worker's memory,
+    so windows of very large images can be read a piece at a time.
+    :param sha1: SHA1 of the original image, used as the cache key
+    :param image_file: file path or file-like object of the original TIFF
+    :return: read-only numpy memmap of shape (height, width, 3)
+    """
+    path = _hsv_cache_path(sha1)
+
+    try:
+        return np.load(path, mmap_mode='r')
+    except (IOError, ValueError):
+        _save_npy_atomic(path, decode_hsv_image(image_file))
+
+    return np.load(path, mmap_mode='r')
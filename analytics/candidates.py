@@ -0,0 +1,194 @@
+"""
+Candidate regions for automatic classification of whole images. Regions are
+found per probe color by thresholding hue, saturation & value, outlined as
+contours & overlapping candidates are then collapsed with non-maximum
+suppression.
+"""
+from collections import OrderedDict
+import numpy as np
+# noinspection PyPackageRequirements
+import cv2
+
+# candidates smaller than this (in pixels) are noise rather than structures
+MIN_CANDIDATE_AREA = 400
+
+# candidates whose bounding boxes overlap more than this are duplicates
+NMS_IOU_THRESHOLD = 0.5
+
+# OpenCV HSV ranges (hue 0 - 179, saturation & value 0 - 255) of the probe
+# colors used by LungMap, as lists of (lower, upper) bounds. Red wraps
+# around the hue circle, so it needs two ranges.
+PROBE_COLOR_RANGES = OrderedDict(
+    [
+        ('red', [((0, 100, 60), (10, 255, 255)), ((170, 100, 60), (179, 255, 255))]),
+        ('yellow', [((20, 100, 60), (35, 255, 255))]),
+        ('green', [((36, 100, 60), (80, 255, 255))]),
+        ('cyan', [((81, 100, 60), (99, 255, 255))]),
+        ('blue', [((100, 100, 60), (130, 255, 255))]),
+        ('magenta', [((140, 100, 60), (169, 255, 255))]),
+        ('white', [((0, 0, 180), (179, 60, 255))])
+    ]
+)
+
+OPEN_KERNEL = np.ones((5, 5), dtype=np.uint8)
+
+
+def _find_contours(mask):
+    # OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 drops the image
+    # noinspection PyUnresolvedReferences
+    return cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+
+def mask_to_polygons(mask, min_area=MIN_CANDIDATE_AREA):
+    """
+    Outline the connected regions of a binary mask
+    :param mask: uint8 numpy array, non-zero inside regions
+    :param min_area: smallest contour area to keep
+    :return: tuple of (list of int32 numpy arrays of shape (N, 2), numpy
+        array of their areas)
+    """
+    polygons = []
+    areas = []
+
+    for contour in _find_contours(mask):
+        if len(contour) < 3:
+            continue
+
+        # noinspection PyUnresolvedReferences
+        area = cv2.contourArea(contour)
+
+        if area < min_area:
+            continue
+
+        polygons.append(contour.reshape(-1, 2).astype(np.int32))
+        areas.append(area)
+
+    return polygons, np.array(areas, dtype=np.float64)
+
+
+def color_mask(hsv_img, color):
+    """
+    Binary mask of the pixels of an HSV array matching a probe color
+    :param hsv_img: HSV numpy array
+    :param color: a key of PROBE_COLOR_RANGES
+    :return: uint8 numpy array, 255 where the color matches
+    """
+    mask = None
+
+    for lower, upper in PROBE_COLOR_RANGES[color]:
+        # noinspection PyUnresolvedReferences
+        range_mask = cv2.inRange(hsv_img, np.array(lower, np.uint8), np.array(upper, np.uint8))
+        # noinspection PyUnresolvedReferences
+        mask = range_mask if mask is None else cv2.bitwise_or(mask, range_mask)
+
+    return mask
+
+
+def brightness_mask(hsv_img):
+    """
+    Binary mask of the bright pixels of an HSV array, the threshold being
+    chosen with Otsu's method. Used when the probe colors aren't known.
+    """
+    value = np.ascontiguousarray(hsv_img[:, :, 2])
+
+    # noinspection PyUnresolvedReferences
+    return cv2.threshold(value, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+
+def bounding_boxes(polygons):
+    """
+    :param polygons: list of numpy arrays of shape (N, 2)
+    :return: float numpy array of shape (len(polygons), 4) of
+        (x0, y0, x1, y1) with exclusive upper bounds
+    """
+    if len(polygons) == 0:
+        return np.zeros((0, 4), dtype=np.float64)
+
+    return np.array(
+        [np.concatenate([p.min(axis=0), p.max(axis=0) + 1]) for p in polygons],
+        dtype=np.float64
+    )
+
+
+def non_max_suppression(boxes, scores, iou_threshold=NMS_IOU_THRESHOLD):
+    """
+    Greedy non-maximum suppression: repeatedly keep the highest scoring box
+    & drop the remaining boxes overlapping it by more than iou_threshold.
+    Each step compares one box against all remaining boxes at once, so the
+    Python loop only runs once per kept box.
+    :param boxes: numpy array of shape (N, 4) of (x0, y0, x1, y1)
+    :param scores: numpy array of shape (N,), higher is better
+    :param iou_threshold: intersection over union above which boxes overlap
+    :return: int numpy array of the indices of the kept boxes, best first
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.intp)
+
+    x0, y0, x1, y1 = boxes.T
+    areas = (x1 - x0) * (y1 - y0)
+    order = np.argsort(scores, kind='mergesort')[::-1]
+    keep = []
+
+    while order.size > 0:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+
+        overlap_width = np.minimum(x1[best], x1[rest]) - np.maximum(x0[best], x0[rest])
+        overlap_height = np.minimum(y1[best], y1[rest]) - np.maximum(y0[best], y0[rest])
+        intersection = np.clip(overlap_width, 0, None) * np.clip(overlap_height, 0, None)
+        iou = intersection / (areas[best] + areas[rest] - intersection)
+
+        order = rest[iou <= iou_threshold]
+
+    return np.array(keep, dtype=np.intp)
+
+
+def find_candidates(hsv_img, colors=None, min_area=MIN_CANDIDATE_AREA,
+                    iou_threshold=NMS_IOU_THRESHOLD):
+    """
+    Find candidate regions in an HSV array, one mask per probe color. The
+    masks are opened to drop speckle before the regions are outlined, then
+    overlapping candidates (e.g. from adjacent colors) are collapsed with
+    non-maximum suppression, preferring larger regions.
+    :param hsv_img: HSV numpy array, e.g. an image or a window of one
+    :param colors: probe colors to look for (see PROBE_COLOR_RANGES), e.g.
+        from the image set's ImageSetProbeMap. Without any known colors the
+        bright regions are used instead.
+    :param min_area: smallest region area to keep, in pixels
+    :param iou_threshold: see non_max_suppression
+    :return: list of int32 numpy arrays of shape (N, 2), in hsv_img coordinates
+    """
+    colors = [c for c in (colors or []) if c in PROBE_COLOR_RANGES]
+
+    if len(colors) > 0:
+        masks = [color_mask(hsv_img, color) for color in colors]
+    else:
+        masks = [brightness_mask(hsv_img)]
+
+    polygons = []
+    areas = []
+
+    for mask in masks:
+        # noinspection PyUnresolvedReferences
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, OPEN_KERNEL)
+        mask_polygons, mask_areas = mask_to_polygons(mask, min_area=min_area)
+        polygons.extend(mask_polygons)
+        areas.append(mask_areas)
+
+    if len(polygons) <= 1:
+        return polygons
+
+    keep = non_max_suppression(bounding_boxes(polygons), np.concatenate(areas), iou_threshold)
+
+    return [polygons[i] for i in keep]
+
+
+def get_probe_colors(image_set):
+    """
+    The distinct probe colors of an image set, lower-cased
+    """
+    return sorted(set(
+        color.strip().lower()
+        for color in image_set.imagesetprobemap_set.values_list('color', flat=True)
+    ))
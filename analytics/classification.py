@@ -0,0 +1,52 @@
+"""
+Classification of polygons using an image set's trained model
+"""
+from analytics import caches, features
+
+
+def classify_polygons(image, polygons):
+    """
+    Classify any number of polygons on one image. The image & model are
+    each loaded once, and all the polygons are scored with a single
+    predict_proba call.
+    :param image: analytics.models.Image instance, its image set must be trained
+    :param polygons: list of numpy arrays of shape (N, 2)
+    :return: tuple of (model classes, probabilities) where probabilities is a
+        numpy array of shape (len(polygons), len(model classes))
+    """
+    pipeline = caches.get_trained_model(image.image_set.trainedmodel)
+
+    columns, rows = features.extract_image_features(
+        image.image_orig_sha1,
+        image.image_orig,
+        [(polygon, None) for polygon in polygons]
+    )
+
+    return score_feature_rows(pipeline, columns, rows)
+
+
+def score_feature_rows(pipeline, columns, rows):
+    """
+    Score a batch of feature rows with a single predict_proba call
+    :param pipeline: fitted sklearn pipeline, see caches.get_trained_model
+    :param columns: feature column names, see features.extract_features
+    :param rows: feature rows, see features.extract_features
+    :return: tuple of (model classes, probabilities) where probabilities is a
+        numpy array of shape (len(rows), len(model classes))
+    """
+    features_data_frame = features.rows_to_data_frame(columns, rows)
+
+    model_classes = list(pipeline.named_steps['classification'].classes_)
+    probabilities = pipeline.predict_proba(features_data_frame.drop('label', axis=1))
+
+    assert (len(model_classes) == probabilities.shape[1])
+
+    return model_classes, probabilities
+
+
+def format_probabilities(model_classes, polygon_probabilities):
+    """
+    Format one polygon's probabilities as the API returns them,
+    i.e. [{"class name": probability}, ...]
+    """
+    return [{a: float(polygon_probabilities[i])} for i, a in enumerate(model_classes)]
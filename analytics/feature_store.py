@@ -0,0 +1,135 @@
+"""
+Persistent per-sub-region feature store, so training only computes
+features for sub-regions that are new or whose polygon has changed. Features
+of newly saved sub-regions are computed ahead of training by the
+run_training_worker management command while it has no jobs.
+"""
+from analytics import models, features, polygons
+from django.db import transaction
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _to_json(feature_values):
+    # numpy scalars aren't JSON serializable
+    return json.dumps(feature_values, default=lambda value: value.item())
+
+
+def get_stored_features(subregion_ids):
+    """
+    Look up stored features for the given sub-regions
+    :param subregion_ids: list or queryset of analytics.models.Subregion ids
+    :return: dict of sub-region id -> SubregionFeatures
+    """
+    stored = models.SubregionFeatures.objects.filter(
+        subregion__in=subregion_ids,
+        schema_version=features.FEATURE_SCHEMA_VERSION
+    )
+
+    return {f.subregion_id: f for f in stored}
+
+
+def is_current(stored, polygon, image_sha1):
+    """
+    Whether stored features still describe the given polygon & image
+    """
+    return (
+        stored is not None and
+        stored.schema_version == features.FEATURE_SCHEMA_VERSION and
+        stored.image_sha1 == image_sha1 and
+        stored.polygon_sha1 == polygons.polygon_sha1(polygon)
+    )
+
+
+def load_features(stored):
+    return json.loads(stored.features)
+
+
+def save_features(entries):
+    """
+    Replace the stored features for a batch of sub-regions
+    :param entries: list of (sub-region id, polygon, image sha1, feature dict)
+    """
+    if len(entries) == 0:
+        return
+
+    with transaction.atomic():
+        models.SubregionFeatures.objects.filter(
+            subregion__in=[e[0] for e in entries]
+        ).delete()
+
+        models.SubregionFeatures.objects.bulk_create(
+            [
+                models.SubregionFeatures(
+                    subregion_id=subregion_id,
+                    polygon_sha1=polygons.polygon_sha1(polygon),
+                    image_sha1=image_sha1,
+                    schema_version=features.FEATURE_SCHEMA_VERSION,
+                    features=_to_json(feature_values)
+                ) for subregion_id, polygon, image_sha1, feature_values in entries
+            ]
+        )
+
+
+def populate_features(subregion_ids):
+    """
+    Compute & store features for newly saved sub-regions. This is a best
+    effort: images not yet downloaded are skipped, and on any failure the
+    features are simply computed later by training.
+    :param subregion_ids: list of analytics.models.Subregion ids
+    :return: list of the ids whose features were stored
+    """
+    subregions = models.Subregion.objects.filter(id__in=subregion_ids)\
+        .select_related('image')
+    by_image = {}
+
+    for subregion in subregions:
+        if subregion.image.image_orig_sha1:
+            by_image.setdefault(subregion.image, []).append(subregion)
+
+    stored_ids = []
+
+    for image, image_subregions in by_image.items():
+        try:
+            image_polygons = [(s.get_polygon(), None) for s in image_subregions]
+            columns, rows = features.extract_image_features(
+                image.image_orig_sha1,
+                image.image_orig.path,
+                image_polygons
+            )
+            save_features(
+                [
+                    (
+                        s.id,
+                        polygon,
+                        image.image_orig_sha1,
+                        dict(zip(columns[:-1], row[:-1]))
+                    ) for s, (polygon, label), row in zip(image_subregions, image_polygons, rows)
+                ]
+            )
+            stored_ids.extend(s.id for s in image_subregions)
+        except Exception:
+            logger.exception('Failed to store features for image %s', image.id)
+
+    return stored_ids
+
+
+def get_missing_feature_ids(limit, exclude_ids=()):
+    """
+    Sub-regions on downloaded images without current stored features,
+    newest first, e.g. those just saved through the API
+    :param limit: maximum number of ids to return
+    :param exclude_ids: ids to skip, e.g. those that already failed
+    :return: list of analytics.models.Subregion ids
+    """
+    return list(
+        models.Subregion.objects
+        .filter(polygon__isnull=False, image__image_orig_sha1__isnull=False)
+        .exclude(image__image_orig_sha1='')
+        .exclude(features__schema_version=features.FEATURE_SCHEMA_VERSION)
+        .exclude(id__in=exclude_ids)
+        .order_by('-id')
+        .values_list('id', flat=True)[:limit]
+    )
@@ -0,0 +1,107 @@
+"""
+Feature extraction for sub-region polygons. The functions here don't touch
+the database, so they can run in worker processes during training.
+"""
+from analytics import caches
+from django.conf import settings
+from lung_map_utils import utils
+import numpy as np
+import pandas as pd
+
+# Bump this whenever the feature metrics generated by lung_map_utils change,
+# stored features with an older version are then re-computed.
+# 2: features are extracted from a crop around each polygon, see crop_region
+FEATURE_SCHEMA_VERSION = 2
+
+# pixels kept around a polygon's bounding box when cropping it out of the
+# image, see crop_region
+FEATURE_CROP_MARGIN = getattr(settings, 'FEATURE_CROP_MARGIN', 16)
+
+
+def crop_region(hsv_img, polygon, margin=FEATURE_CROP_MARGIN):
+    """
+    Crop an HSV array to a polygon's bounding box plus a margin, so the
+    polygon's mask is only ever built over the crop rather than the whole
+    image. The crop leaves the polygon's shape & pixels as they were, so its
+    features should be unchanged (the benchmark_feature_extraction management
+    command compares both on real images). Features stored before cropping
+    are re-computed all the same, see FEATURE_SCHEMA_VERSION.
+    :param hsv_img: HSV numpy array (or memmap)
+    :param polygon: array-like of shape (N, 2) in hsv_img coordinates
+    :param margin: pixels to keep around the bounding box
+    :return: tuple of (cropped HSV array, polygon in crop coordinates)
+    """
+    polygon = np.asarray(polygon, dtype=np.int32).reshape(-1, 2)
+    height, width = hsv_img.shape[:2]
+
+    x0, y0 = np.maximum(polygon.min(axis=0) - margin, 0)
+    x1, y1 = np.minimum(polygon.max(axis=0) + margin + 1, (width, height))
+
+    if x1 <= x0 or y1 <= y0:
+        # the polygon lies outside the image, nothing to crop to
+        return hsv_img, polygon
+
+    # a copy, so the crop is contiguous & doesn't keep a memmap open
+    crop = np.ascontiguousarray(hsv_img[y0:y1, x0:x1])
+
+    return crop, polygon - (x0, y0)
+
+
+def extract_features(hsv_img, polygons, margin=FEATURE_CROP_MARGIN):
+    """
+    Generate the features for labelled polygons on an HSV array
+    :param hsv_img: HSV numpy array, e.g. a whole image or a window of one
+    :param polygons: list of (polygon array, label) tuples, in the
+        coordinates of hsv_img
+    :param margin: each polygon is cropped out of hsv_img with this margin,
+        see crop_region. None passes the whole of hsv_img for every polygon.
+    :return: tuple of (column names, rows) where each row is a tuple of
+        feature values in column order. 'label' is always the last column.
+    """
+    columns = None
+    rows = []
+
+    for polygon, label in polygons:
+        if margin is None or len(polygon) == 0:
+            region_img, region_polygon = hsv_img, polygon
+        else:
+            region_img, region_polygon = crop_region(hsv_img, polygon, margin)
+
+        features = utils.generate_features(
+            hsv_img_as_numpy=region_img,
+            polygon_points=region_polygon,
+            label=label
+        )
+
+        if columns is None:
+            columns = tuple(sorted(k for k in features if k != 'label')) + ('label',)
+
+        rows.append(tuple(features[c] for c in columns))
+
+    return columns, rows
+
+
+def extract_image_features(sha1, image_file, polygons, cached=True):
+    """
+    Generate the features for all the labelled polygons of a single image
+    :param sha1: SHA1 of the original image, used to find its cached HSV array
+    :param image_file: file path of the original image
+    :param polygons: list of (polygon array, label) tuples
+    :param cached: whether to read & fill the HSV image caches. Callers which
+        only read each image once, like training, should pass False so the
+        image isn't held in memory or written to the disk cache for nothing.
+    :return: see extract_features
+    """
+    if cached:
+        hsv_img = caches.get_hsv_image(sha1, image_file)
+    else:
+        hsv_img = caches.decode_hsv_image(image_file)
+
+    return extract_features(hsv_img, polygons)
+
+
+def rows_to_data_frame(columns, rows):
+    """
+    Build the training DataFrame from compact feature rows
+    """
+    return pd.DataFrame.from_records(rows, columns=list(columns))
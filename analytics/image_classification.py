@@ -0,0 +1,285 @@
+"""
+Automatic classification of whole images. Candidate regions are found &
+scored tile by tile over the memory-mapped HSV raster, so only a window of
+the image is ever in memory. Like training it is slow for large images, so
+the API queues a ClassificationJob and the run_classification_worker
+management command picks it up.
+"""
+from analytics import models, caches, candidates, classification, features, polygons, \
+    result_store
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+import datetime
+import json
+import numpy as np
+import traceback
+
+CLASSIFICATION_TILE_SIZE = getattr(settings, 'CLASSIFICATION_TILE_SIZE', 2048)
+# regions are found in the tile plus this margin, so those crossing a tile
+# edge are still outlined whole (up to the margin's size)
+CLASSIFICATION_TILE_MARGIN = getattr(settings, 'CLASSIFICATION_TILE_MARGIN', 256)
+# number of candidates scored per predict_proba call
+CLASSIFICATION_BATCH_SIZE = getattr(settings, 'CLASSIFICATION_BATCH_SIZE', 256)
+# a running job without a heartbeat (sent after each tile) for this long
+# belongs to a worker that died or was restarted
+CLASSIFICATION_JOB_STALE_SECONDS = getattr(settings, 'CLASSIFICATION_JOB_STALE_SECONDS', 60 * 60)
+
+
+def iter_tiles(width, height, tile_size, margin):
+    """
+    Split an image into tiles
+    :return: generator of ((x0, y0, x1, y1) tile, (x0, y0, x1, y1) window)
+        tuples, the window being the tile grown by the margin & clipped
+        to the image
+    """
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            x1 = min(x0 + tile_size, width)
+            y1 = min(y0 + tile_size, height)
+
+            yield (x0, y0, x1, y1), (
+                max(x0 - margin, 0),
+                max(y0 - margin, 0),
+                min(x1 + margin, width),
+                min(y1 + margin, height)
+            )
+
+
+def count_tiles(width, height, tile_size):
+    return -(-width // tile_size) * -(-height // tile_size)
+
+
+def find_tile_candidates(hsv_img, tile, window, colors=None):
+    """
+    Find the candidate regions belonging to a tile. Regions are found in the
+    whole window & each is kept by the single tile containing the top left
+    corner of its bounding box, so regions in the overlap aren't duplicated.
+    :param hsv_img: HSV array (or memmap) of the whole image
+    :param tile: (x0, y0, x1, y1) of the tile
+    :param window: (x0, y0, x1, y1) of the window around the tile
+    :param colors: probe colors to look for, see candidates.find_candidates
+    :return: tuple of (window array, [polygon in window coordinates, ...])
+    """
+    wx0, wy0, wx1, wy1 = window
+    tx0, ty0, tx1, ty1 = tile
+
+    # copy the window out of the memmap once, everything else works on it
+    window_img = np.ascontiguousarray(hsv_img[wy0:wy1, wx0:wx1])
+    owned = []
+
+    for polygon in candidates.find_candidates(window_img, colors=colors):
+        x, y = polygon.min(axis=0) + (wx0, wy0)
+
+        if tx0 <= x < tx1 and ty0 <= y < ty1:
+            owned.append(polygon)
+
+    return window_img, owned
+
+
+def classify_image(image, pipeline, progress_callback=None):
+    """
+    Find & classify candidate regions over a whole image
+    :param image: analytics.models.Image instance, must have been fetched
+    :param pipeline: fitted sklearn pipeline, see caches.get_trained_model
+    :param progress_callback: optional callable, called with the number of
+        tiles processed so far after each tile
+    :return: generator of (polygon, model classes, probabilities) tuples in
+        batches, where polygon is in image coordinates & probabilities is a
+        row of the model's predict_proba output
+    """
+    hsv_img = caches.get_hsv_memmap(image.image_orig_sha1, image.image_orig)
+    height, width = hsv_img.shape[:2]
+    colors = candidates.get_probe_colors(image.image_set)
+
+    columns = None
+    pending_polygons = []
+    pending_rows = []
+
+    def score(batch_polygons, batch_rows):
+        model_classes, probabilities = classification.score_feature_rows(
+            pipeline,
+            columns,
+            batch_rows
+        )
+
+        return [
+            (polygon, model_classes, row)
+            for polygon, row in zip(batch_polygons, probabilities)
+        ]
+
+    tiles = iter_tiles(width, height, CLASSIFICATION_TILE_SIZE, CLASSIFICATION_TILE_MARGIN)
+
+    for tiles_processed, (tile, window) in enumerate(tiles, start=1):
+        window_img, tile_polygons = find_tile_candidates(hsv_img, tile, window, colors)
+
+        if len(tile_polygons) > 0:
+            tile_columns, rows = features.extract_features(
+                window_img,
+                [(polygon, None) for polygon in tile_polygons]
+            )
+            columns = columns or tile_columns
+
+            pending_polygons.extend(polygon + window[:2] for polygon in tile_polygons)
+            pending_rows.extend(rows)
+
+        while len(pending_rows) >= CLASSIFICATION_BATCH_SIZE:
+            yield score(
+                pending_polygons[:CLASSIFICATION_BATCH_SIZE],
+                pending_rows[:CLASSIFICATION_BATCH_SIZE]
+            )
+            del pending_polygons[:CLASSIFICATION_BATCH_SIZE]
+            del pending_rows[:CLASSIFICATION_BATCH_SIZE]
+
+        if progress_callback is not None:
+            progress_callback(tiles_processed)
+
+    if len(pending_rows) > 0:
+        yield score(pending_polygons, pending_rows)
+
+
+def fail_stale_jobs():
+    """
+    Fail running jobs whose worker has stopped sending heartbeats, so their
+    images can be classified again, see training.fail_stale_jobs
+    :return: number of jobs failed
+    """
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=CLASSIFICATION_JOB_STALE_SECONDS)
+    stale_jobs = models.ClassificationJob.objects.filter(
+        Q(heartbeat__lt=stale) | Q(heartbeat__isnull=True, started__lt=stale),
+        status=models.ClassificationJob.STATUS_RUNNING
+    )
+    stale_ids = list(stale_jobs.values_list('id', flat=True))
+
+    failed = models.ClassificationJob.objects.filter(
+        id__in=stale_ids,
+        status=models.ClassificationJob.STATUS_RUNNING
+    ).update(
+        status=models.ClassificationJob.STATUS_FAILED,
+        detail="The worker stopped before the job finished, please classify again",
+        finished=now
+    )
+    # the regions saved so far are an arbitrary part of the image
+    models.ClassifiedRegion.objects.filter(job_id__in=stale_ids).delete()
+
+    return failed
+
+
+def queue_classification_job(image, user=None):
+    """
+    Validates the image can be classified & queues a job to do so
+    :param image: analytics.models.Image instance
+    :param user: the django User requesting the classification
+    :return: the new analytics.models.ClassificationJob instance
+    :raises ValueError: if the image cannot be classified
+    """
+    if not hasattr(image.image_set, 'trainedmodel'):
+        raise ValueError("Image set has no trained model")
+
+    if not image.image_orig_sha1:
+        raise ValueError("Image has not been downloaded yet")
+
+    trained_model = image.image_set.trainedmodel
+    fail_stale_jobs()
+
+    if models.ClassificationJob.objects.filter(
+        image=image,
+        trained_model=trained_model,
+        status__in=models.ClassificationJob.ACTIVE_STATUSES
+    ).exists():
+        raise ValueError("Image is already being classified")
+
+    return models.ClassificationJob.objects.create(
+        image=image,
+        trained_model=trained_model,
+        user=user
+    )
+
+
+def claim_next_job():
+    """
+    Claim the oldest queued classification job. The status change is a
+    conditional UPDATE, so when several workers race for the same job only
+    one wins.
+    :return: the claimed ClassificationJob, or None if the queue is empty
+    """
+    fail_stale_jobs()
+
+    queued = models.ClassificationJob.objects.filter(
+        status=models.ClassificationJob.STATUS_QUEUED
+    )
+
+    for job in queued.order_by('created')[:10]:
+        claimed = models.ClassificationJob.objects.filter(
+            id=job.id,
+            status=models.ClassificationJob.STATUS_QUEUED
+        ).update(
+            status=models.ClassificationJob.STATUS_RUNNING,
+            started=timezone.now(),
+            heartbeat=timezone.now()
+        )
+
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+    return None
+
+
+def run_classification_job(job):
+    """
+    Classifies the job's image, saving the regions found batch by batch &
+    recording progress & the outcome on the job
+    :param job: a claimed (i.e. running) analytics.models.ClassificationJob
+    """
+    def update_progress(tiles_processed):
+        models.ClassificationJob.objects.filter(id=job.id).update(
+            tiles_processed=tiles_processed,
+            heartbeat=timezone.now()
+        )
+
+    regions_found = 0
+
+    try:
+        image = job.image
+        height, width = caches.get_hsv_memmap(image.image_orig_sha1, image.image_orig).shape[:2]
+        job.tiles_total = count_tiles(width, height, CLASSIFICATION_TILE_SIZE)
+        models.ClassificationJob.objects.filter(id=job.id).update(tiles_total=job.tiles_total)
+
+        pipeline = caches.get_trained_model(job.trained_model)
+
+        for batch in classify_image(image, pipeline, progress_callback=update_progress):
+            regions = []
+
+            for polygon, model_classes, probabilities in batch:
+                best = int(np.argmax(probabilities))
+                regions.append(
+                    models.ClassifiedRegion(
+                        job=job,
+                        polygon=polygons.pack_polygon(polygon),
+                        anatomy=model_classes[best],
+                        probability=float(probabilities[best]),
+                        probabilities=json.dumps(
+                            {c: float(p) for c, p in zip(model_classes, probabilities)}
+                        )
+                    )
+                )
+
+            models.ClassifiedRegion.objects.bulk_create(regions)
+            # so classifying these regions again is a lookup
+            result_store.save_results(job.trained_model, image, batch)
+            regions_found += len(regions)
+    except Exception as e:
+        models.ClassifiedRegion.objects.filter(job=job).delete()
+        job.status = models.ClassificationJob.STATUS_FAILED
+        job.detail = str(e).strip() or traceback.format_exc()
+    else:
+        job.status = models.ClassificationJob.STATUS_COMPLETE
+        job.regions_found = regions_found
+        job.tiles_processed = job.tiles_total
+
+    job.finished = timezone.now()
+    job.save(
+        update_fields=['status', 'detail', 'regions_found', 'tiles_processed', 'finished']
+    )
@@ -0,0 +1,188 @@
+"""
+Bulk import of LungMap image set candidates (see
+lungmap_client.lungmap_utils.get_image_set_candidates) into the database.
+Everything is collected up front & diffed against the existing natural
+keys, so only new rows are written, in batched INSERTs.
+"""
+from analytics import models
+from django.db import transaction
+
+BATCH_SIZE = 500
+
+
+def _collect(image_sets):
+    """
+    Flatten image set candidates into sets of natural keys per model
+    """
+    experiments = {}
+    probes = set()
+    image_set_rows = {}
+    image_set_probes = set()
+    images = {}
+    experiment_probes = set()
+
+    for key, value in image_sets.items():
+        image_set_rows[key] = {
+            'magnification': value['magnification'],
+            'species': value['species'],
+            'development_stage': value['development_stage']
+        }
+
+        for image in value['images']:
+            experiments[image['experiment_id']] = image['experiment_type_id']
+            images[(key, image['image_id'], image['source_url'])] = image
+
+        for exp in value['experiments']:
+            experiments.setdefault(exp['experiment_id'], exp['experiment_type_id'])
+
+        for p in value['probes']:
+            label = p['probe_label'].strip()
+            probes.add(label)
+            image_set_probes.add((key, label, p['color']))
+
+            for exp in value['experiments']:
+                experiment_probes.add((exp['experiment_id'], label, p['color']))
+
+    return {
+        'experiments': experiments,
+        'probes': probes,
+        'image_sets': image_set_rows,
+        'image_set_probes': image_set_probes,
+        'images': images,
+        'experiment_probes': experiment_probes
+    }
+
+
+def _existing_keys():
+    """
+    Natural keys of everything already imported, one query per model
+    """
+    return {
+        'experiments': set(
+            models.Experiment.objects.values_list('experiment_id', flat=True)
+        ),
+        'probes': set(models.Probe.objects.values_list('label', flat=True)),
+        'image_sets': set(models.ImageSet.objects.values_list('image_set_name', flat=True)),
+        'image_set_probes': set(
+            models.ImageSetProbeMap.objects.values_list(
+                'image_set__image_set_name', 'probe__label', 'color'
+            )
+        ),
+        'images': set(
+            models.Image.objects.values_list(
+                'image_set__image_set_name', 'image_id', 'source_url'
+            )
+        ),
+        'experiment_probes': set(
+            models.ExperimentProbeMap.objects.values_list(
+                'experiment__experiment_id', 'probe__label', 'color'
+            )
+        )
+    }
+
+
+def import_image_sets(image_sets, dry_run=False, log=None):
+    """
+    Import image set candidates, creating only what doesn't exist yet
+    :param image_sets: dict as returned by get_image_set_candidates
+    :param dry_run: if True, only count what would be created
+    :param log: optional callable taking a progress message string
+    :return: dict of model name -> number of new rows
+    """
+    log = log or (lambda message: None)
+    collected = _collect(image_sets)
+    existing = _existing_keys()
+
+    new = {
+        'experiments': {
+            e_id: e_type for e_id, e_type in collected['experiments'].items()
+            if e_id not in existing['experiments']
+        },
+        'probes': collected['probes'] - existing['probes'],
+        'image_sets': {
+            name: row for name, row in collected['image_sets'].items()
+            if name not in existing['image_sets']
+        },
+        'image_set_probes': collected['image_set_probes'] - existing['image_set_probes'],
+        'images': {
+            key: image for key, image in collected['images'].items()
+            if key not in existing['images']
+        },
+        'experiment_probes': collected['experiment_probes'] - existing['experiment_probes']
+    }
+    counts = {name: len(rows) for name, rows in new.items()}
+
+    for name, count in counts.items():
+        log('%s: %d new' % (name, count))
+
+    if dry_run:
+        return counts
+
+    with transaction.atomic():
+        log('Creating experiments...')
+        models.Experiment.objects.bulk_create(
+            (
+                models.Experiment(experiment_id=e_id, experiment_type_id=e_type)
+                for e_id, e_type in new['experiments'].items()
+            ),
+            batch_size=BATCH_SIZE
+        )
+
+        log('Creating probes...')
+        models.Probe.objects.bulk_create(
+            (models.Probe(label=label) for label in new['probes']),
+            batch_size=BATCH_SIZE
+        )
+        probe_ids = dict(models.Probe.objects.values_list('label', 'id'))
+
+        log('Creating image sets...')
+        models.ImageSet.objects.bulk_create(
+            (
+                models.ImageSet(image_set_name=name, **row)
+                for name, row in new['image_sets'].items()
+            ),
+            batch_size=BATCH_SIZE
+        )
+        image_set_ids = dict(models.ImageSet.objects.values_list('image_set_name', 'id'))
+
+        log('Creating image set probe maps...')
+        models.ImageSetProbeMap.objects.bulk_create(
+            (
+                models.ImageSetProbeMap(
+                    image_set_id=image_set_ids[name],
+                    probe_id=probe_ids[label],
+                    color=color
+                ) for name, label, color in new['image_set_probes']
+            ),
+            batch_size=BATCH_SIZE
+        )
+
+        log('Creating images...')
+        models.Image.objects.bulk_create(
+            (
+                models.Image(
+                    source_url=image['source_url'],
+                    image_name=image['image_name'],
+                    image_id=image['image_id'],
+                    x_scaling=image['x_scaling'],
+                    y_scaling=image['y_scaling'],
+                    image_set_id=image_set_ids[name],
+                    experiment_id=image['experiment_id']
+                ) for (name, image_id, source_url), image in new['images'].items()
+            ),
+            batch_size=BATCH_SIZE
+        )
+
+        log('Creating experiment probe maps...')
+        models.ExperimentProbeMap.objects.bulk_create(
+            (
+                models.ExperimentProbeMap(
+                    experiment_id=e_id,
+                    probe_id=probe_ids[label],
+                    color=color
+                ) for e_id, label, color in new['experiment_probes']
+            ),
+            batch_size=BATCH_SIZE
+        )
+
+    return counts
@@ -0,0 +1,156 @@
+from analytics import caches, candidates, models
+from django.core.management.base import BaseCommand, CommandError
+import numpy as np
+import time
+# noinspection PyPackageRequirements
+import cv2
+
+
+def pairwise_suppression(boxes, scores, iou_threshold):
+    """
+    Baseline: compare every pair of candidates in Python
+    """
+    order = sorted(range(len(boxes)), key=lambda i: scores[i], reverse=True)
+    suppressed = set()
+    keep = []
+
+    for position, i in enumerate(order):
+        if i in suppressed:
+            continue
+
+        keep.append(i)
+        ax0, ay0, ax1, ay1 = boxes[i]
+
+        for j in order[position + 1:]:
+            if j in suppressed:
+                continue
+
+            bx0, by0, bx1, by1 = boxes[j]
+            width = max(0.0, min(ax1, bx1) - max(ax0, bx0))
+            height = max(0.0, min(ay1, by1) - max(ay0, by0))
+            intersection = width * height
+            union = (ax1 - ax0) * (ay1 - ay0) + (bx1 - bx0) * (by1 - by0) - intersection
+
+            if intersection / union > iou_threshold:
+                suppressed.add(j)
+
+    return keep
+
+
+def synthetic_image(size, blobs, seed=0):
+    """
+    Dark image with red & green blobs, each green blob shadowed by a slightly
+    offset red one so both colors yield overlapping candidates
+    :return: tuple of (HSV array, colors)
+    """
+    random = np.random.RandomState(seed)
+    bgr_image = np.zeros((size, size, 3), dtype=np.uint8)
+
+    for _ in range(blobs):
+        x, y = random.randint(0, size, 2)
+        radius = int(random.randint(12, 30))
+        # noinspection PyUnresolvedReferences
+        cv2.circle(bgr_image, (int(x), int(y)), radius, (0, 0, 255), -1)
+        # noinspection PyUnresolvedReferences
+        cv2.circle(bgr_image, (int(x) + 3, int(y) + 3), radius, (0, 255, 0), -1)
+
+    # noinspection PyUnresolvedReferences
+    return cv2.cvtColor(bgr_image, cv2.COLOR_BGR2HSV), ['red', 'green']
+
+
+class Command(BaseCommand):
+    help = 'Time candidate region generation & compare vectorized and pairwise suppression'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--image-id',
+            type=int,
+            help='Use a downloaded image instead of a synthetic one'
+        )
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=4096,
+            help='Width & height of the synthetic image'
+        )
+        parser.add_argument(
+            '--blobs',
+            type=int,
+            default=3000,
+            help='Number of blobs in the synthetic image'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of runs of each step, the best is reported'
+        )
+
+    def time(self, func, *args):
+        durations = []
+        result = None
+
+        for _ in range(max(self.repeat, 1)):
+            start = time.perf_counter()
+            result = func(*args)
+            durations.append(time.perf_counter() - start)
+
+        return min(durations), result
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+
+        if options['image_id'] is not None:
+            try:
+                image = models.Image.objects.get(id=options['image_id'])
+            except models.Image.DoesNotExist:
+                raise CommandError("No such image: %s" % options['image_id'])
+
+            hsv_img = caches.get_hsv_image(image.image_orig_sha1, image.image_orig)
+            colors = candidates.get_probe_colors(image.image_set)
+        else:
+            hsv_img, colors = synthetic_image(options['size'], options['blobs'])
+
+        self.stdout.write(
+            'Image %dx%d, colors %s' % (hsv_img.shape[1], hsv_img.shape[0], ', '.join(colors))
+        )
+
+        # everything before suppression, to compare the two implementations on
+        polygons = []
+        areas = []
+
+        for color in colors:
+            # noinspection PyUnresolvedReferences
+            mask = cv2.morphologyEx(
+                candidates.color_mask(hsv_img, color),
+                cv2.MORPH_OPEN,
+                candidates.OPEN_KERNEL
+            )
+            color_polygons, color_areas = candidates.mask_to_polygons(mask)
+            polygons.extend(color_polygons)
+            areas.append(color_areas)
+
+        boxes = candidates.bounding_boxes(polygons)
+        scores = np.concatenate(areas) if areas else np.zeros(0)
+
+        total_time, found = self.time(candidates.find_candidates, hsv_img, colors)
+        nms_time, keep = self.time(
+            candidates.non_max_suppression,
+            boxes,
+            scores,
+            candidates.NMS_IOU_THRESHOLD
+        )
+        pairwise_time, pairwise_keep = self.time(
+            pairwise_suppression,
+            boxes.tolist(),
+            scores.tolist(),
+            candidates.NMS_IOU_THRESHOLD
+        )
+
+        if sorted(keep.tolist()) != sorted(pairwise_keep):
+            raise CommandError("Vectorized & pairwise suppression disagree")
+
+        self.stdout.write('%d candidates, %d after suppression' % (len(boxes), len(found)))
+        self.stdout.write('find_candidates         %.3fs' % total_time)
+        self.stdout.write('vectorized suppression  %.4fs' % nms_time)
+        self.stdout.write('pairwise suppression    %.4fs' % pairwise_time)
@@ -0,0 +1,153 @@
+from analytics import caches, features, models
+from django.core.management.base import BaseCommand, CommandError
+import numpy as np
+import time
+import tracemalloc
+
+
+def synthetic_regions(width, height, count, seed=0):
+    """
+    A random HSV image with small polygons (roughly circles of 10 - 60
+    pixels radius) scattered over it
+    :return: tuple of (HSV array, [(polygon, None), ...])
+    """
+    random = np.random.RandomState(seed)
+    hsv_img = random.randint(0, 180, (height, width, 3)).astype(np.uint8)
+    angles = np.linspace(0, 2 * np.pi, 24, endpoint=False)
+    regions = []
+
+    for _ in range(count):
+        radius = random.randint(10, 60)
+        cx = random.randint(radius, width - radius)
+        cy = random.randint(radius, height - radius)
+        polygon = np.stack(
+            [cx + radius * np.cos(angles), cy + radius * np.sin(angles)],
+            axis=1
+        ).astype(np.int32)
+        regions.append((polygon, None))
+
+    return hsv_img, regions
+
+
+class Command(BaseCommand):
+    help = 'Compare per-region feature extraction time & peak memory with & without cropping'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--image-id',
+            type=int,
+            help="Use a downloaded image & its sub-regions instead of a synthetic image"
+        )
+        parser.add_argument(
+            '--width',
+            type=int,
+            default=4000,
+            help='Width of the synthetic image'
+        )
+        parser.add_argument(
+            '--height',
+            type=int,
+            default=3000,
+            help='Height of the synthetic image'
+        )
+        parser.add_argument(
+            '--regions',
+            type=int,
+            default=50,
+            help='Number of regions on the synthetic image'
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=1e-9,
+            help='Largest feature difference allowed between the two paths'
+        )
+        parser.add_argument(
+            '--margin',
+            type=int,
+            default=features.FEATURE_CROP_MARGIN,
+            help='Margin kept around each cropped region'
+        )
+
+    def run(self, name, hsv_img, regions, margin):
+        durations = []
+        peaks = []
+        rows = []
+        columns = None
+
+        for region in regions:
+            tracemalloc.start()
+            start = time.perf_counter()
+            columns, region_rows = features.extract_features(hsv_img, [region], margin=margin)
+            durations.append(time.perf_counter() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            rows.extend(region_rows)
+
+        self.stdout.write(
+            '%-8s per region: mean %.2fms  max %.2fms  peak memory mean %.2f MB  max %.2f MB' % (
+                name,
+                1000 * np.mean(durations),
+                1000 * np.max(durations),
+                np.mean(peaks) / (1024 * 1024),
+                np.max(peaks) / (1024 * 1024)
+            )
+        )
+
+        return columns, rows, np.mean(durations), np.mean(peaks)
+
+    def handle(self, *args, **options):
+        if options['image_id'] is not None:
+            try:
+                image = models.Image.objects.get(id=options['image_id'])
+            except models.Image.DoesNotExist:
+                raise CommandError("No such image: %s" % options['image_id'])
+
+            if not image.image_orig_sha1:
+                raise CommandError("Image %s has not been downloaded yet" % image.id)
+
+            hsv_img = caches.get_hsv_image(image.image_orig_sha1, image.image_orig)
+            regions = [(s.get_polygon(), None) for s in image.subregion_set.all()]
+        else:
+            hsv_img, regions = synthetic_regions(
+                options['width'],
+                options['height'],
+                options['regions']
+            )
+
+        regions = [r for r in regions if len(r[0]) > 0]
+
+        if len(regions) == 0:
+            raise CommandError("No regions to extract features for")
+
+        self.stdout.write(
+            'Image %dx%d, %d regions' % (hsv_img.shape[1], hsv_img.shape[0], len(regions))
+        )
+
+        columns, full_rows, full_time, full_peak = self.run('full', hsv_img, regions, None)
+        columns, crop_rows, crop_time, crop_peak = self.run(
+            'cropped',
+            hsv_img,
+            regions,
+            options['margin']
+        )
+
+        # the label is the last column & None here
+        difference = np.max(np.abs(
+            np.array([r[:-1] for r in full_rows], dtype=np.float64) -
+            np.array([r[:-1] for r in crop_rows], dtype=np.float64)
+        ))
+
+        self.stdout.write(
+            'cropped is %.1fx faster with %.1f%% of the peak memory, '
+            'largest feature difference %g' % (
+                full_time / crop_time,
+                100.0 * crop_peak / full_peak,
+                difference
+            )
+        )
+
+        if not difference <= options['tolerance']:
+            raise CommandError(
+                "Cropped features differ from full image features by %g" % difference
+            )
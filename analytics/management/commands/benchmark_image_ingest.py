@@ -0,0 +1,132 @@
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from io import BytesIO
+from lungmap_client import lungmap_utils
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+import tracemalloc
+# noinspection PyPackageRequirements
+import cv2
+# noinspection PyPackageRequirements
+from PIL import Image
+
+
+def legacy_decode(chunks, filename):
+    """
+    The ingest path used before decode_lungmap_image, kept as the baseline:
+    spools the gzip to disk, round-trips the TIFF through a second file,
+    re-encodes it with PIL & hashes the re-encoded copy
+    """
+    base, ext = os.path.splitext(filename)
+
+    with tempfile.NamedTemporaryFile(suffix=ext) as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+        f.seek(0)
+
+        with gzip.GzipFile(mode='rb', fileobj=f) as f2:
+            tiff_data = f2.read()
+
+        with open(f.name[:-3], 'wb') as f3:
+            f3.write(tiff_data)
+
+        # noinspection PyUnresolvedReferences
+        cv_img = cv2.imread(f3.name)
+
+    os.remove(f3.name)
+
+    # noinspection PyUnresolvedReferences
+    img = Image.fromarray(cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB), 'RGB')
+    img_jpeg = img.copy()
+    temp_handle = BytesIO()
+    img.save(temp_handle, 'TIFF')
+    temp_handle.seek(0)
+
+    temp_handle_jpeg = BytesIO()
+    img_jpeg.save(temp_handle_jpeg, 'JPEG')
+    temp_handle_jpeg.seek(0)
+
+    suf = SimpleUploadedFile(base, temp_handle.read(), content_type='image/tif')
+    suf_jpg = SimpleUploadedFile(
+        base.replace('.tif', '.jpg'),
+        temp_handle_jpeg.read(),
+        content_type='image/jpeg'
+    )
+
+    temp_handle.seek(0)
+    image_orig_sha1 = hashlib.sha1(temp_handle.read()).hexdigest()
+
+    return suf, image_orig_sha1, suf_jpg
+
+
+def read_chunks(path, chunk_size):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+
+            if not chunk:
+                return
+
+            yield chunk
+
+
+class Command(BaseCommand):
+    help = 'Compare ingest time & peak memory of the legacy and streaming image decode'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='A gzipped TIFF as served by LungMap, e.g. downloaded with curl'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of runs of each implementation'
+        )
+
+    def run(self, name, decode, path):
+        chunk_size = lungmap_utils.IMAGE_DOWNLOAD_CHUNK_SIZE
+        durations = []
+        peaks = []
+
+        for _ in range(self.repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            decode(read_chunks(path, chunk_size), os.path.basename(path))
+            durations.append(time.perf_counter() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        self.stdout.write(
+            '%-10s best %.3fs  mean %.3fs  peak memory %.1f MB' % (
+                name,
+                min(durations),
+                sum(durations) / len(durations),
+                max(peaks) / (1024 * 1024)
+            )
+        )
+
+        return min(durations), max(peaks)
+
+    def handle(self, *args, **options):
+        path = options['path']
+
+        if not os.path.isfile(path):
+            raise CommandError("No such file: %s" % path)
+
+        self.repeat = max(options['repeat'], 1)
+
+        legacy_time, legacy_peak = self.run('legacy', legacy_decode, path)
+        stream_time, stream_peak = self.run('streaming', lungmap_utils.decode_lungmap_image, path)
+
+        self.stdout.write(
+            'streaming is %.1fx faster with %.0f%% of the peak memory' % (
+                legacy_time / stream_time,
+                100.0 * stream_peak / legacy_peak
+            )
+        )
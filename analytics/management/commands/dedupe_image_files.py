@@ -0,0 +1,77 @@
+from analytics import models, storage
+from django.core.management.base import BaseCommand
+import os
+
+
+class Command(BaseCommand):
+    help = 'Move stored image files to content-addressed names, removing duplicate copies'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            help='Report what would be moved without changing anything'
+        )
+
+    def move(self, field_name, upload_to, dry_run):
+        """
+        Give every stored file of the given Image field its content-addressed
+        name. When the target already exists the old copy is a duplicate
+        & is removed.
+        :return: (number of files moved, bytes freed)
+        """
+        fs = storage.content_addressed_storage
+        images = models.Image.objects\
+            .exclude(image_orig_sha1__isnull=True)\
+            .exclude(image_orig_sha1='')\
+            .exclude(**{field_name: ''})\
+            .exclude(**{field_name + '__isnull': True})
+        moved = 0
+        freed = 0
+
+        for image in images.iterator():
+            old_name = getattr(image, field_name).name
+            new_name = upload_to(image, os.path.basename(old_name))
+
+            if old_name == new_name:
+                continue
+
+            moved += 1
+
+            if dry_run:
+                if fs.exists(new_name) and fs.exists(old_name):
+                    freed += fs.size(old_name)
+                continue
+
+            if fs.exists(old_name):
+                if fs.exists(new_name):
+                    freed += fs.size(old_name)
+                    fs.delete(old_name)
+                else:
+                    os.makedirs(os.path.dirname(fs.path(new_name)), exist_ok=True)
+                    os.replace(fs.path(old_name), fs.path(new_name))
+
+            # any other rows pointing at the old name follow along
+            models.Image.objects.filter(**{field_name: old_name}).update(
+                **{field_name: new_name}
+            )
+
+        return moved, freed
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        for field_name, upload_to in (
+                ('image_orig', storage.image_orig_upload_to),
+                ('image_jpeg', storage.image_jpeg_upload_to)):
+            moved, freed = self.move(field_name, upload_to, dry_run)
+            self.stdout.write(
+                '%s: %d files %s, %.1f MB of duplicates %s' % (
+                    field_name,
+                    moved,
+                    'to move' if dry_run else 'moved',
+                    freed / (1024 * 1024),
+                    'to free' if dry_run else 'freed'
+                )
+            )
@@ -0,0 +1,31 @@
+from analytics import caches, models, renditions
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Generate missing thumbnail, medium & WebP renditions for downloaded images'
+
+    def handle(self, *args, **options):
+        images = models.Image.objects\
+            .exclude(image_orig_sha1__isnull=True)\
+            .exclude(image_orig_sha1='')
+        seen = set()
+        written = 0
+
+        for image in images.iterator():
+            sha1 = image.image_orig_sha1
+
+            if sha1 in seen or renditions.has_renditions(sha1):
+                continue
+
+            seen.add(sha1)
+
+            try:
+                bgr_image = caches.decode_image(image.image_orig)
+            except (IOError, ValueError) as e:
+                self.stderr.write('Image %s: %s' % (image.id, e))
+                continue
+
+            written += renditions.generate_renditions(sha1, bgr_image)
+
+        self.stdout.write('Generated %d renditions' % written)
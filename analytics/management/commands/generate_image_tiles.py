@@ -0,0 +1,33 @@
+from analytics import caches, models, tiles
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Generate missing deep zoom tile pyramids for downloaded images'
+
+    def handle(self, *args, **options):
+        images = models.Image.objects\
+            .exclude(image_orig_sha1__isnull=True)\
+            .exclude(image_orig_sha1='')
+        seen = set()
+        generated = 0
+
+        for image in images.iterator():
+            sha1 = image.image_orig_sha1
+
+            if sha1 in seen or tiles.has_tiles(sha1):
+                continue
+
+            seen.add(sha1)
+
+            try:
+                bgr_image = caches.decode_image(image.image_orig)
+            except (IOError, ValueError) as e:
+                self.stderr.write('Image %s: %s' % (image.id, e))
+                continue
+
+            tiles.generate_tiles(sha1, bgr_image)
+            generated += 1
+            self.stdout.write('Generated tiles for image %s' % image.id)
+
+        self.stdout.write('Generated %d tile pyramids' % generated)
@@ -0,0 +1,98 @@
+from analytics import lungmap_import, models
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from lungmap_client import lungmap_utils
+import time
+
+
+class Command(BaseCommand):
+    help = 'Import image sets, images, experiments & probes from the LungMap mothership'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            help='Report what would be created without writing anything'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            default=False,
+            help='Only fetch experiments not already in the database'
+        )
+        parser.add_argument(
+            '--cache-dir',
+            default=getattr(settings, 'LUNGMAP_SPARQL_CACHE_ROOT', None),
+            help='Directory for cached SPARQL responses'
+        )
+        parser.add_argument(
+            '--cache-ttl',
+            type=int,
+            default=getattr(settings, 'LUNGMAP_SPARQL_CACHE_TTL', 24 * 60 * 60),
+            help='Seconds before a cached SPARQL response is re-fetched'
+        )
+        parser.add_argument(
+            '--max-workers',
+            type=int,
+            default=lungmap_utils.CRAWL_MAX_WORKERS,
+            help='Number of concurrent SPARQL requests'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=lungmap_utils.CRAWL_CHUNK_SIZE,
+            help='Number of experiments per SPARQL query'
+        )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        cache = None
+
+        if options['cache_dir']:
+            cache = lungmap_utils.SparqlResponseCache(
+                options['cache_dir'],
+                ttl=options['cache_ttl']
+            )
+
+        exclude_experiment_ids = None
+
+        if options['incremental']:
+            exclude_experiment_ids = set(
+                models.Experiment.objects.values_list('experiment_id', flat=True)
+            )
+
+        client = lungmap_utils.SparqlClient(
+            max_connections=options['max_workers'],
+            requests_per_second=lungmap_utils.CRAWL_REQUESTS_PER_SECOND,
+            cache=cache
+        )
+
+        self.stdout.write('Crawling LungMap...')
+
+        try:
+            image_sets = lungmap_utils.get_image_set_candidates(
+                client=client,
+                max_workers=options['max_workers'],
+                chunk_size=options['chunk_size'],
+                exclude_experiment_ids=exclude_experiment_ids
+            )
+        finally:
+            client.close()
+
+        self.stdout.write(
+            'Found %d image sets in %.1fs' % (len(image_sets), time.time() - start)
+        )
+
+        counts = lungmap_import.import_image_sets(
+            image_sets,
+            dry_run=options['dry_run'],
+            log=self.stdout.write
+        )
+
+        if options['dry_run']:
+            self.stdout.write('Dry run, nothing was written')
+        else:
+            self.stdout.write(
+                'Imported %d rows in %.1fs' % (sum(counts.values()), time.time() - start)
+            )
@@ -0,0 +1,40 @@
+from analytics import models, polygons
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import itertools
+
+
+class Command(BaseCommand):
+    help = 'Migrate sub-region vertices from Points rows to the packed Subregion.polygon column'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--delete-points',
+            action='store_true',
+            default=False,
+            help='Delete the migrated Points rows afterwards'
+        )
+
+    def handle(self, *args, **options):
+        points = models.Points.objects.filter(subregion__polygon__isnull=True)\
+            .order_by('subregion_id', 'order')\
+            .values_list('subregion_id', 'x', 'y')
+        migrated = 0
+
+        with transaction.atomic():
+            for subregion_id, rows in itertools.groupby(points.iterator(), key=lambda r: r[0]):
+                polygon = [[x, y] for _, x, y in rows]
+                x_min, y_min, x_max, y_max = polygons.bounding_box(polygon)
+                models.Subregion.objects.filter(id=subregion_id).update(
+                    polygon=polygons.pack_polygon(polygon),
+                    x_min=x_min,
+                    y_min=y_min,
+                    x_max=x_max,
+                    y_max=y_max
+                )
+                migrated += 1
+
+            if options['delete_points']:
+                models.Points.objects.filter(subregion__polygon__isnull=False).delete()
+
+        self.stdout.write('Packed polygons for %d sub-regions' % migrated)
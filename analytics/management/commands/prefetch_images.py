@@ -0,0 +1,101 @@
+from analytics import prefetch
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+import time
+
+
+class Command(BaseCommand):
+    help = 'Download images from LungMap in the background'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'image_set_ids',
+            nargs='*',
+            type=int,
+            help='Only fetch images in these image sets (default: all)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=getattr(settings, 'IMAGE_FETCH_CONCURRENCY', 4),
+            help='Maximum number of images downloaded at the same time'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=5.0,
+            help='Seconds to wait between checks of an empty queue'
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            default=False,
+            help='Queue images that previously ran out of attempts again'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Exit once no more images are due instead of waiting for new ones'
+        )
+
+    @staticmethod
+    def fetch(image):
+        try:
+            return prefetch.fetch_image(image)
+        finally:
+            # each thread has its own connection, don't leave them open
+            connection.close()
+
+    def handle(self, *args, **options):
+        image_set_ids = options['image_set_ids']
+        concurrency = max(options['concurrency'], 1)
+
+        marked = prefetch.mark_fetched_images()
+
+        if marked:
+            self.stdout.write('Marked %d previously downloaded images as fetched' % marked)
+
+        if options['retry_failed']:
+            self.stdout.write(
+                'Queued %d failed images' % prefetch.retry_failed_images(image_set_ids)
+            )
+
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                free = concurrency - len(running)
+
+                if free > 0:
+                    for image in prefetch.claim_images(free, image_set_ids):
+                        running[executor.submit(self.fetch, image)] = image
+
+                if not running:
+                    if options['once']:
+                        return
+
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                done, _ = wait(
+                    running,
+                    timeout=options['poll_interval'],
+                    return_when=FIRST_COMPLETED
+                )
+
+                for future in done:
+                    image = running.pop(future)
+
+                    try:
+                        fetched = future.result()
+                    except Exception as e:
+                        # e.g. the database went away while recording the outcome
+                        self.stderr.write('Image %s: %s' % (image.id, e))
+                        continue
+
+                    self.stdout.write(
+                        'Image %s %s' % (image.id, 'fetched' if fetched else 'failed')
+                    )
@@ -0,0 +1,18 @@
+from analytics import stats
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized image set sub-region counts from the Subregion table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'image_set_ids',
+            nargs='*',
+            type=int,
+            help='Image sets to rebuild, defaults to all'
+        )
+
+    def handle(self, *args, **options):
+        count = stats.rebuild_image_set_stats(options['image_set_ids'] or None)
+        self.stdout.write('Rebuilt stats for %d image sets' % count)
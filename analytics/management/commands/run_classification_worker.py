@@ -0,0 +1,36 @@
+from analytics import image_classification
+from django.core.management.base import BaseCommand
+import time
+
+
+class Command(BaseCommand):
+    help = 'Process queued whole image classification jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=5.0,
+            help='Seconds to wait between checks of an empty queue'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Exit once the queue is empty instead of waiting for new jobs'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = image_classification.claim_next_job()
+
+            if job is None:
+                if options['once']:
+                    return
+
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write('Classifying image %s (job %s)' % (job.image_id, job.id))
+            image_classification.run_classification_job(job)
+            self.stdout.write('Job %s %s' % (job.id, job.status))
@@ -0,0 +1,61 @@
+from analytics import feature_store, training
+from django.core.management.base import BaseCommand
+import time
+
+# sub-regions whose features are computed between checks of the job queue
+FEATURE_BATCH_SIZE = 50
+
+
+class Command(BaseCommand):
+    help = 'Process queued model training jobs & pre-compute features of new sub-regions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=5.0,
+            help='Seconds to wait between checks of an empty queue'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Exit once the queue is empty instead of waiting for new jobs'
+        )
+
+    def populate_features(self):
+        """
+        Compute the features of a batch of newly saved sub-regions, so the
+        next training of their image sets can read them from the store
+        :return: number of sub-regions whose features were stored
+        """
+        subregion_ids = feature_store.get_missing_feature_ids(
+            FEATURE_BATCH_SIZE,
+            exclude_ids=self.failed_ids
+        )
+        stored_ids = feature_store.populate_features(subregion_ids)
+        # e.g. undecodable images, training reports those properly
+        self.failed_ids.update(set(subregion_ids).difference(stored_ids))
+
+        return len(stored_ids)
+
+    def handle(self, *args, **options):
+        self.failed_ids = set()
+
+        while True:
+            job = training.claim_next_job()
+
+            if job is None:
+                # no training to do, catch up on features instead
+                if self.populate_features() > 0:
+                    continue
+
+                if options['once']:
+                    return
+
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write('Training image set %s (job %s)' % (job.imageset_id, job.id))
+            training.run_training_job(job)
+            self.stdout.write('Job %s %s' % (job.id, job.status))
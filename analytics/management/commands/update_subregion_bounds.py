@@ -0,0 +1,41 @@
+from analytics import models, polygons
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+
+class Command(BaseCommand):
+    help = 'Fill in the bounding boxes of sub-regions saved before they were recorded'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            default=False,
+            help='Recompute every bounding box, not just the missing ones'
+        )
+
+    def handle(self, *args, **options):
+        subregions = models.Subregion.objects.filter(polygon__isnull=False)
+
+        if not options['all']:
+            subregions = subregions.filter(x_min__isnull=True)
+
+        updated = 0
+
+        with transaction.atomic():
+            for subregion_id, packed_polygon in subregions.values_list('id', 'polygon').iterator():
+                polygon = polygons.unpack_polygon(packed_polygon)
+
+                if len(polygon) == 0:
+                    continue
+
+                x_min, y_min, x_max, y_max = polygons.bounding_box(polygon)
+                models.Subregion.objects.filter(id=subregion_id).update(
+                    x_min=x_min,
+                    y_min=y_min,
+                    x_max=x_max,
+                    y_max=y_max
+                )
+                updated += 1
+
+        self.stdout.write('Updated bounding boxes of %d sub-regions' % updated)
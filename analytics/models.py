@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
+from analytics import polygons, storage
 
 
 class Experiment(models.Model):
@@ -79,6 +80,17 @@ class ImageSetProbeMap(models.Model):
 
 
 class Image(models.Model):
+    FETCH_PENDING = 'pending'
+    FETCH_FETCHING = 'fetching'
+    FETCH_FETCHED = 'fetched'
+    FETCH_FAILED = 'failed'
+    FETCH_STATUS_CHOICES = (
+        (FETCH_PENDING, 'Pending'),
+        (FETCH_FETCHING, 'Fetching'),
+        (FETCH_FETCHED, 'Fetched'),
+        (FETCH_FAILED, 'Failed'),
+    )
+
     source_url = models.CharField(
         max_length=400
     )
@@ -97,7 +109,8 @@ class Image(models.Model):
         blank=True
     )
     image_orig = models.FileField(
-        upload_to='images',
+        upload_to=storage.image_orig_upload_to,
+        storage=storage.content_addressed_storage,
         blank=True,
         null=True
     )
@@ -107,10 +120,33 @@ class Image(models.Model):
         null=True
     )
     image_jpeg = models.FileField(
-        upload_to='images_jpeg',
+        upload_to=storage.image_jpeg_upload_to,
+        storage=storage.content_addressed_storage,
+        blank=True,
+        null=True
+    )
+
+    # images are downloaded from LungMap in the background, see analytics.prefetch
+    fetch_status = models.CharField(
+        max_length=10,
+        choices=FETCH_STATUS_CHOICES,
+        default=FETCH_PENDING,
+        db_index=True
+    )
+    fetch_priority = models.IntegerField(default=0)
+    fetch_attempts = models.IntegerField(default=0)
+    fetch_error = models.TextField(
         blank=True,
         null=True
     )
+    fetch_started = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+    fetch_next_attempt = models.DateTimeField(
+        null=True,
+        blank=True
+    )
 
     def __str__(self):
         return '%s, %s' % (self.image_id, self.image_name)
@@ -156,6 +192,22 @@ class Subregion(models.Model):
         null=False,
         blank=False
     )
+    # vertices packed as int32 (x, y) pairs, see analytics.polygons
+    polygon = models.BinaryField(
+        null=True,
+        blank=True
+    )
+    # inclusive bounding box of the polygon, kept current by save() & indexed
+    # per image for spatial queries, see analytics.subregion_index
+    x_min = models.IntegerField(null=True, blank=True)
+    y_min = models.IntegerField(null=True, blank=True)
+    x_max = models.IntegerField(null=True, blank=True)
+    y_max = models.IntegerField(null=True, blank=True)
+
+    BOUNDING_BOX_FIELDS = ('x_min', 'y_min', 'x_max', 'y_max')
+
+    class Meta:
+        index_together = (('image', 'x_min', 'x_max', 'y_min', 'y_max'),)
 
     def __str__(self):
         return '%s, %s' % (
@@ -163,8 +215,40 @@ class Subregion(models.Model):
             self.image.image_name,
         )
 
+    def get_polygon(self):
+        """
+        Returns the sub-region's vertices as a numpy array of shape (N, 2)
+        """
+        return polygons.unpack_polygon(self.polygon)
+
+    def set_polygon(self, polygon):
+        self.polygon = polygons.pack_polygon(polygon)
+
+    def update_bounding_box(self):
+        polygon = self.get_polygon()
+
+        if len(polygon) > 0:
+            self.x_min, self.y_min, self.x_max, self.y_max = polygons.bounding_box(polygon)
+        else:
+            self.x_min = self.y_min = self.x_max = self.y_max = None
+
+    def save(self, *args, **kwargs):
+        self.update_bounding_box()
+
+        update_fields = kwargs.get('update_fields')
+
+        if update_fields is not None and 'polygon' in update_fields:
+            kwargs['update_fields'] = set(update_fields).union(self.BOUNDING_BOX_FIELDS)
+
+        super(Subregion, self).save(*args, **kwargs)
+
 
 class Points(models.Model):
+    """
+    Legacy one-row-per-vertex polygon storage, superseded by Subregion.polygon.
+    Kept so existing data can be migrated with the pack_subregion_polygons
+    management command.
+    """
     subregion = models.ForeignKey(
         Subregion,
         related_name='points',
@@ -178,6 +262,58 @@ class Points(models.Model):
         return '%s %s #%s: [%s, %s]' % (self.id, self.subregion_id, self.order, self.x, self.y)
 
 
+class ImageSetStats(models.Model):
+    """
+    Denormalized sub-region counts for an image set, kept current by the
+    sub-region API views (see analytics.stats)
+    """
+    image_set = models.OneToOneField(
+        ImageSet,
+        related_name='stats',
+        on_delete=models.CASCADE
+    )
+    images_with_subregion_count = models.IntegerField(default=0)
+    subregion_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '%s: %s' % (self.image_set_id, self.subregion_count)
+
+
+class ImageSetAnatomyStats(models.Model):
+    image_set = models.ForeignKey(
+        ImageSet,
+        related_name='anatomy_stats',
+        on_delete=models.CASCADE
+    )
+    anatomy = models.ForeignKey(Anatomy)
+    subregion_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('image_set', 'anatomy'),)
+
+    def __str__(self):
+        return '%s, %s: %s' % (self.image_set_id, self.anatomy_id, self.subregion_count)
+
+
+class SubregionFeatures(models.Model):
+    """
+    Cached output of lung_map_utils.utils.generate_features for a sub-region.
+    Only valid while the polygon, image & feature schema version all match.
+    """
+    subregion = models.OneToOneField(
+        Subregion,
+        related_name='features',
+        on_delete=models.CASCADE
+    )
+    polygon_sha1 = models.CharField(max_length=40)
+    image_sha1 = models.CharField(max_length=40)
+    schema_version = models.IntegerField()
+    features = models.TextField()  # JSON object of feature name -> value
+
+    def __str__(self):
+        return '%s: v%s' % (self.subregion_id, self.schema_version)
+
+
 class TrainedModel(models.Model):
     imageset = models.OneToOneField(ImageSet)
     model_object = models.FileField(
@@ -185,6 +321,189 @@ class TrainedModel(models.Model):
         blank=True,
         null=True
     )
+    model_object_sha1 = models.CharField(
+        max_length=40,
+        blank=True,
+        null=True
+    )
 
     def __str__(self):
         return '<TrainedModel %s: %s' % (self.id, self.imageset_id)
+
+
+class TrainingJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_FAILED, 'Failed'),
+    )
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+    imageset = models.ForeignKey(ImageSet)
+    user = models.ForeignKey(
+        User,
+        null=True,
+        blank=True
+    )
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=STATUS_QUEUED,
+        db_index=True
+    )
+    images_total = models.IntegerField(default=0)
+    images_processed = models.IntegerField(default=0)
+    detail = models.TextField(
+        blank=True,
+        null=True
+    )
+    trained_model = models.ForeignKey(
+        TrainedModel,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+    # updated as the job makes progress, a running job whose heartbeat
+    # stops belongs to a dead worker, see training.fail_stale_jobs
+    heartbeat = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+    finished = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    def __str__(self):
+        return '<TrainingJob %s: %s (%s)>' % (self.id, self.imageset_id, self.status)
+
+
+class ClassificationJob(models.Model):
+    """
+    Automatic classification of a whole image with its image set's trained
+    model, see analytics.image_classification
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_FAILED, 'Failed'),
+    )
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+    image = models.ForeignKey(Image)
+    trained_model = models.ForeignKey(TrainedModel)
+    user = models.ForeignKey(
+        User,
+        null=True,
+        blank=True
+    )
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=STATUS_QUEUED,
+        db_index=True
+    )
+    tiles_total = models.IntegerField(default=0)
+    tiles_processed = models.IntegerField(default=0)
+    regions_found = models.IntegerField(default=0)
+    detail = models.TextField(
+        blank=True,
+        null=True
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+    # updated after each tile, see image_classification.fail_stale_jobs
+    heartbeat = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+    finished = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    def __str__(self):
+        return '<ClassificationJob %s: %s (%s)>' % (self.id, self.image_id, self.status)
+
+
+class ClassifiedRegion(models.Model):
+    """
+    A candidate region found by a ClassificationJob & its predicted anatomy
+    """
+    job = models.ForeignKey(
+        ClassificationJob,
+        related_name='regions',
+        on_delete=models.CASCADE
+    )
+    # packed vertices in full resolution image coordinates, see analytics.polygons
+    polygon = models.BinaryField()
+    anatomy = models.CharField(max_length=150)
+    probability = models.FloatField()
+    probabilities = models.TextField()  # JSON object of class name -> probability
+
+    def get_polygon(self):
+        return polygons.unpack_polygon(self.polygon)
+
+    def __str__(self):
+        return '%s, %s (%.2f)' % (self.job_id, self.anatomy, self.probability)
+
+
+class ClassificationResult(models.Model):
+    """
+    Stored probabilities of a polygon classified with a trained model, so
+    classifying the same polygon again is a lookup, see analytics.result_store
+    """
+    trained_model = models.ForeignKey(
+        TrainedModel,
+        on_delete=models.CASCADE
+    )
+    image = models.ForeignKey(
+        Image,
+        on_delete=models.CASCADE
+    )
+    # SHA1 of the packed vertices, see analytics.polygons.polygon_sha1
+    polygon_sha1 = models.CharField(max_length=40)
+    # the image file classified, results for an earlier download are stale
+    image_sha1 = models.CharField(max_length=40)
+    # features.FEATURE_SCHEMA_VERSION the polygon was classified with
+    schema_version = models.IntegerField()
+    polygon = models.BinaryField()
+    anatomy = models.CharField(
+        max_length=150,
+        db_index=True
+    )
+    probability = models.FloatField(db_index=True)
+    probabilities = models.TextField()  # JSON object of class name -> probability
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('trained_model', 'image', 'polygon_sha1'),)
+
+    def get_polygon(self):
+        return polygons.unpack_polygon(self.polygon)
+
+    def __str__(self):
+        return '%s, %s: %s (%.2f)' % (
+            self.trained_model_id,
+            self.image_id,
+            self.anatomy,
+            self.probability
+        )
@@ -0,0 +1,132 @@
+"""
+Helpers for the compact polygon representation stored on Subregion:
+vertices packed as little-endian int32 (x, y) pairs, in drawing order.
+"""
+import hashlib
+import numpy as np
+# noinspection PyPackageRequirements
+import cv2
+
+POLYGON_DTYPE = np.dtype('<i4')
+
+
+def pack_polygon(polygon):
+    """
+    Pack polygon vertices for storage in Subregion.polygon
+    :param polygon: array-like of shape (N, 2)
+    :return: bytes
+    """
+    return np.asarray(polygon, dtype=POLYGON_DTYPE).reshape(-1, 2).tobytes()
+
+
+def unpack_polygon(blob):
+    """
+    Inverse of pack_polygon
+    :param blob: bytes or memoryview (as returned by some DB drivers)
+    :return: numpy array of shape (N, 2)
+    """
+    if blob is None:
+        return np.empty((0, 2), dtype=POLYGON_DTYPE)
+
+    return np.frombuffer(bytes(blob), dtype=POLYGON_DTYPE).reshape(-1, 2)
+
+
+def point_dicts_to_polygon(points):
+    """
+    Convert points as sent to the API, i.e. [{"x": 1, "y": 2, "order": 0}, ...],
+    to a polygon array. Points are sorted by 'order' when it is given.
+    :param points: list of dicts
+    :return: numpy array of shape (N, 2)
+    """
+    if all('order' in p for p in points):
+        points = sorted(points, key=lambda p: p['order'])
+
+    return np.array(
+        [[p['x'], p['y']] for p in points],
+        dtype=POLYGON_DTYPE
+    ).reshape(-1, 2)
+
+
+def polygon_sha1(polygon):
+    """
+    SHA1 of a polygon's vertices, used to detect when a sub-region's
+    stored features are stale
+    :param polygon: array-like of shape (N, 2)
+    :return: hex digest string
+    """
+    return hashlib.sha1(pack_polygon(polygon)).hexdigest()
+
+
+def bounding_box(polygon):
+    """
+    :param polygon: array-like of shape (N, 2), N > 0
+    :return: tuple of (x_min, y_min, x_max, y_max), inclusive
+    """
+    polygon = np.asarray(polygon).reshape(-1, 2)
+    x_min, y_min = polygon.min(axis=0)
+    x_max, y_max = polygon.max(axis=0)
+
+    return int(x_min), int(y_min), int(x_max), int(y_max)
+
+
+def boxes_intersect(a, b):
+    """
+    Whether two inclusive (x_min, y_min, x_max, y_max) boxes share a pixel
+    """
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _rasterize(polygon, box):
+    # filled mask of the polygon over the given inclusive box, which may
+    # cut the polygon off
+    mask = np.zeros((box[3] - box[1] + 1, box[2] - box[0] + 1), dtype=np.uint8)
+    offset = np.asarray(polygon, dtype=np.int32).reshape(-1, 2) - box[:2]
+
+    # noinspection PyUnresolvedReferences
+    cv2.fillPoly(mask, [offset], 1)
+
+    return mask
+
+
+def polygon_area(polygon):
+    """
+    Number of pixels covered by a polygon, edges included
+    """
+    return int(np.count_nonzero(_rasterize(polygon, bounding_box(polygon))))
+
+
+def intersection_area(a, b):
+    """
+    Number of pixels covered by both polygons. Only the overlap of their
+    bounding boxes is rasterized, so this is cheap for small or distant
+    polygons whatever the size of the image.
+    :param a: array-like of shape (N, 2)
+    :param b: array-like of shape (M, 2)
+    :return: int
+    """
+    box_a = bounding_box(a)
+    box_b = bounding_box(b)
+
+    if not boxes_intersect(box_a, box_b):
+        return 0
+
+    overlap = (
+        max(box_a[0], box_b[0]),
+        max(box_a[1], box_b[1]),
+        min(box_a[2], box_b[2]),
+        min(box_a[3], box_b[3])
+    )
+
+    return int(np.count_nonzero(_rasterize(a, overlap) & _rasterize(b, overlap)))
+
+
+def polygon_iou(a, b):
+    """
+    Intersection over union of two polygons' pixels, 1.0 for identical polygons
+    """
+    intersection = intersection_area(a, b)
+
+    if intersection == 0:
+        return 0.0
+
+    return intersection / float(polygon_area(a) + polygon_area(b) - intersection)
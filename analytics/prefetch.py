@@ -0,0 +1,224 @@
+"""
+Background download of images from LungMap. Images are queued for fetching
+as soon as they are imported & the prefetch_images management command works
+through the queue, so viewers never wait on the mothership.
+"""
+from analytics import models, renditions, tiles
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from lungmap_client import lungmap_utils
+import datetime
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+FETCH_MAX_ATTEMPTS = getattr(settings, 'IMAGE_FETCH_MAX_ATTEMPTS', 5)
+FETCH_BACKOFF_SECONDS = getattr(settings, 'IMAGE_FETCH_BACKOFF_SECONDS', 30)
+FETCH_BACKOFF_MAX_SECONDS = 60 * 60
+
+# a fetch running longer than this is assumed to belong to a dead worker
+FETCH_STALE_SECONDS = 30 * 60
+
+
+def get_backoff(attempts):
+    """
+    Seconds to wait before the next attempt, doubling after each failure
+    :param attempts: number of attempts made so far
+    """
+    return min(FETCH_BACKOFF_SECONDS * 2 ** max(attempts - 1, 0), FETCH_BACKOFF_MAX_SECONDS)
+
+
+def mark_fetched_images():
+    """
+    Images downloaded before fetch tracking existed still show as pending,
+    mark them fetched so they aren't downloaded again
+    :return: number of images updated
+    """
+    return models.Image.objects\
+        .exclude(fetch_status=models.Image.FETCH_FETCHED)\
+        .exclude(image_orig_sha1__isnull=True)\
+        .exclude(image_orig_sha1='')\
+        .update(fetch_status=models.Image.FETCH_FETCHED)
+
+
+def prioritize_image(image):
+    """
+    Move a not yet fetched image to the front of the queue, e.g. because
+    somebody is waiting to view it
+    """
+    models.Image.objects.filter(
+        id=image.id,
+        fetch_status=models.Image.FETCH_PENDING
+    ).update(
+        fetch_priority=1,
+        fetch_next_attempt=None
+    )
+
+
+def retry_failed_images(image_set_ids=None):
+    """
+    Queue images that ran out of attempts to be fetched again
+    :return: number of images queued
+    """
+    failed = models.Image.objects.filter(fetch_status=models.Image.FETCH_FAILED)
+
+    if image_set_ids:
+        failed = failed.filter(image_set_id__in=image_set_ids)
+
+    return failed.update(
+        fetch_status=models.Image.FETCH_PENDING,
+        fetch_attempts=0,
+        fetch_next_attempt=None
+    )
+
+
+def claim_images(limit, image_set_ids=None):
+    """
+    Claim up to ``limit`` images that are due to be fetched, prioritized
+    images first. Each status change is a conditional UPDATE, so when several
+    workers race for the same image only one wins.
+    :param limit: maximum number of images to claim
+    :param image_set_ids: optionally only claim images in these image sets
+    :return: list of claimed analytics.models.Image instances
+    """
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=FETCH_STALE_SECONDS)
+
+    due = models.Image.objects.filter(
+        Q(fetch_status=models.Image.FETCH_PENDING) &
+        (Q(fetch_next_attempt__isnull=True) | Q(fetch_next_attempt__lte=now)) |
+        Q(fetch_status=models.Image.FETCH_FETCHING, fetch_started__lt=stale)
+    )
+
+    if image_set_ids:
+        due = due.filter(image_set_id__in=image_set_ids)
+
+    claimed = []
+
+    for image in due.order_by('-fetch_priority', 'id')[:limit * 2]:
+        if len(claimed) == limit:
+            break
+
+        updated = models.Image.objects.filter(
+            id=image.id,
+            fetch_status=image.fetch_status,
+            fetch_started=image.fetch_started
+        ).update(
+            fetch_status=models.Image.FETCH_FETCHING,
+            fetch_started=now,
+            fetch_attempts=F('fetch_attempts') + 1
+        )
+
+        if updated:
+            image.refresh_from_db()
+            claimed.append(image)
+
+    return claimed
+
+
+def _share_files(image, source):
+    """
+    Point an image at another image's stored files, see analytics.storage
+    """
+    image.image_orig = source.image_orig.name
+    image.image_orig_sha1 = source.image_orig_sha1
+    image.image_jpeg = source.image_jpeg.name
+
+
+def _share_with_duplicates(image):
+    """
+    The same file is often listed under several experiments or image sets,
+    hand the stored files to every other copy still waiting to be fetched
+    :return: number of images updated
+    """
+    return models.Image.objects.filter(
+        source_url=image.source_url,
+        fetch_status__in=(models.Image.FETCH_PENDING, models.Image.FETCH_FAILED)
+    ).exclude(
+        id=image.id
+    ).update(
+        image_orig=image.image_orig.name,
+        image_orig_sha1=image.image_orig_sha1,
+        image_jpeg=image.image_jpeg.name,
+        fetch_status=models.Image.FETCH_FETCHED,
+        fetch_error=None
+    )
+
+
+def fetch_image(image):
+    """
+    Download a claimed image from LungMap & store the TIFF and JPEG. Images
+    with the same source URL that were already fetched are re-used instead
+    of downloading again. Failures are re-queued with exponential backoff
+    until FETCH_MAX_ATTEMPTS is reached.
+    :param image: an analytics.models.Image claimed with claim_images
+    :return: True if the image was fetched
+    """
+    fetched_copy = models.Image.objects.filter(
+        source_url=image.source_url,
+        fetch_status=models.Image.FETCH_FETCHED
+    ).exclude(
+        id=image.id
+    ).exclude(
+        image_orig_sha1__isnull=True
+    ).exclude(
+        image_orig_sha1=''
+    ).first()
+
+    if fetched_copy is not None:
+        _share_files(image, fetched_copy)
+    else:
+        decoded = []
+
+        try:
+            suf, sha1, suf_jpeg = lungmap_utils.get_image_from_lungmap(
+                image.source_url,
+                on_decoded=decoded.append
+            )
+        except Exception as e:
+            if image.fetch_attempts >= FETCH_MAX_ATTEMPTS:
+                image.fetch_status = models.Image.FETCH_FAILED
+                image.fetch_next_attempt = None
+            else:
+                image.fetch_status = models.Image.FETCH_PENDING
+                image.fetch_next_attempt = timezone.now() + datetime.timedelta(
+                    seconds=get_backoff(image.fetch_attempts)
+                )
+
+            image.fetch_error = str(e).strip() or traceback.format_exc()
+            image.save(update_fields=['fetch_status', 'fetch_next_attempt', 'fetch_error'])
+
+            return False
+
+        # set before assigning the files, their storage names derive from it
+        image.image_orig_sha1 = sha1
+        image.image_orig = suf
+        image.image_jpeg = suf_jpeg
+
+        try:
+            tiles.generate_tiles(sha1, decoded[0])
+        except Exception:
+            # the viewer falls back to the full JPEG, see generate_image_tiles
+            logger.exception('Failed to generate tiles for image %s', image.id)
+
+        try:
+            renditions.generate_renditions(sha1, decoded[0])
+        except Exception:
+            # the rendition endpoint falls back to the full JPEG, see
+            # generate_image_renditions
+            logger.exception('Failed to generate renditions for image %s', image.id)
+
+        del decoded[:]
+
+    image.fetch_status = models.Image.FETCH_FETCHED
+    image.fetch_error = None
+    image.save(
+        update_fields=[
+            'image_orig', 'image_orig_sha1', 'image_jpeg', 'fetch_status', 'fetch_error'
+        ]
+    )
+    _share_with_duplicates(image)
+
+    return True
@@ -0,0 +1,119 @@
+"""
+Downscaled renditions of each image for previews, generated when the image
+is ingested. Like the tile pyramids they are keyed by the SHA1 of the
+original image under IMAGE_RENDITION_ROOT, e.g. ab/<sha1>_thumbnail.webp.
+
+The full size JPEG is the Image.image_jpeg file itself, every other size &
+format combination is a rendition.
+"""
+from collections import OrderedDict
+from django.conf import settings
+import os
+import tempfile
+# noinspection PyPackageRequirements
+import cv2
+
+# longest side in pixels, None keeps the original size
+SIZES = OrderedDict(
+    [
+        ('thumbnail', 256),
+        ('medium', 1024),
+        ('full', None)
+    ]
+)
+FORMATS = OrderedDict(
+    [
+        ('jpg', ('image/jpeg', cv2.IMWRITE_JPEG_QUALITY, 75)),
+        ('webp', ('image/webp', cv2.IMWRITE_WEBP_QUALITY, 80))
+    ]
+)
+
+
+def _rendition_root():
+    return getattr(
+        settings,
+        'IMAGE_RENDITION_ROOT',
+        os.path.join(settings.MEDIA_ROOT, 'renditions')
+    )
+
+
+def is_rendition(size, image_format):
+    return size in SIZES and image_format in FORMATS and (size, image_format) != ('full', 'jpg')
+
+
+def rendition_path(sha1, size, image_format):
+    return os.path.join(
+        _rendition_root(),
+        sha1[:2],
+        '%s_%s.%s' % (sha1, size, image_format)
+    )
+
+
+def has_renditions(sha1):
+    return all(
+        os.path.exists(rendition_path(sha1, size, image_format))
+        for size in SIZES
+        for image_format in FORMATS
+        if is_rendition(size, image_format)
+    )
+
+
+def get_content_type(image_format):
+    return FORMATS[image_format][0]
+
+
+def _resize(bgr_image, max_size):
+    height, width = bgr_image.shape[:2]
+
+    if max_size is None or max(height, width) <= max_size:
+        return bgr_image
+
+    scale = max_size / max(height, width)
+
+    # noinspection PyUnresolvedReferences
+    return cv2.resize(
+        bgr_image,
+        (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)),
+        interpolation=cv2.INTER_AREA
+    )
+
+
+def generate_renditions(sha1, bgr_image):
+    """
+    Write any missing renditions of an image. Smaller sizes are downscaled
+    from the next larger one rather than from the original.
+    :param sha1: SHA1 of the original image
+    :param bgr_image: decoded image as returned by cv2.imdecode
+    :return: number of renditions written
+    """
+    written = 0
+    resized = bgr_image
+
+    for size, max_size in reversed(SIZES.items()):
+        resized = _resize(resized, max_size)
+
+        for image_format, (content_type, quality_flag, quality) in FORMATS.items():
+            if not is_rendition(size, image_format):
+                continue
+
+            path = rendition_path(sha1, size, image_format)
+
+            if os.path.exists(path):
+                continue
+
+            # noinspection PyUnresolvedReferences
+            encoded, data = cv2.imencode('.' + image_format, resized, [quality_flag, quality])
+
+            if not encoded:
+                raise ValueError("Could not encode %s rendition as %s" % (size, image_format))
+
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+
+            with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+                f.write(data.tobytes())
+
+            os.replace(f.name, path)
+            written += 1
+
+    return written
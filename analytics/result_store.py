@@ -0,0 +1,160 @@
+"""
+Persistent store of classification results, keyed by trained model, image
+& polygon, so classifying a polygon again is a lookup rather than feature
+extraction & scoring.
+"""
+from analytics import models, classification, features, polygons
+from collections import OrderedDict
+from django.db import IntegrityError, transaction
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# rows per INSERT & polygon hashes per lookup query, well below SQLite's
+# limit on query parameters
+BATCH_SIZE = 500
+
+
+def _to_json(model_classes, probabilities):
+    return json.dumps(
+        OrderedDict((c, float(p)) for c, p in zip(model_classes, probabilities))
+    )
+
+
+def load_probabilities(result):
+    """
+    :param result: analytics.models.ClassificationResult instance
+    :return: OrderedDict of class name -> probability, in model class order
+    """
+    return json.loads(result.probabilities, object_pairs_hook=OrderedDict)
+
+
+def get_stored_results(trained_model, image, polygon_sha1s):
+    """
+    Look up stored results for polygons on an image
+    :param trained_model: analytics.models.TrainedModel instance
+    :param image: analytics.models.Image instance
+    :param polygon_sha1s: iterable of polygon hashes, see polygons.polygon_sha1
+    :return: dict of polygon hash -> ClassificationResult
+    """
+    polygon_sha1s = sorted(set(polygon_sha1s))
+    results = {}
+
+    for start in range(0, len(polygon_sha1s), BATCH_SIZE):
+        stored = models.ClassificationResult.objects.filter(
+            trained_model=trained_model,
+            image=image,
+            image_sha1=image.image_orig_sha1,
+            schema_version=features.FEATURE_SCHEMA_VERSION,
+            polygon_sha1__in=polygon_sha1s[start:start + BATCH_SIZE]
+        )
+        results.update((r.polygon_sha1, r) for r in stored)
+
+    return results
+
+
+def save_results(trained_model, image, entries):
+    """
+    Store (or replace) the results of classifying polygons on an image, with
+    one INSERT per BATCH_SIZE results. This is a best effort: if a concurrent
+    request stores the same polygons first, its results are kept.
+    :param trained_model: analytics.models.TrainedModel instance
+    :param image: analytics.models.Image instance, must be downloaded
+    :param entries: list of (polygon, model classes, probabilities)
+    """
+    results = OrderedDict()
+
+    for polygon, model_classes, probabilities in entries:
+        best = int(np.argmax(probabilities))
+        polygon_sha1 = polygons.polygon_sha1(polygon)
+        results[polygon_sha1] = models.ClassificationResult(
+            trained_model=trained_model,
+            image=image,
+            polygon_sha1=polygon_sha1,
+            image_sha1=image.image_orig_sha1,
+            schema_version=features.FEATURE_SCHEMA_VERSION,
+            polygon=polygons.pack_polygon(polygon),
+            anatomy=model_classes[best],
+            probability=float(probabilities[best]),
+            probabilities=_to_json(model_classes, probabilities)
+        )
+
+    if len(results) == 0:
+        return
+
+    polygon_sha1s = list(results)
+
+    try:
+        with transaction.atomic():
+            for start in range(0, len(polygon_sha1s), BATCH_SIZE):
+                models.ClassificationResult.objects.filter(
+                    trained_model=trained_model,
+                    image=image,
+                    polygon_sha1__in=polygon_sha1s[start:start + BATCH_SIZE]
+                ).delete()
+
+            models.ClassificationResult.objects.bulk_create(
+                results.values(),
+                batch_size=BATCH_SIZE
+            )
+    except IntegrityError:
+        logger.warning(
+            'Classification results for image %s were stored concurrently', image.id
+        )
+
+
+def classify_polygons(image, regions):
+    """
+    Same as classification.classify_polygons, but polygons classified before
+    with the image set's trained model are read from the store & only the
+    rest are classified (& then stored)
+    :param image: analytics.models.Image instance, its image set must be trained
+    :param regions: list of numpy arrays of shape (N, 2)
+    :return: tuple of (model classes, probabilities) where probabilities is a
+        numpy array of shape (len(regions), len(model classes))
+    """
+    if not image.image_orig_sha1:
+        # nothing to key the results on until the image is downloaded
+        return classification.classify_polygons(image, regions)
+
+    trained_model = image.image_set.trainedmodel
+    polygon_sha1s = [polygons.polygon_sha1(r) for r in regions]
+    stored = get_stored_results(trained_model, image, polygon_sha1s)
+
+    missing = OrderedDict()
+
+    for polygon_sha1, region in zip(polygon_sha1s, regions):
+        if polygon_sha1 not in stored:
+            missing[polygon_sha1] = region
+
+    model_classes = None
+    probabilities_by_sha1 = {}
+
+    if len(missing) > 0:
+        model_classes, probabilities = classification.classify_polygons(
+            image,
+            list(missing.values())
+        )
+        probabilities_by_sha1.update(zip(missing, probabilities))
+        save_results(
+            trained_model,
+            image,
+            [(r, model_classes, p) for r, p in zip(missing.values(), probabilities)]
+        )
+
+    for polygon_sha1, result in stored.items():
+        stored_probabilities = load_probabilities(result)
+
+        if model_classes is None:
+            model_classes = list(stored_probabilities)
+
+        probabilities_by_sha1[polygon_sha1] = [
+            stored_probabilities.get(c, 0.0) for c in model_classes
+        ]
+
+    return model_classes, np.array(
+        [probabilities_by_sha1[s] for s in polygon_sha1s],
+        dtype=np.float64
+    )
@@ -0,0 +1,81 @@
+"""
+Responses for files under MEDIA_ROOT. With IMAGE_SENDFILE_MODE = 'x-accel'
+the response only names the file in an X-Accel-Redirect header & nginx sends
+the bytes itself (see the internal location in nginx_conf/nginx.conf), so
+serving images doesn't tie up a gunicorn worker. Otherwise the file is
+streamed by Django.
+"""
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils.http import urlquote
+import os
+
+SENDFILE_MODE = getattr(settings, 'IMAGE_SENDFILE_MODE', None)
+X_ACCEL_PREFIX = getattr(settings, 'IMAGE_X_ACCEL_PREFIX', '/protected-media/')
+
+
+def quote_etag(etag):
+    return '"%s"' % etag
+
+
+def etag_matches(request, etag):
+    """
+    Check whether the request's If-None-Match header matches the given ETag
+    :param request: Django HttpRequest
+    :param etag: unquoted ETag value
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+
+    if not if_none_match:
+        return False
+
+    # weak comparison, as is appropriate for If-None-Match
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    candidates = [c[2:] if c.startswith('W/') else c for c in candidates]
+
+    return '*' in candidates or quote_etag(etag) in candidates
+
+
+def _x_accel_location(path):
+    relative_path = os.path.relpath(path, settings.MEDIA_ROOT)
+
+    if relative_path.startswith(os.pardir):
+        # outside MEDIA_ROOT, nginx doesn't know about it
+        return None
+
+    return X_ACCEL_PREFIX + urlquote(relative_path.replace(os.sep, '/'))
+
+
+def file_response(request, path, content_type, etag=None, cache_control=None):
+    """
+    Serve a file, answering conditional requests with 304 Not Modified
+    :param request: Django HttpRequest
+    :param path: absolute path of the file
+    :param content_type: MIME type of the file
+    :param etag: optional unquoted ETag identifying the file's content
+    :param cache_control: optional Cache-Control header value
+    :return: HttpResponse
+    :raises Http404: if the file doesn't exist
+    """
+    # a deleted file is gone, whatever ETag the client holds for it
+    if not os.path.isfile(path):
+        raise Http404
+
+    if etag is not None and etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        location = _x_accel_location(path) if SENDFILE_MODE == 'x-accel' else None
+
+        if location is not None:
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = location
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+
+    if cache_control is not None:
+        response['Cache-Control'] = cache_control
+
+    return response
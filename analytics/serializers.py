@@ -1,14 +1,38 @@
 from rest_framework import serializers
-from analytics import models
+from rest_framework.reverse import reverse
+from analytics import models, polygons, renditions
+import json
 
 
 class ImageSerializer(serializers.ModelSerializer):
     image_jpeg = serializers.HyperlinkedIdentityField('images-jpeg', read_only=True)
+    renditions = serializers.SerializerMethodField()
 
     class Meta:
         model = models.Image
         fields = "__all__"
 
+    def get_renditions(self, obj):
+        """
+        URLs of the image in each size & format, e.g.
+        {'thumbnail': {'jpg': ..., 'webp': ...}, ...}, or None until the
+        image has been downloaded
+        """
+        if not obj.image_orig_sha1:
+            return None
+
+        request = self.context.get('request')
+
+        return {
+            size: {
+                image_format: reverse(
+                    'images-rendition',
+                    kwargs={'pk': obj.pk, 'size': size, 'image_format': image_format},
+                    request=request
+                ) for image_format in renditions.FORMATS
+            } for size in renditions.SIZES
+        }
+
 
 class TrainedModelSerializer(serializers.ModelSerializer):
     trained_model_id = serializers.CharField(source='id')
@@ -25,6 +49,49 @@ class TrainedModelCreateSerializer(serializers.ModelSerializer):
         fields = ['imageset']
 
 
+class TrainingJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.IntegerField(source='id', read_only=True)
+
+    class Meta:
+        model = models.TrainingJob
+        fields = [
+            'job_id',
+            'imageset',
+            'status',
+            'images_total',
+            'images_processed',
+            'detail',
+            'trained_model',
+            'created',
+            'started',
+            'finished'
+        ]
+
+
+class ClassificationJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.IntegerField(source='id', read_only=True)
+
+    class Meta:
+        model = models.ClassificationJob
+        fields = [
+            'job_id',
+            'image',
+            'trained_model',
+            'status',
+            'tiles_total',
+            'tiles_processed',
+            'regions_found',
+            'detail',
+            'created',
+            'started',
+            'finished'
+        ]
+
+
+class ClassificationJobCreateSerializer(serializers.Serializer):
+    image_id = serializers.IntegerField()
+
+
 class ImageSetProbeMapSerializer(serializers.ModelSerializer):
     probe_label = serializers.CharField(source='probe.label')
 
@@ -35,23 +102,12 @@ class ImageSetProbeMapSerializer(serializers.ModelSerializer):
 
 class ImageSetSerializer(serializers.ModelSerializer):
     probes = ImageSetProbeMapSerializer(source='imagesetprobemap_set', many=True)
-    image_count = serializers.IntegerField(
-        source='image_set.count',
-        read_only=True
-    )
-    images_with_subregion_count = serializers.IntegerField(
-        source='get_images_with_subregion_count',
-        read_only=True
-    )
-    subregion_count = serializers.IntegerField(
-        source='get_subregion_count',
-        read_only=True
-    )
+    # the counts are annotations, see api_views.get_image_set_queryset
+    image_count = serializers.IntegerField(read_only=True)
+    images_with_subregion_count = serializers.IntegerField(read_only=True)
+    subregion_count = serializers.IntegerField(read_only=True)
 
-    subregion_count_by_anatomy_name = serializers.ListField(
-        source='get_images_with_subregion_count_by_anatomy_name',
-        read_only=True
-    )
+    subregion_count_by_anatomy_name = serializers.SerializerMethodField()
 
     class Meta:
         model = models.ImageSet
@@ -69,6 +125,13 @@ class ImageSetSerializer(serializers.ModelSerializer):
             'trainedmodel'
         )
 
+    # noinspection PyMethodMayBeStatic
+    def get_subregion_count_by_anatomy_name(self, obj):
+        return [
+            {'anatomy__name': a.anatomy.name, 'total': a.subregion_count}
+            for a in obj.anatomy_stats.all()
+        ]
+
 
 class ProbeSerializer(serializers.ModelSerializer):
 
@@ -84,8 +147,27 @@ class PointsSerializer(serializers.ModelSerializer):
         fields = ('x', 'y', 'order')
 
 
+class PolygonField(serializers.Field):
+    """
+    Exposes the packed Subregion.polygon as the list of ordered points
+    the API has always used, i.e. [{"x": 1, "y": 2, "order": 0}, ...]
+    """
+
+    def to_representation(self, value):
+        return [
+            {'x': int(x), 'y': int(y), 'order': i}
+            for i, (x, y) in enumerate(polygons.unpack_polygon(value))
+        ]
+
+    def to_internal_value(self, data):
+        points = PointsSerializer(data=data, many=True)
+        points.is_valid(raise_exception=True)
+
+        return polygons.pack_polygon(polygons.point_dicts_to_polygon(points.validated_data))
+
+
 class SubregionSerializer(serializers.ModelSerializer):
-    points = PointsSerializer(many=True)
+    points = PolygonField(source='polygon')
 
     class Meta:
         model = models.Subregion
@@ -96,6 +178,54 @@ class SubregionSerializer(serializers.ModelSerializer):
         return subregion
 
 
+class SubregionIntersectingSerializer(serializers.Serializer):
+    image = serializers.IntegerField()
+    anatomy = serializers.IntegerField(required=False, allow_null=True)
+    points = PointsSerializer(many=True)
+
+
+class ClassifiedRegionSerializer(serializers.ModelSerializer):
+    points = PolygonField(source='polygon', read_only=True)
+    probabilities = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.ClassifiedRegion
+        fields = ['id', 'anatomy', 'probability', 'probabilities', 'points']
+
+    # noinspection PyMethodMayBeStatic
+    def get_probabilities(self, obj):
+        return json.loads(obj.probabilities)
+
+
+class ClassificationResultSerializer(serializers.ModelSerializer):
+    points = PolygonField(source='polygon', read_only=True)
+    probabilities = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.ClassificationResult
+        fields = [
+            'id',
+            'trained_model',
+            'image',
+            'anatomy',
+            'probability',
+            'probabilities',
+            'points',
+            'created'
+        ]
+
+    # noinspection PyMethodMayBeStatic
+    def get_probabilities(self, obj):
+        return json.loads(obj.probabilities)
+
+
+class ClassificationJobDetailSerializer(ClassificationJobSerializer):
+    regions = ClassifiedRegionSerializer(many=True, read_only=True)
+
+    class Meta(ClassificationJobSerializer.Meta):
+        fields = ClassificationJobSerializer.Meta.fields + ['regions']
+
+
 class ClassifyPointsSerializer(serializers.ModelSerializer):
     points = PointsSerializer(source='subregion_set__points_set', many=True)
     image_id = serializers.CharField(source='id')
@@ -105,6 +235,23 @@ class ClassifyPointsSerializer(serializers.ModelSerializer):
         fields = ['points', 'image_id']
 
 
+class ClassifyPolygonsSerializer(serializers.Serializer):
+    image_id = serializers.IntegerField()
+    polygons = serializers.ListField(
+        child=PointsSerializer(many=True)
+    )
+
+    # noinspection PyMethodMayBeStatic
+    def validate_polygons(self, value):
+        for i, points in enumerate(value):
+            if len(points) < 3:
+                raise serializers.ValidationError(
+                    "Polygon %d has %d points, at least 3 are needed" % (i + 1, len(points))
+                )
+
+        return value
+
+
 class AnatomyProbeMapSerializer(serializers.ModelSerializer):
     anatomy_name = serializers.CharField(source='anatomy.name')
     probe_name = serializers.CharField(source='probe.label')
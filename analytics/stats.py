@@ -0,0 +1,123 @@
+"""
+Maintenance of the denormalized ImageSetStats & ImageSetAnatomyStats tables.
+Views that write sub-regions call these within their transaction, so reading
+the counts never requires aggregating the Subregion table.
+"""
+from analytics import models
+from django.db import transaction
+from django.db.models import Count, F
+
+
+def _adjust(image, anatomy_id, subregion_delta, image_delta):
+    image_set_id = image.image_set_id
+
+    models.ImageSetStats.objects.get_or_create(image_set_id=image_set_id)
+    models.ImageSetStats.objects.filter(image_set_id=image_set_id).update(
+        subregion_count=F('subregion_count') + subregion_delta,
+        images_with_subregion_count=F('images_with_subregion_count') + image_delta
+    )
+
+    models.ImageSetAnatomyStats.objects.get_or_create(
+        image_set_id=image_set_id,
+        anatomy_id=anatomy_id
+    )
+    anatomy_stats = models.ImageSetAnatomyStats.objects.filter(
+        image_set_id=image_set_id,
+        anatomy_id=anatomy_id
+    )
+    anatomy_stats.update(subregion_count=F('subregion_count') + subregion_delta)
+
+    if subregion_delta < 0:
+        # anatomies without sub-regions aren't listed, same as the aggregate query
+        anatomy_stats.filter(subregion_count__lte=0).delete()
+
+
+def subregions_added(image, anatomy_id, count):
+    """
+    Record that sub-regions were created. Call after the sub-regions are saved.
+    :param image: analytics.models.Image the sub-regions belong to
+    :param anatomy_id: the sub-regions' Anatomy id
+    :param count: number of sub-regions created
+    """
+    if count == 0:
+        return
+
+    image_total = models.Subregion.objects.filter(image_id=image.id).count()
+
+    # if all the image's sub-regions are new, the image wasn't counted before
+    _adjust(image, anatomy_id, count, 1 if image_total == count else 0)
+
+
+def subregions_removed(image, anatomy_id, count):
+    """
+    Record that sub-regions were deleted. Call after the sub-regions are deleted.
+    :param image: analytics.models.Image the sub-regions belonged to
+    :param anatomy_id: the sub-regions' Anatomy id
+    :param count: number of sub-regions deleted
+    """
+    if count == 0:
+        return
+
+    image_has_subregions = models.Subregion.objects.filter(image_id=image.id).exists()
+
+    _adjust(image, anatomy_id, -count, 0 if image_has_subregions else -1)
+
+
+def subregion_moved(old_image, old_anatomy_id, image, anatomy_id):
+    """
+    Record that a sub-region's image or anatomy changed. Call after it is saved.
+    :param old_image: analytics.models.Image the sub-region belonged to
+    :param old_anatomy_id: the sub-region's previous Anatomy id
+    :param image: analytics.models.Image the sub-region now belongs to
+    :param anatomy_id: the sub-region's current Anatomy id
+    """
+    if image.id != old_image.id:
+        subregions_removed(old_image, old_anatomy_id, 1)
+        subregions_added(image, anatomy_id, 1)
+    elif anatomy_id != old_anatomy_id:
+        # same image, so its sub-region & image counts don't change
+        _adjust(image, old_anatomy_id, -1, 0)
+        _adjust(image, anatomy_id, 1, 0)
+
+
+def rebuild_image_set_stats(image_set_ids=None):
+    """
+    Recompute the stats tables from the Subregion table
+    :param image_set_ids: optional list of image set ids, defaults to all
+    """
+    image_sets = models.ImageSet.objects.all()
+
+    if image_set_ids is not None:
+        image_sets = image_sets.filter(id__in=image_set_ids)
+
+    image_set_ids = list(image_sets.values_list('id', flat=True))
+    subregions = models.Subregion.objects.filter(image__image_set__in=image_set_ids)
+
+    totals = subregions.values('image__image_set').annotate(
+        subregion_count=Count('id'),
+        images_with_subregion_count=Count('image', distinct=True)
+    ).order_by()
+    anatomy_totals = subregions.values('image__image_set', 'anatomy').annotate(
+        subregion_count=Count('id')
+    ).order_by()
+
+    with transaction.atomic():
+        models.ImageSetStats.objects.filter(image_set__in=image_set_ids).delete()
+        models.ImageSetAnatomyStats.objects.filter(image_set__in=image_set_ids).delete()
+
+        models.ImageSetStats.objects.bulk_create(
+            models.ImageSetStats(
+                image_set_id=t['image__image_set'],
+                subregion_count=t['subregion_count'],
+                images_with_subregion_count=t['images_with_subregion_count']
+            ) for t in totals
+        )
+        models.ImageSetAnatomyStats.objects.bulk_create(
+            models.ImageSetAnatomyStats(
+                image_set_id=t['image__image_set'],
+                anatomy_id=t['anatomy'],
+                subregion_count=t['subregion_count']
+            ) for t in anatomy_totals
+        )
+
+    return len(image_set_ids)
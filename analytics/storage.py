@@ -0,0 +1,70 @@
+"""
+Content-addressed storage for image files. Files are named after the SHA1
+of the original image & sharded into sub-directories by its first two
+characters, e.g. images/ab/ab12...ef.tif, so identical images share a
+single copy on disk no matter how many Image rows refer to them.
+"""
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+import os
+import tempfile
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage that never renames: a name identifies its content, so
+    saving a name that already exists is a no-op. Since files are never
+    deleted through the ORM, a stored file may be shared by many rows.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        if self.exists(name):
+            return name
+
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+
+        # write to a temp file & rename, concurrent writers of the same
+        # name are writing the same bytes, so whichever rename wins is fine
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            if hasattr(content, 'seek'):
+                content.seek(0)
+
+            for chunk in content.chunks():
+                f.write(chunk)
+
+        if self.file_permissions_mode is not None:
+            os.chmod(f.name, self.file_permissions_mode)
+
+        os.replace(f.name, full_path)
+
+        return name
+
+
+content_addressed_storage = ContentAddressedStorage()
+
+
+def content_addressed_path(directory, sha1, filename):
+    """
+    Storage name for a file, keeping the extension of the given filename
+    """
+    if not sha1:
+        # nothing to address by, keep the original name
+        return os.path.join(directory, filename)
+
+    ext = os.path.splitext(filename)[1].lower()
+
+    return os.path.join(directory, sha1[:2], sha1 + ext)
+
+
+def image_orig_upload_to(instance, filename):
+    return content_addressed_path('images', instance.image_orig_sha1, filename)
+
+
+def image_jpeg_upload_to(instance, filename):
+    return content_addressed_path('images_jpeg', instance.image_orig_sha1, filename)
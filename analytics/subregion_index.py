@@ -0,0 +1,157 @@
+"""
+Spatial queries on sub-regions. Each Subregion stores the bounding box of its
+polygon, indexed together with its image, so finding the sub-regions near a
+polygon or within a viewport is an index range scan. Only the few sub-regions
+whose boxes intersect are then compared pixel by pixel.
+"""
+from analytics import models, polygons
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import Q
+import functools
+import operator
+
+# a new sub-region overlapping an existing one by more than this (as
+# intersection over union) is a duplicate of it & isn't saved
+SUBREGION_DUPLICATE_IOU = getattr(settings, 'SUBREGION_DUPLICATE_IOU', 0.9)
+
+# boxes per query, each takes 4 parameters & SQLite allows 999
+BOX_QUERY_SIZE = 200
+
+
+def box_q(box):
+    """
+    Q object matching the Subregions whose bounding boxes intersect a box
+    :param box: inclusive (x_min, y_min, x_max, y_max)
+    """
+    x_min, y_min, x_max, y_max = box
+
+    return Q(
+        x_min__lte=x_max,
+        x_max__gte=x_min,
+        y_min__lte=y_max,
+        y_max__gte=y_min
+    )
+
+
+def intersecting_box(queryset, box):
+    """
+    Restrict a Subregion queryset to those whose bounding boxes intersect
+    the given box, e.g. a viewport
+    :param queryset: Subregion queryset, filtered to one image for the index
+        to be of use
+    :param box: inclusive (x_min, y_min, x_max, y_max)
+    :return: Subregion queryset
+    """
+    return queryset.filter(box_q(box))
+
+
+def intersecting_boxes(queryset, boxes):
+    """
+    The Subregions of a queryset whose bounding boxes intersect any of the
+    given boxes. The boxes are OR'ed into one query (per BOX_QUERY_SIZE
+    boxes) rather than merged into one big box, so boxes far apart don't
+    fetch everything in between.
+    :param queryset: Subregion queryset, see intersecting_box
+    :param boxes: list of inclusive (x_min, y_min, x_max, y_max)
+    :return: list of Subregions, each at most once
+    """
+    found = OrderedDict()
+
+    for start in range(0, len(boxes), BOX_QUERY_SIZE):
+        condition = functools.reduce(
+            operator.or_,
+            (box_q(b) for b in boxes[start:start + BOX_QUERY_SIZE])
+        )
+        found.update((s.id, s) for s in queryset.filter(condition))
+
+    return list(found.values())
+
+
+def intersecting_polygon(queryset, polygon):
+    """
+    Sub-regions of a queryset whose polygons share at least one pixel with
+    the given polygon
+    :param queryset: Subregion queryset, see intersecting_box
+    :param polygon: numpy array of shape (N, 2)
+    :return: list of (Subregion, intersection over union) tuples
+    """
+    found = []
+
+    for subregion in intersecting_box(queryset, polygons.bounding_box(polygon)):
+        iou = polygons.polygon_iou(polygon, subregion.get_polygon())
+
+        if iou > 0:
+            found.append((subregion, iou))
+
+    return found
+
+
+def find_duplicates(image_id, new_polygons, exclude_ids=(), threshold=None):
+    """
+    Check polygons about to be saved on an image against the image's existing
+    sub-regions & each other
+    :param image_id: analytics.models.Image id
+    :param new_polygons: list of numpy arrays of shape (N, 2)
+    :param exclude_ids: ids of sub-regions not to compare with, e.g. the one
+        being updated
+    :param threshold: intersection over union above which polygons are
+        duplicates, defaults to SUBREGION_DUPLICATE_IOU
+    :return: list of (index into new_polygons, duplicated Subregion or index
+        into new_polygons) tuples
+    """
+    if threshold is None:
+        threshold = SUBREGION_DUPLICATE_IOU
+
+    existing = models.Subregion.objects.filter(image_id=image_id)\
+        .exclude(id__in=exclude_ids)\
+        .select_related('anatomy')
+    # polygons without vertices can't duplicate anything
+    boxes = [polygons.bounding_box(p) if len(p) > 0 else None for p in new_polygons]
+    present = [b for b in boxes if b is not None]
+    duplicates = []
+
+    candidates = intersecting_boxes(existing, present)
+
+    for i, (polygon, box) in enumerate(zip(new_polygons, boxes)):
+        if box is None:
+            continue
+
+        for subregion in candidates:
+            subregion_box = (subregion.x_min, subregion.y_min, subregion.x_max, subregion.y_max)
+
+            if not polygons.boxes_intersect(box, subregion_box):
+                continue
+
+            if polygons.polygon_iou(polygon, subregion.get_polygon()) > threshold:
+                duplicates.append((i, subregion))
+
+        for j in range(i):
+            if boxes[j] is None or not polygons.boxes_intersect(box, boxes[j]):
+                continue
+
+            if polygons.polygon_iou(polygon, new_polygons[j]) > threshold:
+                duplicates.append((i, j))
+
+    return duplicates
+
+
+def describe_duplicates(duplicates):
+    """
+    Human readable messages for the output of find_duplicates
+    """
+    messages = []
+
+    for i, duplicate in duplicates:
+        if isinstance(duplicate, models.Subregion):
+            messages.append(
+                "Sub-region %d duplicates existing sub-region %d (%s)" % (
+                    i + 1,
+                    duplicate.id,
+                    duplicate.anatomy.name
+                )
+            )
+        else:
+            messages.append("Sub-region %d duplicates sub-region %d" % (i + 1, duplicate + 1))
+
+    return messages
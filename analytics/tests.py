@@ -1,3 +1,1545 @@
-from django.test import TestCase
+from analytics import caches, candidates, feature_store, features, image_classification, \
+    lungmap_import, models, polygons, prefetch, renditions, result_store, sendfile, stats, \
+    storage, subregion_index, tiles, training
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from unittest import mock
+import datetime
+import hashlib
+import numpy as np
+import os
+import tempfile
+import time
+# noinspection PyPackageRequirements
+import cv2
+# noinspection PyPackageRequirements
+import PIL.Image
 
-# Create your tests here.
+
+def create_experiment():
+    return models.Experiment.objects.get_or_create(
+        experiment_id='LMEX0000000001',
+        defaults={'experiment_type_id': 'LMXT0000000003'}
+    )[0]
+
+
+def create_image(image_set, image_id='LMIM0000000001', **kwargs):
+    """
+    Create an Image of the test experiment, fields not given are derived
+    from image_id
+    """
+    fields = {
+        'source_url': 'http://example.com/%s.tif.gz' % image_id,
+        'image_name': '%s.tif' % image_id,
+        'experiment': create_experiment()
+    }
+    fields.update(kwargs)
+
+    return models.Image.objects.create(image_set=image_set, image_id=image_id, **fields)
+
+
+class SubregionListCreateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='tester', password='tester')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.image = create_image(models.ImageSet.objects.create(image_set_name='image set'))
+        self.anatomy = models.Anatomy.objects.create(name='bronchiole')
+
+    def _payload(self, region_count, points_per_region):
+        return [
+            {
+                'image': self.image.id,
+                'anatomy': self.anatomy.id,
+                'points': [
+                    {'x': r * 10 + i, 'y': i, 'order': i} for i in range(points_per_region)
+                ]
+            } for r in range(region_count)
+        ]
+
+    def test_bulk_create_query_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/api/subregions/',
+                self._payload(region_count=10, points_per_region=100),
+                format='json'
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            sum(len(s.get_polygon()) for s in models.Subregion.objects.all()),
+            1000
+        )
+        # one INSERT per vertex would be well over 1000 queries, this leaves
+        # room for the per-sub-region INSERTs & the image set stats upkeep
+        self.assertLessEqual(len(queries), 40)
+
+    def test_create_and_delete_maintain_stats(self):
+        self.client.post('/api/subregions/', self._payload(3, 4), format='json')
+        image_set_stats = models.ImageSetStats.objects.get(image_set=self.image.image_set)
+
+        self.assertEqual(image_set_stats.subregion_count, 3)
+        self.assertEqual(image_set_stats.images_with_subregion_count, 1)
+        self.assertEqual(
+            models.ImageSetAnatomyStats.objects.get(anatomy=self.anatomy).subregion_count,
+            3
+        )
+
+        self.client.delete(
+            '/api/subregions/?image=%d&anatomy=%d' % (self.image.id, self.anatomy.id)
+        )
+        image_set_stats.refresh_from_db()
+
+        self.assertEqual(image_set_stats.subregion_count, 0)
+        self.assertEqual(image_set_stats.images_with_subregion_count, 0)
+        self.assertFalse(models.ImageSetAnatomyStats.objects.exists())
+
+    def test_update_maintains_stats(self):
+        other_anatomy = models.Anatomy.objects.create(name='artery')
+        other_image = create_image(self.image.image_set, image_id='LMIM0000000002')
+        self.client.post('/api/subregions/', [self._square(0, 0, 30)], format='json')
+        subregion = models.Subregion.objects.get()
+        image_set_stats = models.ImageSetStats.objects.get(image_set=self.image.image_set)
+
+        def anatomy_counts():
+            return dict(
+                models.ImageSetAnatomyStats.objects.values_list('anatomy', 'subregion_count')
+            )
+
+        # changing only the anatomy of the image's only sub-region
+        response = self.client.patch(
+            '/api/subregions/%d/' % subregion.id,
+            {'anatomy': other_anatomy.id},
+            format='json'
+        )
+        image_set_stats.refresh_from_db()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(image_set_stats.subregion_count, 1)
+        self.assertEqual(image_set_stats.images_with_subregion_count, 1)
+        self.assertEqual(anatomy_counts(), {other_anatomy.id: 1})
+
+        response = self.client.patch(
+            '/api/subregions/%d/' % subregion.id,
+            {'image': other_image.id},
+            format='json'
+        )
+        image_set_stats.refresh_from_db()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(image_set_stats.subregion_count, 1)
+        self.assertEqual(image_set_stats.images_with_subregion_count, 1)
+        self.assertEqual(anatomy_counts(), {other_anatomy.id: 1})
+
+        # moving a sub-region onto an image which already has one
+        self.client.post('/api/subregions/', [self._square(100, 100, 30)], format='json')
+        image_set_stats.refresh_from_db()
+
+        self.assertEqual(image_set_stats.images_with_subregion_count, 2)
+
+        response = self.client.patch(
+            '/api/subregions/%d/' % subregion.id,
+            {'image': self.image.id, 'anatomy': self.anatomy.id},
+            format='json'
+        )
+        image_set_stats.refresh_from_db()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(image_set_stats.subregion_count, 2)
+        self.assertEqual(image_set_stats.images_with_subregion_count, 1)
+        self.assertEqual(anatomy_counts(), {self.anatomy.id: 2})
+
+    def test_bulk_create_preserves_point_order(self):
+        response = self.client.post(
+            '/api/subregions/',
+            self._payload(region_count=2, points_per_region=5),
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(
+            [p['order'] for p in response.data[0]['points']],
+            list(range(5))
+        )
+
+    def _square(self, x, y, size, anatomy=None):
+        return {
+            'image': self.image.id,
+            'anatomy': (anatomy or self.anatomy).id,
+            'points': [
+                {'x': px, 'y': py, 'order': i}
+                for i, (px, py) in enumerate(
+                    [(x, y), (x + size, y), (x + size, y + size), (x, y + size)]
+                )
+            ]
+        }
+
+    def test_bounding_box_saved(self):
+        self.client.post('/api/subregions/', [self._square(10, 20, 30)], format='json')
+        subregion = models.Subregion.objects.get()
+
+        self.assertEqual(
+            (subregion.x_min, subregion.y_min, subregion.x_max, subregion.y_max),
+            (10, 20, 40, 50)
+        )
+
+        response = self.client.patch(
+            '/api/subregions/%d/' % subregion.id,
+            {'points': self._square(100, 100, 10)['points']},
+            format='json'
+        )
+        subregion.refresh_from_db()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(subregion.x_max, 110)
+
+    def test_duplicates_rejected(self):
+        other_anatomy = models.Anatomy.objects.create(name='artery')
+        self.client.post('/api/subregions/', [self._square(10, 10, 30)], format='json')
+
+        response = self.client.post(
+            '/api/subregions/',
+            [self._square(11, 10, 30, anatomy=other_anatomy)],
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('bronchiole', response.data['detail'][0])
+
+        # overlapping (rather than duplicate) & separate sub-regions are fine
+        response = self.client.post(
+            '/api/subregions/',
+            [
+                self._square(25, 10, 30, anatomy=other_anatomy),
+                self._square(200, 200, 30, anatomy=other_anatomy)
+            ],
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, 201)
+
+        third_anatomy = models.Anatomy.objects.create(name='vein')
+        response = self.client.post(
+            '/api/subregions/',
+            [
+                self._square(300, 300, 30, anatomy=third_anatomy),
+                self._square(300, 300, 30, anatomy=third_anatomy)
+            ],
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data['detail'],
+            ["Sub-region 2 duplicates sub-region 1"]
+        )
+
+    def test_duplicate_check_only_fetches_nearby_subregions(self):
+        self.client.post(
+            '/api/subregions/',
+            [self._square(0, 0, 30), self._square(500, 500, 30), self._square(990, 990, 30)],
+            format='json'
+        )
+        boxes = [(0, 0, 40, 40), (980, 980, 1000, 1000)]
+
+        found = subregion_index.intersecting_boxes(models.Subregion.objects.all(), boxes)
+
+        # the sub-region in between isn't a candidate
+        self.assertEqual(sorted(s.x_min for s in found), [0, 990])
+
+    def test_spatial_queries(self):
+        self.client.post(
+            '/api/subregions/',
+            [self._square(0, 0, 30), self._square(100, 0, 30), self._square(0, 100, 30)],
+            format='json'
+        )
+
+        response = self.client.get(
+            '/api/subregions/',
+            {'image': self.image.id, 'bbox': '20,0,100,50'}
+        )
+
+        self.assertEqual(
+            sorted(r['points'][0]['x'] for r in response.data),
+            [0, 100]
+        )
+
+        response = self.client.post(
+            '/api/subregions/intersecting/',
+            {'image': self.image.id, 'points': self._square(20, 20, 30)['points']},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['points'][0], {'x': 0, 'y': 0, 'order': 0})
+        self.assertGreater(response.data[0]['iou'], 0)
+
+        response = self.client.get('/api/subregions/', {'bbox': '1,2'})
+
+        self.assertEqual(response.status_code, 400)
+
+
+class PolygonPackingTests(TestCase):
+    def test_round_trip(self):
+        polygon = [[0, 0], [4000, 0], [4000, 3000], [-1, 2 ** 31 - 1]]
+        blob = polygons.pack_polygon(polygon)
+
+        self.assertEqual(len(blob), len(polygon) * 8)
+        self.assertEqual(polygons.unpack_polygon(blob).tolist(), polygon)
+        self.assertEqual(polygons.unpack_polygon(memoryview(blob)).tolist(), polygon)
+
+    def test_empty(self):
+        self.assertEqual(polygons.unpack_polygon(None).shape, (0, 2))
+
+    def test_iou(self):
+        square = [[0, 0], [9, 0], [9, 9], [0, 9]]
+        half = [[5, 0], [14, 0], [14, 9], [5, 9]]
+
+        self.assertEqual(polygons.bounding_box(half), (5, 0, 14, 9))
+        self.assertEqual(polygons.polygon_iou(square, square), 1.0)
+        self.assertEqual(polygons.intersection_area(square, half), 50)
+        self.assertAlmostEqual(polygons.polygon_iou(square, half), 50 / 150.0)
+        self.assertEqual(polygons.polygon_iou(square, [[20, 20], [30, 20], [30, 30]]), 0.0)
+
+
+class ImageSetListQueryTests(TestCase):
+    image_set_count = 300
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username='tester', password='tester')
+        experiment = create_experiment()
+        probe = models.Probe.objects.create(label='Anti-Acta2')
+        anatomies = [
+            models.Anatomy.objects.create(name='bronchiole'),
+            models.Anatomy.objects.create(name='artery')
+        ]
+
+        models.ImageSet.objects.bulk_create(
+            models.ImageSet(
+                image_set_name='image set %d' % i,
+                magnification='20X',
+                species='mus musculus'
+            ) for i in range(cls.image_set_count)
+        )
+        image_sets = list(models.ImageSet.objects.all())
+
+        models.ImageSetProbeMap.objects.bulk_create(
+            models.ImageSetProbeMap(image_set=s, probe=probe, color='red') for s in image_sets
+        )
+        models.Image.objects.bulk_create(
+            models.Image(
+                source_url='http://example.com/%d_%d.tif.gz' % (s.id, i),
+                image_name='%d_%d.tif' % (s.id, i),
+                image_set=s,
+                experiment=experiment,
+                image_id='%d_%d' % (s.id, i)
+            ) for s in image_sets for i in range(2)
+        )
+        # only the first image of each set gets sub-regions
+        models.Subregion.objects.bulk_create(
+            models.Subregion(
+                image=image,
+                anatomy=anatomy,
+                user=user,
+                polygon=polygons.pack_polygon([[0, 0], [10, 0], [10, 10]])
+            )
+            for image in models.Image.objects.filter(image_name__endswith='_0.tif')
+            for anatomy in anatomies
+        )
+        stats.rebuild_image_set_stats()
+
+    def test_list_query_count_is_constant(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/image-sets/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), self.image_set_count)
+        self.assertLessEqual(len(queries), 5)
+
+    def test_list_counts(self):
+        response = self.client.get('/api/image-sets/')
+        image_set = response.data[0]
+
+        self.assertEqual(image_set['image_count'], 2)
+        self.assertEqual(image_set['images_with_subregion_count'], 1)
+        self.assertEqual(image_set['subregion_count'], 2)
+        self.assertEqual(
+            sorted(a['anatomy__name'] for a in image_set['subregion_count_by_anatomy_name']),
+            ['artery', 'bronchiole']
+        )
+        self.assertEqual(len(image_set['probes']), 1)
+        self.assertIsNone(image_set['trainedmodel'])
+
+    def test_detail_query_count(self):
+        image_set = models.ImageSet.objects.first()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/image-sets/%d/' % image_set.id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['subregion_count'], 2)
+        self.assertLessEqual(len(queries), 5)
+
+
+class LungMapImportTests(TestCase):
+    image_sets = {
+        'mouse E16.5 20X': {
+            'magnification': '20X',
+            'species': 'mus musculus',
+            'development_stage': 'E16.5',
+            'images': [
+                {
+                    'experiment_id': 'LMEX0000000001',
+                    'experiment_type_id': 'LMXT0000000003',
+                    'image_id': 'LMIM0000000001',
+                    'image_name': 'image_1.tif',
+                    'source_url': 'http://example.com/image_1.tif.gz',
+                    'x_scaling': '0.5',
+                    'y_scaling': '0.5'
+                },
+                {
+                    'experiment_id': 'LMEX0000000002',
+                    'experiment_type_id': 'LMXT0000000003',
+                    'image_id': 'LMIM0000000002',
+                    'image_name': 'image_2.tif',
+                    'source_url': 'http://example.com/image_2.tif.gz',
+                    'x_scaling': '0.5',
+                    'y_scaling': '0.5'
+                }
+            ],
+            'experiments': [
+                {'experiment_id': 'LMEX0000000001', 'experiment_type_id': 'LMXT0000000003'},
+                {'experiment_id': 'LMEX0000000002', 'experiment_type_id': 'LMXT0000000003'}
+            ],
+            'probes': [
+                {'probe_label': 'Anti-Acta2 ', 'color': 'red'},
+                {'probe_label': 'Anti-Sftpc', 'color': 'green'}
+            ]
+        }
+    }
+
+    def test_import(self):
+        counts = lungmap_import.import_image_sets(self.image_sets)
+
+        self.assertEqual(counts['images'], 2)
+        self.assertEqual(models.Image.objects.count(), 2)
+        self.assertEqual(models.Experiment.objects.count(), 2)
+        self.assertEqual(models.Probe.objects.filter(label='Anti-Acta2').count(), 1)
+        self.assertEqual(models.ImageSetProbeMap.objects.count(), 2)
+        self.assertEqual(models.ExperimentProbeMap.objects.count(), 4)
+
+    def test_reimport_creates_nothing(self):
+        lungmap_import.import_image_sets(self.image_sets)
+
+        with CaptureQueriesContext(connection) as queries:
+            counts = lungmap_import.import_image_sets(self.image_sets)
+
+        self.assertEqual(sum(counts.values()), 0)
+        self.assertEqual(models.ExperimentProbeMap.objects.count(), 4)
+        self.assertLessEqual(len(queries), 10)
+
+    def test_dry_run(self):
+        counts = lungmap_import.import_image_sets(self.image_sets, dry_run=True)
+
+        self.assertEqual(counts['image_sets'], 1)
+        self.assertEqual(models.ImageSet.objects.count(), 0)
+
+
+class ImagePrefetchTests(TestCase):
+    def setUp(self):
+        self.image = create_image(models.ImageSet.objects.create(image_set_name='image set'))
+
+    def test_claim_is_exclusive(self):
+        self.assertEqual([i.id for i in prefetch.claim_images(1)], [self.image.id])
+        self.assertEqual(prefetch.claim_images(1), [])
+
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.fetch_status, models.Image.FETCH_FETCHING)
+        self.assertEqual(self.image.fetch_attempts, 1)
+
+    def test_failure_backs_off(self):
+        image = prefetch.claim_images(1)[0]
+
+        with mock.patch(
+                'lungmap_client.lungmap_utils.get_image_from_lungmap',
+                side_effect=IOError('connection reset')):
+            self.assertFalse(prefetch.fetch_image(image))
+
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.fetch_status, models.Image.FETCH_PENDING)
+        self.assertEqual(self.image.fetch_error, 'connection reset')
+        self.assertIsNotNone(self.image.fetch_next_attempt)
+
+        # not due again until the backoff has passed
+        self.assertEqual(prefetch.claim_images(1), [])
+
+    def test_gives_up_after_max_attempts(self):
+        models.Image.objects.filter(id=self.image.id).update(
+            fetch_attempts=prefetch.FETCH_MAX_ATTEMPTS - 1
+        )
+        image = prefetch.claim_images(1)[0]
+
+        with mock.patch(
+                'lungmap_client.lungmap_utils.get_image_from_lungmap',
+                side_effect=IOError('not found')):
+            prefetch.fetch_image(image)
+
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.fetch_status, models.Image.FETCH_FAILED)
+
+        prefetch.retry_failed_images()
+        self.assertEqual(len(prefetch.claim_images(1)), 1)
+
+    def test_backoff_doubles(self):
+        self.assertEqual(prefetch.get_backoff(2), 2 * prefetch.get_backoff(1))
+        self.assertEqual(prefetch.get_backoff(100), prefetch.FETCH_BACKOFF_MAX_SECONDS)
+
+    def test_detail_does_not_download(self):
+        with mock.patch('lungmap_client.lungmap_utils.get_image_from_lungmap') as get_image:
+            response = self.client.get('/api/images/%d/' % self.image.id)
+
+        self.assertFalse(get_image.called)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['fetch_status'], models.Image.FETCH_PENDING)
+
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.fetch_priority, 1)
+
+
+class DecodeHSVImageTests(TestCase):
+    def test_matches_previous_pil_decode(self):
+        # earlier versions stored TIFFs re-encoded by PIL & decoded them with PIL
+        rgb_image = np.random.RandomState(0).randint(0, 256, (32, 24, 3)).astype(np.uint8)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'image.tif')
+            PIL.Image.fromarray(rgb_image, 'RGB').save(path, 'TIFF')
+
+            # noinspection PyUnresolvedReferences
+            expected = cv2.cvtColor(np.asarray(PIL.Image.open(path)), cv2.COLOR_RGB2HSV)
+
+            np.testing.assert_array_equal(caches.decode_hsv_image(path), expected)
+
+
+class HSVImageCacheTests(SimpleTestCase):
+    sha1 = 'ab' * 20
+
+    def setUp(self):
+        self.cache_root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(HSV_IMAGE_CACHE_ROOT=self.cache_root.name)
+        self.settings.enable()
+        caches.hsv_image_cache.clear()
+
+        self.hsv_img = np.random.RandomState(0).randint(0, 180, (32, 24, 3)).astype(np.uint8)
+
+    def tearDown(self):
+        caches.hsv_image_cache.clear()
+        self.settings.disable()
+        self.cache_root.cleanup()
+
+    def test_memory_tier(self):
+        with mock.patch.object(caches, 'decode_hsv_image', return_value=self.hsv_img) as decode:
+            first = caches.get_hsv_image(self.sha1, 'image.tif')
+            second = caches.get_hsv_image(self.sha1, 'image.tif')
+
+        self.assertEqual(decode.call_count, 1)
+        self.assertIs(second, first)
+        self.assertFalse(first.flags.writeable)
+        np.testing.assert_array_equal(first, self.hsv_img)
+
+    def test_disk_tier_is_memory_mapped(self):
+        with mock.patch.object(caches, 'decode_hsv_image', return_value=self.hsv_img):
+            caches.get_hsv_image(self.sha1, 'image.tif')
+
+        path = os.path.join(self.cache_root.name, self.sha1[:2], self.sha1 + '.npy')
+        self.assertTrue(os.path.isfile(path))
+
+        # e.g. another worker, or this one after eviction
+        caches.hsv_image_cache.clear()
+
+        with mock.patch.object(caches, 'decode_hsv_image') as decode:
+            hsv_img = caches.get_hsv_image(self.sha1, 'image.tif')
+            memmap = caches.get_hsv_memmap(self.sha1, 'image.tif')
+
+        decode.assert_not_called()
+        self.assertIsInstance(hsv_img, np.memmap)
+        self.assertIsInstance(memmap, np.memmap)
+        np.testing.assert_array_equal(hsv_img, self.hsv_img)
+        np.testing.assert_array_equal(memmap, self.hsv_img)
+
+    def test_memmap_decodes_once(self):
+        with mock.patch.object(caches, 'decode_hsv_image', return_value=self.hsv_img) as decode:
+            caches.get_hsv_memmap(self.sha1, 'image.tif')
+            memmap = caches.get_hsv_memmap(self.sha1, 'image.tif')
+
+        self.assertEqual(decode.call_count, 1)
+        self.assertIsInstance(memmap, np.memmap)
+        # the memmap tier never fills this worker's memory
+        self.assertNotIn(self.sha1, caches.hsv_image_cache)
+
+    def test_no_sha1_is_not_cached(self):
+        with mock.patch.object(caches, 'decode_hsv_image', return_value=self.hsv_img) as decode:
+            caches.get_hsv_image(None, 'image.tif')
+            caches.get_hsv_image(None, 'image.tif')
+
+        self.assertEqual(decode.call_count, 2)
+        self.assertEqual(os.listdir(self.cache_root.name), [])
+
+
+class ContentAddressedStorageTests(TestCase):
+    def test_identical_files_are_stored_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fs = storage.ContentAddressedStorage(location=directory)
+            name = 'images/ab/abcdef.tif'
+
+            self.assertEqual(fs.save(name, ContentFile(b'tiff')), name)
+            self.assertEqual(fs.save(name, ContentFile(b'tiff')), name)
+            self.assertEqual(os.listdir(os.path.join(directory, 'images', 'ab')), ['abcdef.tif'])
+
+    def test_upload_to(self):
+        image = models.Image(image_orig_sha1='abcdef')
+
+        self.assertEqual(
+            storage.image_orig_upload_to(image, 'image_1.tif'),
+            os.path.join('images', 'ab', 'abcdef.tif')
+        )
+        self.assertEqual(
+            storage.image_jpeg_upload_to(image, 'image_1.jpg'),
+            os.path.join('images_jpeg', 'ab', 'abcdef.jpg')
+        )
+
+    def test_duplicate_source_url_is_not_downloaded_again(self):
+        images = [
+            create_image(models.ImageSet.objects.create(image_set_name='image set %d' % i))
+            for i in range(3)
+        ]
+        models.Image.objects.filter(id=images[0].id).update(
+            image_orig='images/ab/abcdef.tif',
+            image_orig_sha1='abcdef',
+            image_jpeg='images_jpeg/ab/abcdef.jpg',
+            fetch_status=models.Image.FETCH_FETCHED
+        )
+
+        with mock.patch('lungmap_client.lungmap_utils.get_image_from_lungmap') as get_image:
+            self.assertTrue(prefetch.fetch_image(prefetch.claim_images(1)[0]))
+
+        self.assertFalse(get_image.called)
+        self.assertEqual(
+            set(models.Image.objects.values_list('image_orig', 'fetch_status')),
+            {('images/ab/abcdef.tif', models.Image.FETCH_FETCHED)}
+        )
+
+
+class TilePyramidTests(TestCase):
+    sha1 = 'ab' * 20
+
+    def setUp(self):
+        self.tile_root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(IMAGE_TILE_ROOT=self.tile_root.name)
+        self.settings.enable()
+        self.bgr_image = np.zeros((400, 600, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tile_root.cleanup()
+
+    def test_generate(self):
+        self.assertTrue(tiles.generate_tiles(self.sha1, self.bgr_image, tile_size=256))
+        self.assertFalse(tiles.generate_tiles(self.sha1, self.bgr_image, tile_size=256))
+
+        max_level = tiles.get_max_level(600, 400)
+        self.assertEqual(max_level, 10)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(tiles.tiles_directory(self.sha1), str(max_level)))),
+            ['0_0.jpg', '0_1.jpg', '1_0.jpg', '1_1.jpg', '2_0.jpg', '2_1.jpg']
+        )
+        self.assertEqual(
+            os.listdir(os.path.join(tiles.tiles_directory(self.sha1), '0')),
+            ['0_0.jpg']
+        )
+
+        # noinspection PyUnresolvedReferences
+        corner = cv2.imread(tiles.tile_path(self.sha1, max_level, 2, 1))
+        self.assertEqual(corner.shape, (400 - 256, 600 - 512, 3))
+
+    def test_endpoints(self):
+        tiles.generate_tiles(self.sha1, self.bgr_image)
+
+        response = self.client.get('/api/tiles/%s.dzi' % self.sha1)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Width="600"', b''.join(response.streaming_content))
+
+        response = self.client.get('/api/tiles/%s_files/0/0_0.jpg' % self.sha1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.client.get('/api/tiles/%s_files/0/1_0.jpg' % self.sha1)
+        self.assertEqual(response.status_code, 404)
+
+
+class ImageJpegResponseTests(TestCase):
+    sha1 = 'cd' * 20
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings.enable()
+
+        self.image = create_image(
+            models.ImageSet.objects.create(image_set_name='image set'),
+            image_orig_sha1=self.sha1
+        )
+        self.image.image_jpeg.save('image.jpg', ContentFile(b'jpeg'))
+        self.url = '/api/images-jpeg/%d/' % self.image.id
+
+    def tearDown(self):
+        self.settings.disable()
+        self.media_root.cleanup()
+
+    def test_etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'jpeg')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"something else"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleted_file_is_not_found_despite_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        os.remove(self.image.image_jpeg.path)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 404)
+
+    def test_x_accel_redirect(self):
+        with mock.patch.object(sendfile, 'SENDFILE_MODE', 'x-accel'):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response['X-Accel-Redirect'],
+            '/protected-media/images_jpeg/cd/%s.jpg' % self.sha1
+        )
+        self.assertEqual(response.content, b'')
+
+    def test_renditions(self):
+        rendition_root = os.path.join(self.media_root.name, 'renditions')
+
+        with override_settings(IMAGE_RENDITION_ROOT=rendition_root):
+            written = renditions.generate_renditions(
+                self.sha1,
+                np.zeros((2000, 1000, 3), dtype=np.uint8)
+            )
+            self.assertEqual(written, 5)
+            self.assertTrue(renditions.has_renditions(self.sha1))
+
+            # noinspection PyUnresolvedReferences
+            thumbnail = cv2.imread(renditions.rendition_path(self.sha1, 'thumbnail', 'jpg'))
+            self.assertEqual(thumbnail.shape, (256, 128, 3))
+
+            response = self.client.get('/api/images/%d/' % self.image.id)
+            self.assertTrue(
+                response.data['renditions']['thumbnail']['webp'].endswith(
+                    '/api/images/%d/thumbnail.webp' % self.image.id
+                )
+            )
+
+            response = self.client.get('/api/images/%d/medium.webp' % self.image.id)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            self.assertEqual(response['ETag'], '"%s-medium-webp"' % self.sha1)
+
+            response = self.client.get('/api/images/%d/full.jpg' % self.image.id)
+            self.assertEqual(b''.join(response.streaming_content), b'jpeg')
+
+
+class ImageClassificationTests(TestCase):
+    def setUp(self):
+        image_set = models.ImageSet.objects.create(image_set_name='image set')
+        models.TrainedModel.objects.create(imageset=image_set, model_object='image_set.pkl')
+        self.image = create_image(image_set, image_orig_sha1='ef' * 20)
+
+        # bright squares on a dark background, two of them straddling tile edges
+        self.hsv_img = np.zeros((300, 300, 3), dtype=np.uint8)
+        self.squares = [(20, 20), (110, 20), (20, 110), (200, 200), (240, 40)]
+
+        for x, y in self.squares:
+            self.hsv_img[y:y + 40, x:x + 40] = (60, 200, 250)
+
+    def test_tiles_cover_image(self):
+        covered = np.zeros((300, 250), dtype=np.int32)
+
+        for (x0, y0, x1, y1), (wx0, wy0, wx1, wy1) in image_classification.iter_tiles(
+                250, 300, 128, 32):
+            covered[y0:y1, x0:x1] += 1
+            self.assertTrue(wx0 <= x0 and wy0 <= y0 and x1 <= wx1 <= 250 and y1 <= wy1 <= 300)
+
+        self.assertTrue((covered == 1).all())
+        self.assertEqual(image_classification.count_tiles(250, 300, 128), 6)
+
+    def test_regions_on_tile_edges_are_found_once(self):
+        found = []
+
+        for tile, window in image_classification.iter_tiles(300, 300, 128, 64):
+            window_img, tile_polygons = image_classification.find_tile_candidates(
+                self.hsv_img, tile, window
+            )
+            found.extend(tuple(p.min(axis=0) + window[:2]) for p in tile_polygons)
+
+        self.assertEqual(sorted(found), sorted(self.squares))
+
+    def test_run_job(self):
+        pipeline = mock.Mock()
+        pipeline.named_steps = {'classification': mock.Mock(classes_=['artery', 'bronchiole'])}
+        pipeline.predict_proba.side_effect = lambda df: np.tile([0.25, 0.75], (len(df), 1))
+
+        job = image_classification.queue_classification_job(self.image)
+        self.assertEqual(image_classification.claim_next_job().id, job.id)
+
+        with mock.patch.object(caches, 'get_hsv_memmap', return_value=self.hsv_img), \
+                mock.patch.object(caches, 'get_trained_model', return_value=pipeline), \
+                mock.patch.object(image_classification, 'CLASSIFICATION_TILE_SIZE', 128), \
+                mock.patch.object(image_classification, 'CLASSIFICATION_TILE_MARGIN', 64), \
+                mock.patch.object(image_classification, 'CLASSIFICATION_BATCH_SIZE', 2):
+            image_classification.run_classification_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.ClassificationJob.STATUS_COMPLETE, job.detail)
+        self.assertEqual(job.regions_found, len(self.squares))
+        self.assertEqual(job.tiles_total, 9)
+
+        # one predict_proba call per batch of 2 candidates
+        self.assertEqual(pipeline.predict_proba.call_count, 3)
+
+        region = job.regions.first()
+        self.assertEqual(region.anatomy, 'bronchiole')
+        self.assertEqual(region.probability, 0.75)
+        self.assertEqual(
+            models.ClassificationResult.objects.filter(image=self.image).count(),
+            len(self.squares)
+        )
+
+    def test_stale_jobs_are_failed(self):
+        job = image_classification.queue_classification_job(self.image)
+        image_classification.claim_next_job()
+        models.ClassifiedRegion.objects.create(
+            job=job,
+            polygon=polygons.pack_polygon([[0, 0], [1, 0], [1, 1]]),
+            anatomy='artery',
+            probability=0.5,
+            probabilities='{}'
+        )
+
+        self.assertEqual(image_classification.fail_stale_jobs(), 0)
+
+        with self.assertRaises(ValueError):
+            image_classification.queue_classification_job(self.image)
+
+        models.ClassificationJob.objects.filter(id=job.id).update(
+            heartbeat=timezone.now() - datetime.timedelta(
+                seconds=image_classification.CLASSIFICATION_JOB_STALE_SECONDS + 60
+            )
+        )
+
+        new_job = image_classification.queue_classification_job(self.image)
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, models.ClassificationJob.STATUS_FAILED)
+        self.assertFalse(job.regions.exists())
+        self.assertEqual(new_job.status, models.ClassificationJob.STATUS_QUEUED)
+
+    def test_queue_requires_download(self):
+        models.Image.objects.filter(id=self.image.id).update(image_orig_sha1=None)
+        self.image.refresh_from_db()
+
+        with self.assertRaises(ValueError):
+            image_classification.queue_classification_job(self.image)
+
+
+class CandidateGenerationTests(TestCase):
+    def test_suppression_keeps_best_of_overlapping_boxes(self):
+        boxes = np.array(
+            [[0, 0, 10, 10], [1, 1, 11, 11], [20, 20, 30, 30], [0, 0, 9, 10]],
+            dtype=np.float64
+        )
+        scores = np.array([50, 100, 10, 40])
+
+        keep = candidates.non_max_suppression(boxes, scores, iou_threshold=0.5)
+
+        self.assertEqual(keep.tolist(), [1, 2])
+
+    def test_suppression_without_boxes(self):
+        keep = candidates.non_max_suppression(np.zeros((0, 4)), np.zeros(0))
+
+        self.assertEqual(len(keep), 0)
+
+    def test_red_wraps_around_hue(self):
+        hsv_img = np.zeros((2, 3, 3), dtype=np.uint8)
+        hsv_img[0] = [(2, 200, 200), (175, 200, 200), (60, 200, 200)]
+
+        mask = candidates.color_mask(hsv_img, 'red')
+
+        self.assertEqual(mask[0].tolist(), [255, 255, 0])
+        self.assertFalse(mask[1].any())
+
+    def test_candidates_per_probe_color(self):
+        hsv_img = np.zeros((200, 200, 3), dtype=np.uint8)
+        hsv_img[20:60, 20:60] = (0, 200, 200)  # red
+        hsv_img[100:170, 100:170] = (60, 200, 200)  # green
+        # a blue region inside the green one is a duplicate of it
+        hsv_img[106:164, 106:164] = (120, 200, 200)
+
+        found = candidates.find_candidates(hsv_img, colors=['red', 'green', 'blue'])
+
+        self.assertEqual(
+            sorted(tuple(p.min(axis=0)) for p in found),
+            [(20, 20), (100, 100)]
+        )
+        self.assertEqual(
+            [tuple(p.min(axis=0)) for p in candidates.find_candidates(hsv_img, colors=['red'])],
+            [(20, 20)]
+        )
+
+
+class ClassificationResultStoreTests(TestCase):
+    def setUp(self):
+        image_set = models.ImageSet.objects.create(image_set_name='image set')
+        self.trained_model = models.TrainedModel.objects.create(
+            imageset=image_set,
+            model_object='image_set.pkl'
+        )
+        self.image = create_image(image_set, image_orig_sha1='ef' * 20)
+        self.image = models.Image.objects.select_related('image_set__trainedmodel')\
+            .get(id=self.image.id)
+
+        self.regions = [
+            np.array([[0, 0], [10, 0], [10, 10]]),
+            np.array([[20, 20], [30, 20], [30, 30]])
+        ]
+
+    @staticmethod
+    def classify(image, regions):
+        # the first vertex decides the class
+        return ['artery', 'bronchiole'], np.array(
+            [[0.9, 0.1] if r[0][0] == 0 else [0.2, 0.8] for r in regions]
+        )
+
+    def test_classified_polygons_are_read_from_store(self):
+        with mock.patch.object(
+                result_store.classification, 'classify_polygons', side_effect=self.classify
+        ) as classify_polygons:
+            result_store.classify_polygons(self.image, self.regions[:1])
+            model_classes, probabilities = result_store.classify_polygons(
+                self.image,
+                self.regions
+            )
+
+        # the second call only classifies the new polygon
+        self.assertEqual(classify_polygons.call_count, 2)
+        self.assertEqual(len(classify_polygons.call_args[0][1]), 1)
+        self.assertEqual(model_classes, ['artery', 'bronchiole'])
+        self.assertEqual(probabilities.tolist(), [[0.9, 0.1], [0.2, 0.8]])
+
+        with mock.patch.object(
+                result_store.classification, 'classify_polygons', side_effect=self.classify
+        ) as classify_polygons:
+            model_classes, probabilities = result_store.classify_polygons(
+                self.image,
+                self.regions[::-1]
+            )
+
+        classify_polygons.assert_not_called()
+        self.assertEqual(model_classes, ['artery', 'bronchiole'])
+        self.assertEqual(probabilities.tolist(), [[0.2, 0.8], [0.9, 0.1]])
+
+    def test_results_of_earlier_download_are_stale(self):
+        result_store.save_results(
+            self.trained_model,
+            self.image,
+            [(self.regions[0], ['artery', 'bronchiole'], [0.9, 0.1])]
+        )
+        self.image.image_orig_sha1 = '12' * 20
+
+        with mock.patch.object(
+                result_store.classification, 'classify_polygons', side_effect=self.classify
+        ) as classify_polygons:
+            result_store.classify_polygons(self.image, self.regions[:1])
+
+        classify_polygons.assert_called_once()
+        self.assertEqual(models.ClassificationResult.objects.get().image_sha1, '12' * 20)
+
+    def test_results_of_older_feature_schema_are_stale(self):
+        result_store.save_results(
+            self.trained_model,
+            self.image,
+            [(self.regions[0], ['artery', 'bronchiole'], [0.9, 0.1])]
+        )
+
+        with mock.patch.object(
+                features, 'FEATURE_SCHEMA_VERSION', features.FEATURE_SCHEMA_VERSION + 1
+        ), mock.patch.object(
+                result_store.classification, 'classify_polygons', side_effect=self.classify
+        ) as classify_polygons:
+            result_store.classify_polygons(self.image, self.regions[:1])
+
+            classify_polygons.assert_called_once()
+            self.assertEqual(
+                models.ClassificationResult.objects.get().schema_version,
+                features.FEATURE_SCHEMA_VERSION
+            )
+
+    def test_list_filters(self):
+        result_store.save_results(
+            self.trained_model,
+            self.image,
+            [
+                (region, ['artery', 'bronchiole'], probabilities)
+                for region, probabilities in zip(self.regions, [[0.9, 0.1], [0.4, 0.6]])
+            ]
+        )
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_user(username='tester'))
+
+        response = client.get(
+            '/api/classify/results/',
+            {'image': self.image.id, 'min_probability': 0.7}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['anatomy'] for r in response.data], ['artery'])
+        self.assertEqual(response.data[0]['points'][1], {'x': 10, 'y': 0, 'order': 1})
+
+        response = client.get('/api/classify/results/', {'anatomy': 'bronchiole'})
+
+        self.assertEqual([r['probability'] for r in response.data], [0.6])
+
+
+class FeatureCropTests(TestCase):
+    def setUp(self):
+        self.hsv_img = np.arange(300 * 400 * 3, dtype=np.uint32).astype(np.uint8)\
+            .reshape(300, 400, 3)
+        self.polygon = np.array([[100, 50], [140, 50], [140, 80], [100, 80]], dtype=np.int32)
+
+    def test_crop_region(self):
+        crop, offset_polygon = features.crop_region(self.hsv_img, self.polygon, margin=10)
+
+        self.assertEqual(crop.shape, (51, 61, 3))
+        self.assertEqual(offset_polygon.min(axis=0).tolist(), [10, 10])
+        self.assertTrue((crop[10:41, 10:51] == self.hsv_img[50:81, 100:141]).all())
+
+    def test_crop_is_clipped_to_image(self):
+        polygon = np.array([[-5, 290], [20, 290], [20, 310]], dtype=np.int32)
+        crop, offset_polygon = features.crop_region(self.hsv_img, polygon, margin=10)
+
+        self.assertEqual(crop.shape, (20, 31, 3))
+        self.assertEqual(offset_polygon.tolist(), [[-5, 10], [20, 10], [20, 30]])
+
+    def test_features_use_crop(self):
+        def generate_features(hsv_img_as_numpy, polygon_points, label):
+            return {'height': hsv_img_as_numpy.shape[0], 'x': polygon_points[0][0], 'label': label}
+
+        with mock.patch.object(features.utils, 'generate_features', side_effect=generate_features):
+            columns, rows = features.extract_features(
+                self.hsv_img,
+                [(self.polygon, 'artery')],
+                margin=5
+            )
+            full_columns, full_rows = features.extract_features(
+                self.hsv_img,
+                [(self.polygon, 'artery')],
+                margin=None
+            )
+
+        self.assertEqual(columns, ('height', 'x', 'label'))
+        self.assertEqual(rows, [(41, 5, 'artery')])
+        self.assertEqual(full_rows, [(300, 100, 'artery')])
+
+
+class TrainingJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='tester', password='tester')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.image_set = models.ImageSet.objects.create(image_set_name='image set')
+        self.images = [
+            create_image(
+                self.image_set,
+                image_id='LMIM000000000%d' % i,
+                image_orig_sha1=('%02d' % i) * 20
+            ) for i in range(2)
+        ]
+
+        # 4 sub-regions of each of 2 anatomies, the minimum for training
+        for anatomy_name in ('artery', 'bronchiole'):
+            anatomy = models.Anatomy.objects.create(name=anatomy_name)
+
+            for i in range(4):
+                subregion = models.Subregion(
+                    image=self.images[i % 2],
+                    anatomy=anatomy,
+                    user=self.user
+                )
+                subregion.set_polygon([[i * 50, 0], [i * 50 + 40, 0], [i * 50 + 40, 40]])
+                subregion.save()
+
+    def test_stale_jobs_are_failed(self):
+        job = training.queue_training_job(self.image_set)
+        self.assertEqual(training.claim_next_job().id, job.id)
+
+        # the worker died long ago
+        models.TrainingJob.objects.filter(id=job.id).update(
+            heartbeat=timezone.now() - datetime.timedelta(
+                seconds=training.TRAINING_JOB_STALE_SECONDS + 60
+            )
+        )
+
+        new_job = training.queue_training_job(self.image_set)
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, models.TrainingJob.STATUS_FAILED)
+        self.assertIsNotNone(job.finished)
+        self.assertEqual(new_job.status, models.TrainingJob.STATUS_QUEUED)
+
+    def test_running_jobs_with_recent_heartbeat_are_kept(self):
+        job = training.queue_training_job(self.image_set)
+        training.claim_next_job()
+
+        self.assertEqual(training.fail_stale_jobs(), 0)
+
+        with self.assertRaises(ValueError):
+            training.queue_training_job(self.image_set)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.TrainingJob.STATUS_RUNNING)
+
+    def test_queue_job(self):
+        response = self.client.post(
+            '/api/train-model/',
+            {'imageset': self.image_set.id},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, 202)
+        job = models.TrainingJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.status, models.TrainingJob.STATUS_QUEUED)
+        self.assertEqual(job.images_total, 2)
+        self.assertEqual(job.user, self.user)
+
+        # only one active job per image set
+        response = self.client.post(
+            '/api/train-model/',
+            {'imageset': self.image_set.id},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(models.TrainingJob.objects.count(), 1)
+
+    def test_claim_once(self):
+        job = training.queue_training_job(self.image_set)
+
+        claimed = training.claim_next_job()
+
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, models.TrainingJob.STATUS_RUNNING)
+        self.assertIsNotNone(claimed.started)
+        self.assertIsNone(training.claim_next_job())
+
+    def test_run_job(self):
+        def train_image_set(image_set, progress_callback=None):
+            progress_callback(1)
+            self.assertEqual(
+                models.TrainingJob.objects.get(id=job.id).images_processed,
+                1
+            )
+
+            return models.TrainedModel.objects.create(imageset=image_set)
+
+        job = training.queue_training_job(self.image_set)
+        training.claim_next_job()
+
+        with mock.patch.object(training, 'train_image_set', side_effect=train_image_set):
+            training.run_training_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.TrainingJob.STATUS_COMPLETE)
+        self.assertEqual(job.images_processed, 2)
+        self.assertEqual(job.trained_model, self.image_set.trainedmodel)
+        self.assertIsNone(job.detail)
+        self.assertIsNotNone(job.finished)
+
+        response = self.client.get('/api/train-model/jobs/%d/' % job.id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], models.TrainingJob.STATUS_COMPLETE)
+        self.assertEqual(response.data['images_processed'], 2)
+        self.assertEqual(response.data['trained_model'], job.trained_model_id)
+
+    def test_run_job_failure(self):
+        job = training.queue_training_job(self.image_set)
+        training.claim_next_job()
+
+        with mock.patch.object(
+                training, 'train_image_set', side_effect=ValueError("Not enough memory")
+        ):
+            training.run_training_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.TrainingJob.STATUS_FAILED)
+        self.assertEqual(job.detail, "Not enough memory")
+        self.assertEqual(job.images_processed, 0)
+        self.assertIsNone(job.trained_model)
+
+        response = self.client.get('/api/train-model/jobs/%d/' % job.id)
+
+        self.assertEqual(response.data['status'], models.TrainingJob.STATUS_FAILED)
+        self.assertEqual(response.data['detail'], "Not enough memory")
+
+        # a failed job doesn't block training again
+        self.assertEqual(
+            training.queue_training_job(self.image_set).status,
+            models.TrainingJob.STATUS_QUEUED
+        )
+
+    @override_settings(TRAINING_WORKERS=1)
+    def test_features_only_computed_for_new_or_changed_subregions(self):
+        def generate_features(hsv_img_as_numpy, polygon_points, label):
+            width = int(np.ptp(polygon_points[:, 0]))
+
+            return {'width': width, 'label': label}
+
+        models.Image.objects.filter(image_set=self.image_set).update(image_orig='image.tif')
+
+        def get_training_data():
+            with mock.patch.object(caches, 'decode_hsv_image', return_value=self.hsv_img), \
+                    mock.patch.object(
+                        features.utils, 'generate_features', side_effect=generate_features
+                    ) as patched:
+                training_data = training.get_training_data(self.image_set)
+
+            return patched.call_count, training_data
+
+        self.hsv_img = np.zeros((100, 400, 3), dtype=np.uint8)
+
+        calls, training_data = get_training_data()
+        self.assertEqual(calls, 8)
+        self.assertEqual(len(training_data), 8)
+
+        # nothing changed, everything is read from the store
+        calls, training_data = get_training_data()
+        self.assertEqual(calls, 0)
+        self.assertEqual(len(training_data), 8)
+        self.assertEqual(list(training_data.columns), ['width', 'label'])
+
+        # a new sub-region
+        subregion = models.Subregion(
+            image=self.images[0],
+            anatomy=models.Anatomy.objects.get(name='artery'),
+            user=self.user
+        )
+        subregion.set_polygon([[300, 50], [340, 50], [340, 90]])
+        subregion.save()
+
+        calls, training_data = get_training_data()
+        self.assertEqual(calls, 1)
+        self.assertEqual(len(training_data), 9)
+
+        # a changed polygon
+        subregion.set_polygon([[310, 50], [340, 50], [340, 90]])
+        subregion.save()
+
+        calls, training_data = get_training_data()
+        self.assertEqual(calls, 1)
+        self.assertEqual(sorted(training_data['width'].tolist()), [30] + [40] * 8)
+
+        # new feature metrics
+        with mock.patch.object(
+                features, 'FEATURE_SCHEMA_VERSION', features.FEATURE_SCHEMA_VERSION + 1
+        ):
+            calls, training_data = get_training_data()
+
+        self.assertEqual(calls, 9)
+
+    def test_worker_populates_missing_features(self):
+        models.Image.objects.filter(image_set=self.image_set).update(image_orig='image.tif')
+        hsv_img = np.zeros((100, 400, 3), dtype=np.uint8)
+
+        self.assertEqual(len(feature_store.get_missing_feature_ids(100)), 8)
+
+        with mock.patch.object(caches, 'get_hsv_image', return_value=hsv_img), \
+                mock.patch.object(features.utils, 'generate_features', side_effect=OSError):
+            # failures are skipped rather than retried forever
+            call_command('run_training_worker', '--once')
+
+        self.assertFalse(models.SubregionFeatures.objects.exists())
+
+        with mock.patch.object(caches, 'get_hsv_image', return_value=hsv_img), \
+                mock.patch.object(
+                    features.utils,
+                    'generate_features',
+                    side_effect=lambda hsv_img_as_numpy, polygon_points, label: {'label': label}
+                ):
+            call_command('run_training_worker', '--once')
+
+        self.assertEqual(models.SubregionFeatures.objects.count(), 8)
+        self.assertEqual(feature_store.get_missing_feature_ids(100), [])
+
+
+def fake_extract_image_features(sha1, image_path, image_polygons, cached=True):
+    # module level so worker processes can run it, later images finish first
+    time.sleep(0.05 * (5 - int(sha1)))
+
+    # training must skip the HSV caches, also in the worker processes
+    if cached:
+        raise AssertionError('training features extracted through the HSV caches')
+
+    return ('area', 'label'), [(len(p) * int(sha1), label) for p, label in image_polygons]
+
+
+class ExtractTrainingFeaturesTests(SimpleTestCase):
+    def setUp(self):
+        self.tasks = [
+            (
+                str(i),
+                '/images/%d.tif' % i,
+                [(np.zeros((j + 3, 2)), 'artery' if j % 2 else 'bronchiole') for j in range(i + 1)]
+            ) for i in range(5)
+        ]
+
+    def extract(self, workers):
+        progress = []
+
+        # worker processes are forked, so they see the patched function
+        with mock.patch.object(
+                training.features, 'extract_image_features', fake_extract_image_features
+        ):
+            results = training.extract_training_features(
+                self.tasks,
+                workers=workers,
+                progress_callback=progress.append
+            )
+
+        return results, progress
+
+    def test_process_pool_matches_serial(self):
+        serial_results, serial_progress = self.extract(workers=1)
+        pool_results, pool_progress = self.extract(workers=3)
+
+        self.assertEqual(pool_results, serial_results)
+        self.assertEqual([len(rows) for columns, rows in pool_results], [1, 2, 3, 4, 5])
+        self.assertEqual(pool_results[2][1][1], (4 * 2, 'artery'))
+        self.assertEqual(
+            set(columns for columns, rows in pool_results),
+            {('area', 'label')}
+        )
+
+        self.assertEqual(serial_progress, [1, 2, 3, 4, 5])
+        self.assertEqual(pool_progress, [1, 2, 3, 4, 5])
+
+    def test_decodes_without_caches(self):
+        hsv_img = np.zeros((10, 10, 3), dtype=np.uint8)
+
+        with mock.patch.object(caches, 'decode_hsv_image', return_value=hsv_img) as decode, \
+                mock.patch.object(caches, 'get_hsv_image') as get_hsv_image, \
+                mock.patch.object(
+                    features.utils,
+                    'generate_features',
+                    side_effect=lambda hsv_img_as_numpy, polygon_points, label: {'label': label}
+                ):
+            results = training.extract_training_features(self.tasks[:2], workers=1)
+
+        self.assertEqual(decode.call_count, 2)
+        get_hsv_image.assert_not_called()
+        self.assertEqual(results[1], (('label',), [('bronchiole',), ('artery',)]))
+
+
+class ClassifySubRegionBatchTests(TestCase):
+    def setUp(self):
+        self.image_set = models.ImageSet.objects.create(image_set_name='image set')
+        models.TrainedModel.objects.create(imageset=self.image_set, model_object='image_set.pkl')
+        self.image = create_image(
+            self.image_set,
+            image_orig='image.tif',
+            image_orig_sha1='ef' * 20
+        )
+
+        # the probability of 'artery' is the polygon's width / 100
+        self.pipeline = mock.Mock()
+        self.pipeline.named_steps = {
+            'classification': mock.Mock(classes_=['artery', 'bronchiole'])
+        }
+        self.pipeline.predict_proba.side_effect = lambda df: np.stack(
+            [df['width'] / 100.0, 1 - df['width'] / 100.0],
+            axis=1
+        )
+
+    @staticmethod
+    def generate_features(hsv_img_as_numpy, polygon_points, label):
+        return {'width': int(np.ptp(polygon_points[:, 0])), 'label': label}
+
+    @staticmethod
+    def triangle(width):
+        return [
+            {'x': 10, 'y': 10, 'order': 0},
+            {'x': 10 + width, 'y': 10, 'order': 1},
+            {'x': 10, 'y': 50, 'order': 2}
+        ]
+
+    def post(self, polygon_points):
+        with mock.patch.object(caches, 'get_trained_model', return_value=self.pipeline), \
+                mock.patch.object(
+                    caches,
+                    'get_hsv_image',
+                    return_value=np.zeros((100, 100, 3), dtype=np.uint8)
+                ), \
+                mock.patch.object(
+                    features.utils, 'generate_features', side_effect=self.generate_features
+                ):
+            return APIClient().post(
+                '/api/classify/batch/',
+                {'image_id': self.image.id, 'polygons': polygon_points},
+                format='json'
+            )
+
+    def test_one_prediction_for_all_polygons_in_request_order(self):
+        response = self.post([self.triangle(10), self.triangle(30), self.triangle(20)])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.pipeline.predict_proba.call_count, 1)
+        self.assertEqual(
+            [r[0]['artery'] for r in response.data['results']],
+            [0.1, 0.3, 0.2]
+        )
+        self.assertEqual(response.data['results'][1], [{'artery': 0.3}, {'bronchiole': 0.7}])
+
+    def test_no_polygons(self):
+        response = self.post([])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [])
+        self.pipeline.predict_proba.assert_not_called()
+
+    def test_degenerate_polygons(self):
+        for points in ([], self.triangle(10)[:2]):
+            response = self.post([self.triangle(10), points])
+
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('polygons', response.data)
+
+        self.pipeline.predict_proba.assert_not_called()
+
+    def test_untrained_image_set(self):
+        self.image_set.trainedmodel.delete()
+
+        response = self.post([self.triangle(10)])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['detail'], "Image set has no trained model")
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_lru_keeps_recently_used(self):
+        cache = caches.LRUCache(max_size=2, policy='lru')
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(sorted(cache._entries), ['a', 'c'])
+
+    def test_fifo_ignores_use(self):
+        cache = caches.LRUCache(max_size=2, policy='fifo')
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(sorted(cache._entries), ['b', 'c'])
+
+    def test_byte_budget(self):
+        cache = caches.LRUCache(max_size=100, size_func=lambda array: array.nbytes)
+        cache.set('a', np.zeros(40, dtype=np.uint8))
+        cache.set('b', np.zeros(50, dtype=np.uint8))
+
+        self.assertEqual(cache.current_size, 90)
+
+        cache.set('c', np.zeros(30, dtype=np.uint8))
+
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.current_size, 80)
+
+        # larger than the whole budget, never cached
+        cache.set('d', np.zeros(101, dtype=np.uint8))
+
+        self.assertNotIn('d', cache)
+        self.assertEqual(len(cache), 2)
+
+        cache.delete('b')
+        self.assertEqual(cache.current_size, 30)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            caches.LRUCache(max_size=1, policy='random')
+
+
+class TrainedModelCacheTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings.enable()
+        caches.trained_model_cache.clear()
+
+        image_set = models.ImageSet.objects.create(image_set_name='image set')
+        self.trained_model = models.TrainedModel.objects.create(
+            imageset=image_set,
+            model_object=ContentFile(b'pickled pipeline', name='image_set.pkl')
+        )
+
+    def tearDown(self):
+        caches.trained_model_cache.clear()
+        self.settings.disable()
+        self.media_root.cleanup()
+
+    def test_loaded_once(self):
+        with mock.patch.object(caches.joblib, 'load', return_value='pipeline') as load:
+            self.assertEqual(caches.get_trained_model(self.trained_model), 'pipeline')
+            self.assertEqual(caches.get_trained_model(self.trained_model), 'pipeline')
+
+        self.assertEqual(load.call_count, 1)
+
+    def test_missing_checksum_computed_once(self):
+        with mock.patch.object(caches.joblib, 'load', return_value='pipeline'), \
+                mock.patch.object(caches, 'file_sha1', wraps=caches.file_sha1) as file_sha1:
+            caches.get_trained_model(self.trained_model)
+            caches.get_trained_model(
+                models.TrainedModel.objects.get(id=self.trained_model.id)
+            )
+
+        self.assertEqual(file_sha1.call_count, 1)
+        self.assertEqual(
+            models.TrainedModel.objects.get(id=self.trained_model.id).model_object_sha1,
+            hashlib.sha1(b'pickled pipeline').hexdigest()
+        )
+
+    def test_invalidate(self):
+        with mock.patch.object(caches.joblib, 'load', return_value='pipeline') as load:
+            caches.get_trained_model(self.trained_model)
+            caches.invalidate_trained_model(self.trained_model.id)
+            caches.get_trained_model(self.trained_model)
+
+        self.assertEqual(load.call_count, 2)
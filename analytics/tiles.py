@@ -0,0 +1,141 @@
+"""
+Deep Zoom (DZI) tile pyramids for the image viewer. A pyramid is generated
+once per distinct image (keyed by the SHA1 of the original, like the rest
+of the derived rasters) when the image is ingested, so the viewer only ever
+downloads the tiles it is displaying, at the resolution it is displaying.
+
+Layout under IMAGE_TILE_ROOT follows the DZI convention:
+ab/<sha1>.dzi and ab/<sha1>_files/<level>/<col>_<row>.jpg
+"""
+from django.conf import settings
+import math
+import os
+import shutil
+import tempfile
+# noinspection PyPackageRequirements
+import cv2
+
+TILE_SIZE = getattr(settings, 'IMAGE_TILE_SIZE', 256)
+TILE_FORMAT = 'jpg'
+TILE_JPEG_QUALITY = 75
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  TileSize="%(tile_size)d" Overlap="0" Format="%(format)s">
+  <Size Width="%(width)d" Height="%(height)d"/>
+</Image>
+"""
+
+
+def _tile_root():
+    return getattr(
+        settings,
+        'IMAGE_TILE_ROOT',
+        os.path.join(settings.MEDIA_ROOT, 'tiles')
+    )
+
+
+def dzi_path(sha1):
+    return os.path.join(_tile_root(), sha1[:2], sha1 + '.dzi')
+
+
+def tiles_directory(sha1):
+    return os.path.join(_tile_root(), sha1[:2], sha1 + '_files')
+
+
+def tile_path(sha1, level, col, row):
+    return os.path.join(
+        tiles_directory(sha1),
+        str(level),
+        '%d_%d.%s' % (col, row, TILE_FORMAT)
+    )
+
+
+def has_tiles(sha1):
+    # the descriptor is written last, so it marks a complete pyramid
+    return os.path.exists(dzi_path(sha1))
+
+
+def get_max_level(width, height):
+    """
+    Level of the full resolution image, level 0 being 1 x 1 pixel
+    """
+    return int(math.ceil(math.log(max(width, height, 1), 2)))
+
+
+def _write_level(directory, level_image, tile_size):
+    os.makedirs(directory)
+    height, width = level_image.shape[:2]
+
+    for row, y in enumerate(range(0, height, tile_size)):
+        for col, x in enumerate(range(0, width, tile_size)):
+            # noinspection PyUnresolvedReferences
+            encoded, tile = cv2.imencode(
+                '.' + TILE_FORMAT,
+                level_image[y:y + tile_size, x:x + tile_size],
+                [cv2.IMWRITE_JPEG_QUALITY, TILE_JPEG_QUALITY]
+            )
+
+            if not encoded:
+                raise ValueError("Could not encode tile %d_%d" % (col, row))
+
+            with open(os.path.join(directory, '%d_%d.%s' % (col, row, TILE_FORMAT)), 'wb') as f:
+                f.write(tile.tobytes())
+
+
+def generate_tiles(sha1, bgr_image, tile_size=TILE_SIZE):
+    """
+    Generate the DZI pyramid for an image unless it already exists. Each
+    level is downsampled from the one above it, halving the size each time.
+    Tiles are written to a temp directory & moved into place, so a pyramid
+    is either complete or absent.
+    :param sha1: SHA1 of the original image
+    :param bgr_image: decoded image as returned by cv2.imdecode
+    :param tile_size: tile width & height in pixels
+    :return: True if the pyramid was generated, False if it already existed
+    """
+    if has_tiles(sha1):
+        return False
+
+    height, width = bgr_image.shape[:2]
+    shard = os.path.dirname(dzi_path(sha1))
+    os.makedirs(shard, exist_ok=True)
+    temp_directory = tempfile.mkdtemp(dir=shard)
+
+    try:
+        level_image = bgr_image
+
+        for level in range(get_max_level(width, height), -1, -1):
+            _write_level(os.path.join(temp_directory, str(level)), level_image, tile_size)
+
+            level_height, level_width = level_image.shape[:2]
+            # noinspection PyUnresolvedReferences
+            level_image = cv2.resize(
+                level_image,
+                (max(int(math.ceil(level_width / 2)), 1), max(int(math.ceil(level_height / 2)), 1)),
+                interpolation=cv2.INTER_AREA
+            )
+
+        try:
+            os.rename(temp_directory, tiles_directory(sha1))
+        except OSError:
+            # another worker got there first, its tiles are identical
+            if not os.path.isdir(tiles_directory(sha1)):
+                raise
+    finally:
+        if os.path.isdir(temp_directory):
+            shutil.rmtree(temp_directory)
+
+    with tempfile.NamedTemporaryFile('w', dir=shard, suffix='.dzi', delete=False) as f:
+        f.write(
+            DZI_TEMPLATE % {
+                'tile_size': tile_size,
+                'format': TILE_FORMAT,
+                'width': width,
+                'height': height
+            }
+        )
+
+    os.replace(f.name, dzi_path(sha1))
+
+    return True
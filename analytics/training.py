@@ -0,0 +1,326 @@
+"""
+Model training for image sets. Training is slow for large image sets, so it
+runs outside of the request/response cycle: the API queues a TrainingJob and
+the run_training_worker management command picks it up.
+"""
+from analytics import models, caches, features, feature_store
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections
+from django.db.models import Count, Q
+from django.utils import timezone
+from lung_map_utils import utils
+import datetime
+import hashlib
+import os
+import pickle
+import traceback
+
+# a running job without a heartbeat for this long belongs to a worker that
+# died or was restarted. Heartbeats come with each image's features, so this
+# must also cover fitting the pipeline.
+TRAINING_JOB_STALE_SECONDS = getattr(settings, 'TRAINING_JOB_STALE_SECONDS', 2 * 60 * 60)
+
+
+def validate_training_data(image_set):
+    """
+    Checks an image set has enough labelled sub-regions to train a model
+    :param image_set: analytics.models.ImageSet instance
+    :raises ValueError: if the training data is insufficient
+    """
+    subregions = models.Subregion.objects.filter(image__image_set=image_set)\
+        .values('anatomy__name') \
+        .annotate(total=Count('anatomy__name')) \
+        .order_by('anatomy__name')
+
+    if len(subregions) <= 1:
+        raise ValueError(
+            """
+            More than 1 anatomical structure is needed to train a model. Please
+            continue to create training data by segmenting new anatomical structures.
+            Once complete, a trained model can be created.
+            """
+        )
+
+    for sub in subregions:
+        if sub['total'] < 4:
+            raise ValueError(
+                """
+                In order to train a model, we require that each imageset have
+                at least 4 subregions for each anatomical structure. It seems
+                that within this imageset, the anatomical structure %s has
+                only %s subregion(s). Please either delete this subregion or
+                continue to build training data for this structure.
+                """ % (sub['anatomy__name'], str(sub['total']))
+            )
+
+
+def get_training_images(image_set):
+    """
+    Images in the image set that have at least one sub-region
+    """
+    return image_set.image_set\
+        .annotate(subregion_count=Count('subregion'))\
+        .filter(subregion_count__gt=0)\
+        .prefetch_related('subregion_set')
+
+
+def _get_worker_count():
+    workers = getattr(settings, 'TRAINING_WORKERS', None)
+
+    return workers or os.cpu_count() or 1
+
+
+def _extract_image_features_task(task):
+    # unpack arguments in the worker process. Training reads each image once,
+    # so the HSV caches would only cost each worker memory & disk writes.
+    return features.extract_image_features(*task, cached=False)
+
+
+def extract_training_features(tasks, workers=None, progress_callback=None):
+    """
+    Extract features for many images, one process pool task per image
+    :param tasks: list of (sha1, image path, [(polygon, label), ...]) tuples
+    :param workers: number of worker processes, defaults to TRAINING_WORKERS
+    :param progress_callback: optional callable, called with the number of
+        images processed so far after each image completes
+    :return: list of (column names, rows) tuples in the same order as tasks,
+        see features.extract_image_features
+    """
+    workers = min(workers or _get_worker_count(), max(len(tasks), 1))
+    results = [None] * len(tasks)
+
+    def collect(completed):
+        for images_processed, (index, result) in enumerate(completed, start=1):
+            results[index] = result
+
+            if progress_callback is not None:
+                progress_callback(images_processed)
+
+    if workers == 1:
+        collect((i, _extract_image_features_task(task)) for i, task in enumerate(tasks))
+
+        return results
+
+    # worker processes are forked & must not share the parent's DB connections
+    connections.close_all()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_extract_image_features_task, task): i
+            for i, task in enumerate(tasks)
+        }
+        collect((futures[f], f.result()) for f in as_completed(futures))
+
+    return results
+
+
+def get_training_data(image_set, progress_callback=None):
+    """
+    Build the training DataFrame for an image set. Features are read from the
+    feature store where still current & only computed for the remaining
+    sub-regions, which are then added to the store.
+    :param image_set: analytics.models.ImageSet instance
+    :param progress_callback: optional callable, called with the number of
+        images processed so far
+    :return: pandas DataFrame with one row per sub-region & a 'label' column
+    """
+    images = get_training_images(image_set).prefetch_related('subregion_set__anatomy')
+    stored = feature_store.get_stored_features(
+        models.Subregion.objects.filter(image__image_set=image_set).values_list('id', flat=True)
+    )
+
+    cached_rows = []  # (feature dict, label) tuples
+    tasks = []
+    task_subregions = []
+
+    for image in images:
+        polygons = []
+        subregions = []
+
+        for subregion in image.subregion_set.all():
+            polygon = subregion.get_polygon()
+            stored_features = stored.get(subregion.id)
+
+            if feature_store.is_current(stored_features, polygon, image.image_orig_sha1):
+                cached_rows.append(
+                    (feature_store.load_features(stored_features), subregion.anatomy.name)
+                )
+            else:
+                polygons.append((polygon, subregion.anatomy.name))
+                subregions.append(subregion)
+
+        if len(polygons) > 0:
+            tasks.append((image.image_orig_sha1, image.image_orig.path, polygons))
+            task_subregions.append(subregions)
+
+    # images whose features were all in the store count as already processed
+    images_cached = len(images) - len(tasks)
+
+    def task_progress(images_processed):
+        if progress_callback is not None:
+            progress_callback(images_cached + images_processed)
+
+    task_progress(0)
+    results = extract_training_features(tasks, progress_callback=task_progress)
+
+    columns = None
+    rows = []
+    new_features = []
+
+    for (sha1, path, polygons), subregions, (image_columns, image_rows) in zip(
+            tasks, task_subregions, results):
+        if columns is None:
+            columns = image_columns
+        elif image_columns != columns:
+            raise ValueError("Inconsistent feature columns across images")
+
+        rows.extend(image_rows)
+        new_features.extend(
+            (s.id, polygon, sha1, dict(zip(columns[:-1], row[:-1])))
+            for s, (polygon, label), row in zip(subregions, polygons, image_rows)
+        )
+
+    if columns is None and len(cached_rows) > 0:
+        columns = tuple(sorted(cached_rows[0][0])) + ('label',)
+
+    for feature_values, label in cached_rows:
+        rows.append(tuple(feature_values[c] for c in columns[:-1]) + (label,))
+
+    feature_store.save_features(new_features)
+
+    return features.rows_to_data_frame(columns, rows)
+
+
+def train_image_set(image_set, progress_callback=None):
+    """
+    Extracts features for every sub-region in the image set, fits the
+    classification pipeline and saves it as a TrainedModel
+    :param image_set: analytics.models.ImageSet instance
+    :param progress_callback: optional callable, called with the number of
+        images processed so far after each image
+    :return: the new analytics.models.TrainedModel instance
+    """
+    validate_training_data(image_set)
+
+    training_data = get_training_data(image_set, progress_callback=progress_callback)
+
+    pipe = utils.pipeline
+    pipe.fit(training_data.drop('label', axis=1), training_data['label'])
+
+    content = pickle.dumps(pipe)
+    pickled_model = ContentFile(content)
+    pickled_model.name = image_set.image_set_name + '.pkl'
+
+    trained_model = models.TrainedModel(
+        imageset=image_set,
+        model_object=pickled_model,
+        model_object_sha1=hashlib.sha1(content).hexdigest()
+    )
+    trained_model.save()
+    caches.invalidate_trained_model(trained_model.id)
+
+    return trained_model
+
+
+def fail_stale_jobs():
+    """
+    Fail running jobs whose worker has stopped sending heartbeats, so their
+    image sets can be trained again. They aren't re-queued, a job that kills
+    its worker would otherwise do so over & over.
+    :return: number of jobs failed
+    """
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=TRAINING_JOB_STALE_SECONDS)
+
+    return models.TrainingJob.objects.filter(
+        Q(heartbeat__lt=stale) | Q(heartbeat__isnull=True, started__lt=stale),
+        status=models.TrainingJob.STATUS_RUNNING
+    ).update(
+        status=models.TrainingJob.STATUS_FAILED,
+        detail="The worker stopped before the job finished, please train again",
+        finished=now
+    )
+
+
+def queue_training_job(image_set, user=None):
+    """
+    Validates the image set & queues a job to train it
+    :param image_set: analytics.models.ImageSet instance
+    :param user: the django User requesting the training
+    :return: the new analytics.models.TrainingJob instance
+    :raises ValueError: if the image set cannot be trained
+    """
+    if hasattr(image_set, 'trainedmodel'):
+        raise ValueError("Image set is already trained")
+
+    fail_stale_jobs()
+
+    if models.TrainingJob.objects.filter(
+        imageset=image_set,
+        status__in=models.TrainingJob.ACTIVE_STATUSES
+    ).exists():
+        raise ValueError("Image set is already being trained")
+
+    validate_training_data(image_set)
+
+    return models.TrainingJob.objects.create(
+        imageset=image_set,
+        user=user,
+        images_total=get_training_images(image_set).count()
+    )
+
+
+def claim_next_job():
+    """
+    Claim the oldest queued training job. The status change is a conditional
+    UPDATE, so when several workers race for the same job only one wins.
+    :return: the claimed TrainingJob, or None if the queue is empty
+    """
+    fail_stale_jobs()
+
+    queued = models.TrainingJob.objects.filter(status=models.TrainingJob.STATUS_QUEUED)
+
+    for job in queued.order_by('created')[:10]:
+        claimed = models.TrainingJob.objects.filter(
+            id=job.id,
+            status=models.TrainingJob.STATUS_QUEUED
+        ).update(
+            status=models.TrainingJob.STATUS_RUNNING,
+            started=timezone.now(),
+            heartbeat=timezone.now()
+        )
+
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+    return None
+
+
+def run_training_job(job):
+    """
+    Trains the job's image set, recording progress & the outcome on the job
+    :param job: a claimed (i.e. running) analytics.models.TrainingJob
+    """
+    def update_progress(images_processed):
+        models.TrainingJob.objects.filter(id=job.id).update(
+            images_processed=images_processed,
+            heartbeat=timezone.now()
+        )
+
+    try:
+        trained_model = train_image_set(job.imageset, progress_callback=update_progress)
+    except Exception as e:
+        job.status = models.TrainingJob.STATUS_FAILED
+        job.detail = str(e).strip() or traceback.format_exc()
+    else:
+        job.status = models.TrainingJob.STATUS_COMPLETE
+        job.trained_model = trained_model
+        job.images_processed = job.images_total
+
+    job.finished = timezone.now()
+    job.save(
+        update_fields=['status', 'detail', 'trained_model', 'images_processed', 'finished']
+    )
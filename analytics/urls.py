@@ -11,12 +11,33 @@ urlpatterns = [
     url(r'^api/images/$', api_views.ImageList.as_view()),
     url(r'^api/images/(?P<pk>[0-9]+)/$', api_views.ImageDetail.as_view()),
     url(r'^api/images-jpeg/(?P<pk>[0-9]+)/$', api_views.get_image_jpeg, name='images-jpeg'),
+    url(
+        r'^api/images/(?P<pk>[0-9]+)/(?P<size>thumbnail|medium|full)\.(?P<image_format>jpg|webp)$',
+        api_views.get_image_rendition,
+        name='images-rendition'
+    ),
+    url(r'^api/tiles/(?P<sha1>[0-9a-f]{40})\.dzi$', api_views.get_image_dzi),
+    url(
+        r'^api/tiles/(?P<sha1>[0-9a-f]{40})_files/(?P<level>[0-9]+)/(?P<col>[0-9]+)_(?P<row>[0-9]+)\.jpg$',
+        api_views.get_image_tile
+    ),
     url(r'^api/subregions/$', api_views.SubregionList.as_view()),
+    url(r'^api/subregions/intersecting/$', api_views.SubregionIntersecting.as_view()),
     url(r'^api/subregions/(?P<pk>[0-9]+)/$', api_views.SubregionDetail.as_view()),
     url(r'^api/image-sets/$', api_views.ImageSetList.as_view()),
     url(r'^api/image-sets/(?P<pk>[0-9]+)/$', api_views.ImageSetDetail.as_view()),
     url(r'^api/anatomy-probe-map/$', api_views.AnatomyProbeMapList.as_view()),
     url(r'^api/train-model/$', api_views.TrainedModelCreate.as_view()),
     url(r'^api/train-model/(?P<pk>[0-9]+)/$', api_views.TrainedModelDetail.as_view()),
-    url(r'^api/classify/$', api_views.ClassifySubRegion.as_view())
+    url(r'^api/train-model/jobs/$', api_views.TrainingJobList.as_view()),
+    url(r'^api/train-model/jobs/(?P<pk>[0-9]+)/$', api_views.TrainingJobDetail.as_view()),
+    url(r'^api/classify/$', api_views.ClassifySubRegion.as_view()),
+    url(r'^api/classify/batch/$', api_views.ClassifySubRegionBatch.as_view()),
+    url(r'^api/classify/results/$', api_views.ClassificationResultList.as_view()),
+    url(r'^api/classify/image/$', api_views.ClassificationJobCreate.as_view()),
+    url(r'^api/classify/image/jobs/$', api_views.ClassificationJobList.as_view()),
+    url(
+        r'^api/classify/image/jobs/(?P<pk>[0-9]+)/$',
+        api_views.ClassificationJobDetail.as_view()
+    )
 ]
@@ -159,3 +159,68 @@ USE_TZ = True
 
 MEDIA_ROOT = BASE_DIR + '/media/'
 MEDIA_URL = '/media/'
+
+# Number of un-pickled trained models each worker process keeps in memory
+# for classification, and how to evict them once full ('lru' or 'fifo')
+TRAINED_MODEL_CACHE_SIZE = int(os.environ.get('TRAINED_MODEL_CACHE_SIZE', 4))
+TRAINED_MODEL_CACHE_POLICY = os.environ.get('TRAINED_MODEL_CACHE_POLICY', 'lru')
+
+# Decoded HSV rasters used for training & classification are cached in each
+# worker's memory up to this many bytes, and as memory-mapped .npy files
+# shared by all workers
+HSV_IMAGE_CACHE_BYTES = int(os.environ.get('HSV_IMAGE_CACHE_BYTES', 512 * 1024 * 1024))
+HSV_IMAGE_CACHE_ROOT = os.path.join(MEDIA_ROOT, 'hsv_cache')
+
+# Number of processes used to extract features when training a model,
+# defaults to the number of CPU cores
+TRAINING_WORKERS = int(os.environ.get('TRAINING_WORKERS', os.cpu_count() or 1))
+
+# A training job running this long without progress is assumed to belong to
+# a dead worker & failed, so the image set can be trained again
+TRAINING_JOB_STALE_SECONDS = int(os.environ.get('TRAINING_JOB_STALE_SECONDS', 2 * 60 * 60))
+
+# Images are downloaded from LungMap in the background by the prefetch_images
+# command, at most IMAGE_FETCH_CONCURRENCY at a time. Failed downloads are
+# retried with exponential backoff starting at IMAGE_FETCH_BACKOFF_SECONDS
+IMAGE_FETCH_CONCURRENCY = int(os.environ.get('IMAGE_FETCH_CONCURRENCY', 4))
+IMAGE_FETCH_MAX_ATTEMPTS = int(os.environ.get('IMAGE_FETCH_MAX_ATTEMPTS', 5))
+IMAGE_FETCH_BACKOFF_SECONDS = int(os.environ.get('IMAGE_FETCH_BACKOFF_SECONDS', 30))
+
+# Set IMAGE_SENDFILE_MODE to 'x-accel' when running behind the nginx config
+# in nginx_conf, image files are then sent by nginx instead of Django
+IMAGE_SENDFILE_MODE = os.environ.get('IMAGE_SENDFILE_MODE')
+IMAGE_X_ACCEL_PREFIX = '/protected-media/'
+
+# Deep zoom tile pyramids for the image viewer, generated when images are downloaded
+IMAGE_TILE_ROOT = os.path.join(MEDIA_ROOT, 'tiles')
+IMAGE_TILE_SIZE = int(os.environ.get('IMAGE_TILE_SIZE', 256))
+
+# Thumbnail, medium & WebP renditions, generated when images are downloaded
+IMAGE_RENDITION_ROOT = os.path.join(MEDIA_ROOT, 'renditions')
+
+# Whole images are classified a tile at a time, each read with a margin
+# so regions crossing tile edges are found whole. Candidate regions are
+# scored CLASSIFICATION_BATCH_SIZE at a time
+CLASSIFICATION_TILE_SIZE = int(os.environ.get('CLASSIFICATION_TILE_SIZE', 2048))
+CLASSIFICATION_TILE_MARGIN = int(os.environ.get('CLASSIFICATION_TILE_MARGIN', 256))
+CLASSIFICATION_BATCH_SIZE = int(os.environ.get('CLASSIFICATION_BATCH_SIZE', 256))
+
+# A classification job running this long without finishing a tile is assumed
+# to belong to a dead worker & failed, so the image can be classified again
+CLASSIFICATION_JOB_STALE_SECONDS = int(
+    os.environ.get('CLASSIFICATION_JOB_STALE_SECONDS', 60 * 60)
+)
+
+# Features are extracted from each polygon's bounding box plus this margin
+# (in pixels) rather than the whole image
+FEATURE_CROP_MARGIN = int(os.environ.get('FEATURE_CROP_MARGIN', 16))
+
+# A new sub-region overlapping another one on its image by more than this
+# intersection over union is rejected as a duplicate
+SUBREGION_DUPLICATE_IOU = float(os.environ.get('SUBREGION_DUPLICATE_IOU', 0.9))
+
+# LungMap SPARQL responses are cached on disk when importing image sets,
+# and re-fetched once older than LUNGMAP_SPARQL_CACHE_TTL seconds. The list of
+# experiments is always fetched, so new experiments are seen straight away.
+LUNGMAP_SPARQL_CACHE_ROOT = os.path.join(BASE_DIR, 'sparql_cache')
+LUNGMAP_SPARQL_CACHE_TTL = int(os.environ.get('LUNGMAP_SPARQL_CACHE_TTL', 24 * 60 * 60))
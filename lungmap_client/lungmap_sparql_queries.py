@@ -47,3 +47,17 @@ WHERE {
     ?probe_id rdfs:label ?probe_label
 }
 """
+
+
+# Variants of the above taking many experiments in one VALUES block, the
+# EXPERIMENTS_PLACEHOLDER is replaced by space separated lm:<experiment_id>
+# terms. Result rows carry the experiment so they can be split back out.
+GET_IMAGES_BY_EXPERIMENTS = GET_IMAGES_BY_EXPERIMENT.replace(
+    'lm:EXPERIMENT_PLACEHOLDER',
+    'EXPERIMENTS_PLACEHOLDER'
+)
+
+GET_PROBE_BY_EXPERIMENTS = GET_PROBE_BY_EXPERIMENT.replace(
+    'lm:EXPERIMENT_PLACEHOLDER',
+    'EXPERIMENTS_PLACEHOLDER'
+)
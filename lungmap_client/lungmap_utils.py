@@ -1,31 +1,213 @@
 # noinspection PyPackageRequirements
 import cv2
-from django.core.files.uploadedfile import SimpleUploadedFile
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.uploadedfile import InMemoryUploadedFile
 from io import BytesIO
 from lungmap_client import lungmap_sparql_queries as sparql_queries
-from SPARQLWrapper import SPARQLWrapper, JSON
 import hashlib
+import numpy as np
 import os
-# noinspection PyPackageRequirements
-from PIL import Image
+from requests.adapters import HTTPAdapter
 import requests
 import tempfile
-import gzip
+import json
+import threading
+import time
+import zlib
 
 
 lungmap_sparql_server = "http://data.lungmap.net/sparql"
 
+# defaults for crawling the LM mothership, kept modest to be a good citizen
+CRAWL_MAX_WORKERS = 8
+CRAWL_REQUESTS_PER_SECOND = 10
+# number of experiments queried per SPARQL request
+CRAWL_CHUNK_SIZE = 25
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() across threads so that no more than
+    requests_per_second pass through. A falsy rate disables limiting.
+    """
+
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SparqlResponseCache(object):
+    """
+    Content-addressed on-disk cache of SPARQL result bindings. Entries are
+    keyed by the SHA1 of the normalized query text (whitespace collapsed)
+    and expire ttl seconds after being written.
+    """
+
+    def __init__(self, directory, ttl=24 * 60 * 60):
+        self.directory = directory
+        self.ttl = ttl
+
+    @staticmethod
+    def key(query):
+        normalized = ' '.join(query.split())
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+    def _path(self, query):
+        key = self.key(query)
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, query):
+        """
+        :return: the cached bindings, or None if missing or expired
+        """
+        path = self._path(query)
+
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, query, bindings):
+        path = self._path(query)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # write to a temp file & rename so readers never see a partial file
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.json', delete=False) as f:
+            json.dump(bindings, f)
+
+        os.replace(f.name, path)
+
+
+class SparqlClient(object):
+    """
+    Thread-safe SPARQL client re-using pooled HTTP connections to the
+    endpoint, optionally rate limited & backed by a SparqlResponseCache
+    """
+
+    def __init__(self, endpoint=None, max_connections=CRAWL_MAX_WORKERS,
+                 requests_per_second=None, timeout=60, cache=None):
+        self.endpoint = endpoint or lungmap_sparql_server
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_connections,
+            max_retries=3
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def query(self, query, use_cache=True):
+        """
+        Run a query & return the result bindings
+        :param query: SPARQL query string
+        :param use_cache: whether the response may be read from & stored in
+            the cache. Pass False for queries that must always be current.
+        :return: list of binding dicts
+        """
+        if self.cache is not None and use_cache:
+            bindings = self.cache.get(query)
+
+            if bindings is not None:
+                return bindings
+
+        self.rate_limiter.wait()
+
+        response = self.session.get(
+            self.endpoint,
+            params={'query': query, 'format': 'json'},
+            headers={'Accept': 'application/sparql-results+json'},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        bindings = response.json()['results']['bindings']
+
+        if self.cache is not None and use_cache:
+            self.cache.set(query, bindings)
+
+        return bindings
+
+    def close(self):
+        self.session.close()
+
+
+def _crawl_experiments(client, experiment_ids):
+    probes = get_probes_by_experiments(experiment_ids, client=client)
+    images = get_images_by_experiments(experiment_ids, client=client)
 
-def get_image_set_candidates():
-    sparql = SPARQLWrapper(lungmap_sparql_server)
-    sparql.setQuery(sparql_queries.GET_BASIC_EXPERIMENTS)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
+    return [(probes[e_id], images[e_id]) for e_id in experiment_ids]
+
+
+def get_image_set_candidates(client=None, max_workers=CRAWL_MAX_WORKERS,
+                             requests_per_second=CRAWL_REQUESTS_PER_SECOND,
+                             chunk_size=CRAWL_CHUNK_SIZE, exclude_experiment_ids=None):
+    """
+    Crawl the LM mothership for experiments & their probes and images,
+    grouping the images into image set candidates. Experiments are queried
+    in chunks, and the chunks crawled concurrently by a bounded thread pool
+    sharing one connection pool.
+    :param client: optional SparqlClient, by default one is created for the
+        LM SPARQL server using max_workers & requests_per_second
+    :param max_workers: number of chunks to crawl concurrently
+    :param requests_per_second: limit on SPARQL requests, None for no limit
+    :param chunk_size: number of experiments per SPARQL query
+    :param exclude_experiment_ids: optional collection of experiment ids to
+        skip, e.g. those already imported, for an incremental sync
+    :return: dict of image set name -> image set candidate
+    """
+    own_client = client is None
+
+    if own_client:
+        client = SparqlClient(
+            max_connections=max_workers,
+            requests_per_second=requests_per_second
+        )
+
+    try:
+        return _get_image_set_candidates(
+            client,
+            max_workers,
+            chunk_size,
+            set(exclude_experiment_ids or ())
+        )
+    finally:
+        if own_client:
+            client.close()
+
+
+def _get_image_set_candidates(client, max_workers, chunk_size, exclude_experiment_ids):
+    # the experiment list is never cached, else new experiments wouldn't be
+    # seen until the cached list expires
+    results = client.query(sparql_queries.GET_BASIC_EXPERIMENTS, use_cache=False)
 
     experiments = {}
-    for r in results['results']['bindings']:
+    for r in results:
         e_id = r['experiment_id']['value'].split('#')[1]
 
+        if e_id in exclude_experiment_ids:
+            continue
+
         if e_id in experiments.keys():
             # looks like there are some experiments with multiple development stage strings
             print('Duplicate experiment %s' % e_id)
@@ -44,16 +226,21 @@ def get_image_set_candidates():
         }
 
     images = []
-
-    for e_id, e in experiments.items():
-        e_probes = get_probes_by_experiment(experiment_id=e_id)
-
-        # very important to sort probes by probe label to make sure the string is consistent
-        # in order to combine images from experiments with the same probe / color combos
-        e['probes'] = sorted(e_probes, key=lambda k: k['probe_label'])
-
-        e_images = get_images_by_experiment(e_id)
-        images.extend(e_images)
+    experiment_ids = sorted(experiments.keys())
+    chunks = [
+        experiment_ids[i:i + chunk_size] for i in range(0, len(experiment_ids), chunk_size)
+    ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        crawled = executor.map(lambda chunk: _crawl_experiments(client, chunk), chunks)
+
+        for e_id, (e_probes, e_images) in zip(
+                experiment_ids,
+                (result for chunk_results in crawled for result in chunk_results)):
+            # very important to sort probes by probe label to make sure the string is consistent
+            # in order to combine images from experiments with the same probe / color combos
+            experiments[e_id]['probes'] = sorted(e_probes, key=lambda k: k['probe_label'])
+            images.extend(e_images)
 
     image_sets = {}
 
@@ -109,135 +296,244 @@ def get_image_set_candidates():
     return image_sets
 
 
-def _get_by_experiment(query, experiment_id):
+def _get_by_experiment(query, experiment_id, client=None):
     """
     Query LM mothership (via SPARQL) and get information by a given 
     experiment_id for a particular experiment
     :param query: a predefined query string from lungmap_client that 
     has the replacement string EXPERIMENT_PLACEHOLDER
     :param experiment_id: valid experiment_id from lungmap
+    :param client: optional SparqlClient to re-use
+    :return:
+    """
+    query_sub = query.replace('EXPERIMENT_PLACEHOLDER', experiment_id)
+
+    if client is not None:
+        return client.query(query_sub)
+
+    client = SparqlClient(max_connections=1)
+
+    try:
+        return client.query(query_sub)
+    finally:
+        client.close()
+
+
+def _get_by_experiments(query, experiment_ids, client=None):
+    """
+    Query LM mothership (via SPARQL) for many experiments in a single request
+    :param query: a predefined query string from lungmap_client that
+    has the replacement string EXPERIMENTS_PLACEHOLDER
+    :param experiment_ids: list of valid experiment_ids from lungmap
+    :param client: optional SparqlClient to re-use
     :return:
     """
+    values = ' '.join('lm:%s' % e_id for e_id in experiment_ids)
+    query_sub = query.replace('EXPERIMENTS_PLACEHOLDER', values)
+
+    if client is not None:
+        return client.query(query_sub)
+
+    client = SparqlClient(max_connections=1)
+
     try:
-        query_sub = query.replace('EXPERIMENT_PLACEHOLDER', experiment_id)
-        sparql = SPARQLWrapper(lungmap_sparql_server)
-        sparql.setQuery(query_sub)
-        sparql.setReturnFormat(JSON)
-        results = sparql.query().convert()
-        return results['results']['bindings']
-    except ValueError as e:
-        raise e
+        return client.query(query_sub)
+    finally:
+        client.close()
 
 
-def get_images_by_experiment(experiment_id):
+def _parse_image_row(x, experiment_id):
+    return {
+        # files in BREATH DB are gzipped TIFF files
+        'image_name': os.path.basename(x['image_file_path']['value']).rsplit('.', 1)[0],
+        'image_id': x['dir']['value'],
+        'source_url': x['image_file_path']['value'],
+        'experiment_id': experiment_id,
+        'experiment_type_id': x['experiment_type']['value'],
+        'magnification': x['magnification']['value'],
+        'x_scaling': x['x_scaling']['value'],
+        'y_scaling': x['y_scaling']['value']
+    }
+
+
+def _parse_probe_row(x):
+    return {
+        'color': x['color']['value'],
+        'probe_label': x['probe_label']['value']
+    }
+
+
+def get_images_by_experiment(experiment_id, client=None):
     results = _get_by_experiment(
         sparql_queries.GET_IMAGES_BY_EXPERIMENT,
-        experiment_id
+        experiment_id,
+        client=client
     )
-    output = []
-    try:
-        for x in results:
-            row = {}
-            # files in BREATH DB are gzipped TIFF files
-            row['image_name'] = os.path.basename(x['image_file_path']['value']).rsplit('.', 1)[0]
-            row['image_id'] = x['dir']['value']
-            row['source_url'] = x['image_file_path']['value']
-            row['experiment_id'] = experiment_id
-            row['experiment_type_id'] = x['experiment_type']['value']
-            row['magnification'] = x['magnification']['value']
-            row['x_scaling'] = x['x_scaling']['value']
-            row['y_scaling'] = x['y_scaling']['value']
-            output.append(row)
-        return output
-    except ValueError as e:
-        raise e
-
-
-def get_probes_by_experiment(experiment_id):
+
+    return [_parse_image_row(x, experiment_id) for x in results]
+
+
+def get_probes_by_experiment(experiment_id, client=None):
     results = _get_by_experiment(
         sparql_queries.GET_PROBE_BY_EXPERIMENT,
-        experiment_id
+        experiment_id,
+        client=client
     )
-    output = []
-    try:
-        for x in results:
-            row = {
-                'color': x['color']['value'],
-                'probe_label': x['probe_label']['value']
-            }
-            output.append(row)
-        return output
-    except ValueError as e:
-        raise e
+
+    return [_parse_probe_row(x) for x in results]
 
 
-def get_image_from_lungmap(url):
+def get_images_by_experiments(experiment_ids, client=None):
     """
-    Takes a URL and downloads the image, calculates a SHA1,
-    creates a SimpleUploadedFile, converts to jpeg
-    and then creates another SimpleUploadedFile for the jpeg, 
-    returns 3 objects
-    :param url:
-    :return: SimpleUploadedFile (orig), SHA1 Hash (orig), 
-    SimpleUploadedFile (jpeg converted)
+    Batched equivalent of get_images_by_experiment
+    :return: dict of experiment_id -> list of image dicts
     """
-    try:
-        filename = url.split('/')[-1]
-        base, ext = os.path.splitext(filename)
+    results = _get_by_experiments(
+        sparql_queries.GET_IMAGES_BY_EXPERIMENTS,
+        experiment_ids,
+        client=client
+    )
+    output = {e_id: [] for e_id in experiment_ids}
 
-        # TODO: check response, if not successful we cannot proceed
-        response = requests.get(url, stream=True)
+    for x in results:
+        # the query selects the experiment id itself, not the URI
+        e_id = x['experiment']['value']
+        output[e_id].append(_parse_image_row(x, e_id))
 
-        with tempfile.NamedTemporaryFile(suffix=ext) as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                f.write(chunk)
+    return output
 
-            f.seek(0)
 
-            with gzip.GzipFile(mode='rb', fileobj=f) as f2:
-                tiff_data = f2.read()
+def get_probes_by_experiments(experiment_ids, client=None):
+    """
+    Batched equivalent of get_probes_by_experiment
+    :return: dict of experiment_id -> list of probe dicts
+    """
+    results = _get_by_experiments(
+        sparql_queries.GET_PROBE_BY_EXPERIMENTS,
+        experiment_ids,
+        client=client
+    )
+    output = {e_id: [] for e_id in experiment_ids}
 
-            f2.close()
+    for x in results:
+        e_id = x['experiment_id']['value'].split('#')[1]
+        output[e_id].append(_parse_probe_row(x))
 
-            with open(f.name[:-3], 'wb') as f3:
-                f3.write(tiff_data)
+    return output
 
-                # noinspection PyUnresolvedReferences
-                cv_img = cv2.imread(f3.name)
 
-        response.close()
-        os.remove(f3.name)
+GZIP_MAGIC = b'\x1f\x8b'
+IMAGE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# matches the PIL default the JPEGs were previously encoded with
+JPEG_QUALITY = 75
+
+
+def decode_lungmap_image(chunks, filename, on_decoded=None):
+    """
+    Decodes a (usually gzipped) TIFF from LungMap as it arrives. The gzip
+    stream is decompressed & hashed chunk by chunk into a single in-memory
+    buffer, which is decoded once and re-used as the stored TIFF, so the
+    raster is never written to disk or re-encoded as a TIFF.
+    :param chunks: iterable of bytes, e.g. response.iter_content()
+    :param filename: name of the source file, e.g. 'image.tif.gz'
+    :param on_decoded: optional callable, called with the decoded BGR numpy
+        array so callers can derive further rasters without decoding again
+    :return: InMemoryUploadedFile (orig TIFF), SHA1 hash (orig TIFF),
+        InMemoryUploadedFile (JPEG)
+    """
+    base = filename[:-3] if filename.endswith('.gz') else filename
+    tiff_buffer = BytesIO()
+    sha1 = hashlib.sha1()
+    decompressor = None
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+
+        if decompressor is None:
+            # the server may have already decoded a gzip Content-Encoding
+            if chunk[:2] == GZIP_MAGIC:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                decompressor = False
+
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+
+        sha1.update(chunk)
+        tiff_buffer.write(chunk)
+
+    if decompressor:
+        tail = decompressor.flush()
+        sha1.update(tail)
+        tiff_buffer.write(tail)
 
+    view = tiff_buffer.getbuffer()
+
+    try:
         # noinspection PyUnresolvedReferences
-        img = Image.fromarray(
-            cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB),
-            'RGB'
-        )
-        img_jpeg = img.copy()
-        temp_handle = BytesIO()
-        img.save(temp_handle, 'TIFF')
-        temp_handle.seek(0)
-
-        # jpeg image
-        temp_handle_jpeg = BytesIO()
-        img_jpeg.save(temp_handle_jpeg, 'JPEG')
-        temp_handle_jpeg.seek(0)
-
-        # filename
-        suf = SimpleUploadedFile(
-            base,
-            temp_handle.read(),
-            content_type='image/tif'
-        )
-        suf_jpg = SimpleUploadedFile(
-            base.replace('.tif', '.jpg'),
-            temp_handle_jpeg.read(),
-            content_type='image/jpeg'
-        )
+        cv_img = cv2.imdecode(np.frombuffer(view, dtype=np.uint8), cv2.IMREAD_COLOR)
+    finally:
+        # the buffer can't be read as a file while the view is exported
+        view.release()
+
+    if cv_img is None:
+        raise ValueError("Could not decode image %s" % filename)
+
+    if on_decoded is not None:
+        on_decoded(cv_img)
+
+    # noinspection PyUnresolvedReferences
+    encoded, jpeg_data = cv2.imencode(
+        '.jpg',
+        cv_img,
+        [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+    )
+
+    if not encoded:
+        raise ValueError("Could not encode image %s as JPEG" % filename)
 
-        temp_handle.seek(0)
-        image_orig_sha1 = hashlib.sha1(temp_handle.read()).hexdigest()
+    tiff_size = tiff_buffer.tell()
+    tiff_buffer.seek(0)
 
-        return suf, image_orig_sha1, suf_jpg
-    except ValueError as e:
-        raise e
+    suf = InMemoryUploadedFile(
+        tiff_buffer,
+        None,
+        base,
+        'image/tif',
+        tiff_size,
+        None
+    )
+    suf_jpg = InMemoryUploadedFile(
+        BytesIO(jpeg_data.tobytes()),
+        None,
+        base.replace('.tif', '.jpg'),
+        'image/jpeg',
+        jpeg_data.size,
+        None
+    )
+
+    return suf, sha1.hexdigest(), suf_jpg
+
+
+def get_image_from_lungmap(url, on_decoded=None):
+    """
+    Takes a URL and streams the image, calculating a SHA1 & converting it
+    to a JPEG along the way, see decode_lungmap_image
+    :param url:
+    :param on_decoded: see decode_lungmap_image
+    :return: InMemoryUploadedFile (orig), SHA1 Hash (orig),
+    InMemoryUploadedFile (jpeg converted)
+    """
+    response = requests.get(url, stream=True)
+
+    try:
+        response.raise_for_status()
+
+        return decode_lungmap_image(
+            response.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_SIZE),
+            url.split('/')[-1],
+            on_decoded=on_decoded
+        )
+    finally:
+        response.close()
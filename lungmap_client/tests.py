@@ -0,0 +1,308 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from lungmap_client import lungmap_utils
+from socketserver import ThreadingMixIn
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+import gzip
+import hashlib
+import json
+import numpy as np
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+# noinspection PyPackageRequirements
+import cv2
+
+RECORDED_RESPONSES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'fixtures',
+    'sparql_responses.json'
+)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInSparqlEndpoint(object):
+    """
+    Local stand-in for the LM SPARQL endpoint serving recorded JSON. Answers
+    each query by the experiment ids in its VALUES clause, and records the
+    queries it receives & the peak number of concurrent requests.
+    """
+
+    def __init__(self, recorded_responses=RECORDED_RESPONSES):
+        with open(recorded_responses) as f:
+            self.responses = json.load(f)
+
+        self.queries = []
+        self.max_concurrent = 0
+        self._concurrent = 0
+        self._lock = threading.Lock()
+
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # noinspection PyPep8Naming
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)['query'][0]
+                body = json.dumps(endpoint.answer(query)).encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/sparql-results+json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/sparql' % self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+
+    def answer(self, query):
+        with self._lock:
+            self.queries.append(query)
+            self._concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self._concurrent)
+
+        try:
+            values = re.search(r'VALUES \?\w+ \{(.*?)\}', query, re.DOTALL).group(1)
+            experiment_ids = re.findall(r'lm:(\w+)', values)
+
+            if 'has_probe_color' in query:
+                recorded = self.responses['probes']
+            elif 'lmdb:directory' in query:
+                recorded = self.responses['images']
+            else:
+                return {'results': {'bindings': self.responses['experiments']}}
+
+            bindings = []
+            for e_id in experiment_ids:
+                bindings.extend(recorded.get(e_id, []))
+
+            # give concurrent requests a chance to overlap
+            threading.Event().wait(0.01)
+
+            return {'results': {'bindings': bindings}}
+        finally:
+            with self._lock:
+                self._concurrent -= 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _crawl(endpoint, max_workers, chunk_size=1):
+    client = lungmap_utils.SparqlClient(endpoint=endpoint.url, max_connections=max_workers)
+
+    try:
+        return lungmap_utils.get_image_set_candidates(
+            client=client,
+            max_workers=max_workers,
+            chunk_size=chunk_size
+        )
+    finally:
+        client.close()
+
+
+class ConcurrentCrawlTests(unittest.TestCase):
+    def test_crawl_groups_images_into_image_sets(self):
+        with StandInSparqlEndpoint() as endpoint:
+            image_sets = _crawl(endpoint, max_workers=4)
+
+        # 2 mouse experiments with the same probes & 1 human, each at 2 magnifications
+        self.assertEqual(len(image_sets), 4)
+        mouse_20x = image_sets['mus musculus_E16.5_20X_Anti-Acta2__red_Anti-Sftpc__green']
+        self.assertEqual(
+            sorted(i['image_id'] for i in mouse_20x['images']),
+            ['LMEX0000000001_000', 'LMEX0000000002_000']
+        )
+
+    def test_concurrent_crawl_matches_serial_crawl(self):
+        with StandInSparqlEndpoint() as endpoint:
+            serial = _crawl(endpoint, max_workers=1)
+
+        with StandInSparqlEndpoint() as endpoint:
+            concurrent = _crawl(endpoint, max_workers=4)
+            max_concurrent = endpoint.max_concurrent
+            query_count = len(endpoint.queries)
+
+        self.assertEqual(serial, concurrent)
+        self.assertGreater(max_concurrent, 1)
+        # the experiment list, then probes & images for each of the 3 experiments
+        self.assertEqual(query_count, 7)
+
+    def test_rate_limiter_spaces_requests(self):
+        limiter = lungmap_utils.RateLimiter(requests_per_second=100)
+        start = lungmap_utils.time.monotonic()
+
+        for _ in range(11):
+            limiter.wait()
+
+        self.assertGreaterEqual(lungmap_utils.time.monotonic() - start, 0.1)
+
+
+class BatchedQueryTests(unittest.TestCase):
+    experiment_ids = ['LMEX0000000001', 'LMEX0000000002', 'LMEX0000000003']
+
+    def test_batched_results_match_per_experiment_results(self):
+        with StandInSparqlEndpoint() as endpoint:
+            client = lungmap_utils.SparqlClient(endpoint=endpoint.url)
+            images = lungmap_utils.get_images_by_experiments(self.experiment_ids, client=client)
+            probes = lungmap_utils.get_probes_by_experiments(self.experiment_ids, client=client)
+
+            for e_id in self.experiment_ids:
+                self.assertEqual(
+                    images[e_id],
+                    lungmap_utils.get_images_by_experiment(e_id, client=client)
+                )
+                self.assertEqual(
+                    probes[e_id],
+                    lungmap_utils.get_probes_by_experiment(e_id, client=client)
+                )
+
+            client.close()
+
+    def test_own_clients_are_closed(self):
+        close = lungmap_utils.SparqlClient.close
+
+        with StandInSparqlEndpoint() as endpoint, \
+                mock.patch.object(lungmap_utils, 'lungmap_sparql_server', endpoint.url), \
+                mock.patch.object(
+                    lungmap_utils.SparqlClient, 'close', autospec=True, side_effect=close
+                ) as patched_close:
+            images = lungmap_utils.get_images_by_experiments(self.experiment_ids)
+            lungmap_utils.get_probes_by_experiment(self.experiment_ids[0])
+
+            self.assertEqual(patched_close.call_count, 2)
+
+            client = lungmap_utils.SparqlClient(endpoint=endpoint.url)
+            lungmap_utils.get_images_by_experiment(self.experiment_ids[0], client=client)
+
+            # a client passed in is left open for re-use
+            self.assertEqual(patched_close.call_count, 2)
+            client.close()
+
+        self.assertEqual(sorted(images), self.experiment_ids)
+
+    def test_chunked_crawl_matches_per_experiment_crawl(self):
+        with StandInSparqlEndpoint() as endpoint:
+            per_experiment = _crawl(endpoint, max_workers=2, chunk_size=1)
+
+        with StandInSparqlEndpoint() as endpoint:
+            chunked = _crawl(endpoint, max_workers=2, chunk_size=2)
+            query_count = len(endpoint.queries)
+
+        self.assertEqual(per_experiment, chunked)
+        # the experiment list, then probes & images for each of the 2 chunks
+        self.assertEqual(query_count, 5)
+
+
+class SparqlResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_repeat_queries_are_served_from_cache(self):
+        cache = lungmap_utils.SparqlResponseCache(self.cache_dir)
+
+        with StandInSparqlEndpoint() as endpoint:
+            client = lungmap_utils.SparqlClient(endpoint=endpoint.url, cache=cache)
+            first = lungmap_utils.get_probes_by_experiment('LMEX0000000001', client=client)
+            second = lungmap_utils.get_probes_by_experiment('LMEX0000000001', client=client)
+            client.close()
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(endpoint.queries), 1)
+
+    def test_key_ignores_whitespace(self):
+        self.assertEqual(
+            lungmap_utils.SparqlResponseCache.key('SELECT ?a\n  WHERE { ?a ?b ?c }'),
+            lungmap_utils.SparqlResponseCache.key('SELECT ?a WHERE {  ?a ?b ?c  }  ')
+        )
+
+    def test_expired_entries_are_ignored(self):
+        cache = lungmap_utils.SparqlResponseCache(self.cache_dir, ttl=-1)
+        cache.set('SELECT ?a WHERE { ?a ?b ?c }', [{'a': {'value': 1}}])
+
+        self.assertIsNone(cache.get('SELECT ?a WHERE { ?a ?b ?c }'))
+
+    def test_incremental_crawl_skips_known_experiments(self):
+        with StandInSparqlEndpoint() as endpoint:
+            client = lungmap_utils.SparqlClient(endpoint=endpoint.url)
+            image_sets = lungmap_utils.get_image_set_candidates(
+                client=client,
+                exclude_experiment_ids={'LMEX0000000001', 'LMEX0000000002'}
+            )
+            client.close()
+
+        self.assertEqual(
+            sorted(image_sets.keys()),
+            ['homo sapiens_D001_100X_Anti-Calca__white', 'homo sapiens_D001_20X_Anti-Calca__white']
+        )
+
+
+    def test_experiment_list_is_not_cached(self):
+        cache = lungmap_utils.SparqlResponseCache(self.cache_dir)
+        # a list cached before any experiments were published
+        cache.set(lungmap_utils.sparql_queries.GET_BASIC_EXPERIMENTS, [])
+
+        with StandInSparqlEndpoint() as endpoint:
+            client = lungmap_utils.SparqlClient(endpoint=endpoint.url, cache=cache)
+            image_sets = lungmap_utils.get_image_set_candidates(client=client)
+            client.close()
+
+        self.assertEqual(len(image_sets), 4)
+        self.assertEqual(cache.get(lungmap_utils.sparql_queries.GET_BASIC_EXPERIMENTS), [])
+
+
+class StreamingImageDecodeTests(unittest.TestCase):
+    def setUp(self):
+        self.bgr_image = np.random.RandomState(0).randint(0, 256, (64, 48, 3)).astype(np.uint8)
+        # noinspection PyUnresolvedReferences
+        self.tiff_data = cv2.imencode('.tiff', self.bgr_image)[1].tobytes()
+
+    @staticmethod
+    def chunked(data, size=1000):
+        return (data[i:i + size] for i in range(0, len(data), size))
+
+    def check(self, data):
+        suf, sha1, suf_jpg = lungmap_utils.decode_lungmap_image(
+            self.chunked(data),
+            'image_1.tif.gz'
+        )
+
+        self.assertEqual(suf.name, 'image_1.tif')
+        self.assertEqual(suf_jpg.name, 'image_1.jpg')
+        self.assertEqual(suf.read(), self.tiff_data)
+        self.assertEqual(sha1, hashlib.sha1(self.tiff_data).hexdigest())
+
+        # noinspection PyUnresolvedReferences
+        jpeg = cv2.imdecode(np.frombuffer(suf_jpg.read(), dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual(jpeg.shape, self.bgr_image.shape)
+
+    def test_gzipped(self):
+        self.check(gzip.compress(self.tiff_data))
+
+    def test_already_decompressed(self):
+        self.check(self.tiff_data)
+
+    def test_undecodable(self):
+        with self.assertRaises(ValueError):
+            lungmap_utils.decode_lungmap_image(
+                self.chunked(gzip.compress(b'not an image')),
+                'image_1.tif.gz'
+            )
@@ -1,4 +1,7 @@
 #!/bin/bash
 python manage.py collectstatic --noinput
+python manage.py run_training_worker &
+python manage.py run_classification_worker &
+python manage.py prefetch_images &
 gunicorn --bind unix:/ihc-image-analysis/lap.sock lap.wsgi:application &
-nginx -g "daemon off;"
\ No newline at end of file
+nginx -g "daemon off;"
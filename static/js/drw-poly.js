@@ -10,6 +10,7 @@ drw_polygon.directive('drwPolygon', [function () {
             height: '=',
             regions: '=',
             imgUrl: '=?',
+            dziUrl: '=?',
             enabled: '=?'
         },
         controller: function () {
@@ -38,20 +39,229 @@ drw_polygon.directive('drwPolygon', [function () {
                 .attr("width", scope.width + 'px')
                 .attr("height", scope.height + 'px');
 
-            scope.$watch('imgUrl', function() {
-                if (scope.imgUrl === null) {
-                    return;
-                }
+            var $tiles = $(element).find('.drw-tiles');
+            $tiles.css({'width': scope.width + 'px', 'height': scope.height + 'px'});
+
+            // The image is shown stretched to width x height "display" units,
+            // which is also the coordinate system of the SVG polygons. Zooming
+            // changes which part of it is visible via the SVG viewBox, with
+            // view.x & view.y the top left corner in display units.
+            var view = {
+                'zoom': 1.0,
+                'x': 0,
+                'y': 0
+            };
+            var max_zoom = 1.0;
 
-                image = new Image();
+            // The tile pyramid being displayed. When an image has no deep zoom
+            // tiles the full JPEG is shown as the single tile of a 1 level pyramid.
+            var pyramid = null;
+            var tile_elements = {};
 
-                scope.calc_img_scale = function () {
-                    img_scale.x = this.width / scope.width;
-                    img_scale.y = this.height / scope.height;
+            var to_display_coords = function (offset_x, offset_y) {
+                return {
+                    'x': view.x + offset_x / view.zoom,
+                    'y': view.y + offset_y / view.zoom
                 };
-                $(image).load(scope.calc_img_scale);
+            };
+
+            var set_pyramid = function (new_pyramid) {
+                pyramid = new_pyramid;
+                img_scale.x = pyramid.width / scope.width;
+                img_scale.y = pyramid.height / scope.height;
+
+                // allow zooming in until image pixels are twice their size on screen
+                max_zoom = Math.max(img_scale.x, img_scale.y, 0.5) * 2;
+
+                view.zoom = 1.0;
+                view.x = 0;
+                view.y = 0;
+
+                $tiles.empty();
+                tile_elements = {};
+                update_view();
+            };
+
+            var load_full_image = function () {
+                image = new Image();
+
+                $(image).load(function () {
+                    set_pyramid(
+                        {
+                            'width': this.width,
+                            'height': this.height,
+                            'tile_size': Math.max(this.width, this.height),
+                            'max_level': 0,
+                            'tile_url': function () {
+                                return scope.imgUrl;
+                            }
+                        }
+                    );
+                });
 
                 image.src = scope.imgUrl;
+            };
+
+            var load_dzi = function () {
+                var dzi_url = scope.dziUrl;
+
+                $.ajax({'url': dzi_url, 'dataType': 'xml'}).done(function (xml) {
+                    var $image = $(xml).find('Image');
+                    var $size = $image.find('Size');
+                    var width = parseInt($size.attr('Width'));
+                    var height = parseInt($size.attr('Height'));
+                    var format = $image.attr('Format');
+                    var tiles_url = dzi_url.replace(/\.dzi$/, '_files/');
+
+                    set_pyramid(
+                        {
+                            'width': width,
+                            'height': height,
+                            'tile_size': parseInt($image.attr('TileSize')),
+                            'max_level': Math.ceil(Math.log(Math.max(width, height, 1)) / Math.LN2),
+                            'tile_url': function (level, col, row) {
+                                return tiles_url + level + '/' + col + '_' + row + '.' + format;
+                            }
+                        }
+                    );
+                }).fail(load_full_image);
+            };
+
+            var show_level = function (level, keep) {
+                // pixels of this level per full resolution pixel
+                var level_scale = Math.pow(2, level - pyramid.max_level);
+                var level_width = Math.ceil(pyramid.width * level_scale);
+                var level_height = Math.ceil(pyramid.height * level_scale);
+                var tile_size = pyramid.tile_size;
+
+                // the visible part of the image in this level's pixels
+                var x0 = view.x * img_scale.x * level_scale;
+                var y0 = view.y * img_scale.y * level_scale;
+                var x1 = (view.x + scope.width / view.zoom) * img_scale.x * level_scale;
+                var y1 = (view.y + scope.height / view.zoom) * img_scale.y * level_scale;
+
+                var first_col = Math.max(Math.floor(x0 / tile_size), 0);
+                var first_row = Math.max(Math.floor(y0 / tile_size), 0);
+                var last_col = Math.min(Math.ceil(x1 / tile_size), Math.ceil(level_width / tile_size)) - 1;
+                var last_row = Math.min(Math.ceil(y1 / tile_size), Math.ceil(level_height / tile_size)) - 1;
+
+                for (var row = first_row; row <= last_row; row++) {
+                    for (var col = first_col; col <= last_col; col++) {
+                        var key = level + '/' + col + '_' + row;
+                        var tile = tile_elements[key];
+
+                        if (tile === undefined) {
+                            tile = $('<img>')
+                                .attr('src', pyramid.tile_url(level, col, row))
+                                .css({'position': 'absolute', 'z-index': level})
+                                .appendTo($tiles);
+                            tile_elements[key] = tile;
+                        }
+
+                        // tile extent in level pixels, the last row & column may be partial
+                        var left = col * tile_size;
+                        var top = row * tile_size;
+                        var right = Math.min(left + tile_size, level_width);
+                        var bottom = Math.min(top + tile_size, level_height);
+
+                        // ... mapped to screen pixels
+                        var to_screen_x = view.zoom / (img_scale.x * level_scale);
+                        var to_screen_y = view.zoom / (img_scale.y * level_scale);
+
+                        tile.css(
+                            {
+                                'left': (left * to_screen_x - view.x * view.zoom) + 'px',
+                                'top': (top * to_screen_y - view.y * view.zoom) + 'px',
+                                'width': ((right - left) * to_screen_x) + 'px',
+                                'height': ((bottom - top) * to_screen_y) + 'px'
+                            }
+                        );
+                        keep[key] = true;
+                    }
+                }
+            };
+
+            var update_view = function () {
+                $svg[0].setAttribute(
+                    'viewBox',
+                    [view.x, view.y, scope.width / view.zoom, scope.height / view.zoom].join(' ')
+                );
+
+                if (pyramid === null) {
+                    return;
+                }
+
+                // the level with at least one pixel per screen pixel
+                var screen_scale = Math.max(
+                    view.zoom / img_scale.x,
+                    view.zoom / img_scale.y
+                );
+                var level = pyramid.max_level + Math.ceil(Math.log(screen_scale) / Math.LN2);
+                level = Math.min(Math.max(level, 0), pyramid.max_level);
+
+                // the level that fits in a single tile is always drawn underneath,
+                // so there is something to see while the visible tiles load
+                var base_level = Math.min(
+                    Math.ceil(Math.log(Math.max(pyramid.width, pyramid.height) / pyramid.tile_size) / Math.LN2),
+                    pyramid.max_level
+                );
+                base_level = pyramid.max_level - Math.max(base_level, 0);
+
+                var keep = {};
+                show_level(base_level, keep);
+
+                if (level > base_level) {
+                    show_level(level, keep);
+                }
+
+                // drop tiles that are no longer visible
+                Object.keys(tile_elements).forEach(function (key) {
+                    if (!keep[key]) {
+                        tile_elements[key].remove();
+                        delete tile_elements[key];
+                    }
+                });
+            };
+
+            var zoom = function (evt) {
+                if (pyramid === null) {
+                    return;
+                }
+
+                var original = evt.originalEvent;
+                var factor = original.deltaY < 0 ? 1.25 : 0.8;
+                var new_zoom = Math.min(Math.max(view.zoom * factor, 1.0), max_zoom);
+                var offset = $svg.offset();
+                var offset_x = original.pageX - offset.left;
+                var offset_y = original.pageY - offset.top;
+
+                // keep the point under the cursor where it is
+                var anchor = to_display_coords(offset_x, offset_y);
+                view.zoom = new_zoom;
+                view.x = Math.min(
+                    Math.max(anchor.x - offset_x / new_zoom, 0),
+                    scope.width - scope.width / new_zoom
+                );
+                view.y = Math.min(
+                    Math.max(anchor.y - offset_y / new_zoom, 0),
+                    scope.height - scope.height / new_zoom
+                );
+
+                update_view();
+
+                return false;
+            };
+
+            scope.$watch('imgUrl', function() {
+                if (scope.imgUrl === null || scope.imgUrl === undefined) {
+                    return;
+                }
+
+                if (scope.dziUrl) {
+                    load_dzi();
+                } else {
+                    load_full_image();
+                }
             });
 
             scope.$watch('regions', function () {
@@ -97,8 +307,9 @@ drw_polygon.directive('drwPolygon', [function () {
                             $svg.off('mouseup');
                         },
                         drag: function (event) {
-                            point.x = event.offsetX;
-                            point.y = event.offsetY;
+                            var display_point = to_display_coords(event.offsetX, event.offsetY);
+                            point.x = display_point.x;
+                            point.y = display_point.y;
                             event.target.setAttribute('x', (point.x - 4).toString());
                             event.target.setAttribute('y', (point.y - 4).toString());
                         },
@@ -228,17 +439,18 @@ drw_polygon.directive('drwPolygon', [function () {
                 }
 
                 var region_index = parseInt(scope.poly_el.attributes['drw-index'].value);
+                var display_point = to_display_coords(evt.offsetX, evt.offsetY);
 
                 // save point to the user's data
                 scope.regions[region_index].push(
                     [
-                        Math.round(evt.offsetX * img_scale.x),
-                        Math.round(evt.offsetY * img_scale.y)
+                        Math.round(display_point.x * img_scale.x),
+                        Math.round(display_point.y * img_scale.y)
                     ]
                 );
 
                 // draw the point
-                create_point(evt.offsetX, evt.offsetY);
+                create_point(display_point.x, display_point.y);
             };
 
             var watch_keypress = function () {
@@ -256,6 +468,7 @@ drw_polygon.directive('drwPolygon', [function () {
             };
 
             $svg.on('mouseup', mouseup);
+            $svg.on('wheel', zoom);
 
             // a slight hack to capture key presses in the SVG element
             $svg.on('mouseenter', watch_keypress);
@@ -178,20 +178,33 @@ app.controller(
         '$scope',
         '$q',
         '$routeParams',
+        '$timeout',
         '$uibModal',
         'ImageSet',
         'Image',
         'Subregion',
         'AnatomyProbeMap',
-        'Classify',
+        'ClassifyBatch',
+        'ClassifyImage',
+        'ClassificationJob',
         'TrainModel',
-        function ($scope, $q, $routeParams, $uibModal, ImageSet, Image,
-                  Subregion, AnatomyProbeMap, Classify, TrainModel) {
+        'TrainingJob',
+        function ($scope, $q, $routeParams, $timeout, $uibModal, ImageSet, Image,
+                  Subregion, AnatomyProbeMap, ClassifyBatch, ClassifyImage,
+                  ClassificationJob, TrainModel, TrainingJob) {
             $scope.images = [];
             $scope.selected_image = null;
             $scope.selected_classification = null;
             $scope.mode = 'train';  // can be 'train', or 'classify'
             $scope.currently_training = false; //boolean if backend is busy training a model
+            $scope.training_job = null;  // the queued or running training job, if any
+            var training_job_poll_interval = 2000;  // milliseconds
+            var training_job_timer = null;
+            var image_fetch_poll_interval = 2000;  // milliseconds
+            var image_fetch_timer = null;
+            $scope.classification_job = null;  // the queued or running whole image classification
+            var classification_job_poll_interval = 2000;  // milliseconds
+            var classification_job_timer = null;
 
             // drw-poly vars
             $scope.enabled = false;
@@ -263,6 +276,19 @@ app.controller(
 
             $scope.image_set.$promise.then(function(data) {
                 $scope.images = Image.query({'image_set': data.id});
+
+                // pick up a training job that is still in progress, e.g. after a page reload
+                if (data.trainedmodel === null) {
+                    TrainingJob.query({'imageset': data.id}).$promise.then(function (jobs) {
+                        jobs.forEach(function (job) {
+                            if (job.status === 'queued' || job.status === 'running') {
+                                $scope.currently_training = true;
+                                $scope.training_job = job;
+                                poll_training_job(job.job_id);
+                            }
+                        });
+                    });
+                }
                 var anatomy_promises = [];
 
                 data.probes.forEach(function(probe) {
@@ -296,23 +322,45 @@ app.controller(
 
             $scope.image_selected = function(img) {
                 $scope.selected_image = img;
-                if (!img.image_orig_sha1) {
-                    var save_response = Image.get(
-                        {
-                            'id': img.id
-                        },
-                        {}
-                    );
 
-                    save_response.$promise.then(function(data) {
-                        $scope.selected_image = data;
-                        $scope.select_classification($scope.selected_classification);
-                    });
+                if (image_fetch_timer !== null) {
+                    $timeout.cancel(image_fetch_timer);
+                    image_fetch_timer = null;
+                }
+
+                if (!img.image_orig_sha1) {
+                    // images are downloaded in the background, poll until it's ready
+                    poll_image_fetch(img.id, 0);
                 } else {
                     $scope.select_classification($scope.selected_classification);
                 }
             };
 
+            function poll_image_fetch(image_id, delay) {
+                image_fetch_timer = $timeout(function () {
+                    var image_response = Image.get({'id': image_id});
+
+                    image_response.$promise.then(function (data) {
+                        if ($scope.selected_image === null || $scope.selected_image.id !== image_id) {
+                            // a different image was selected meanwhile
+                            return;
+                        }
+
+                        $scope.selected_image = data;
+
+                        if (data.image_orig_sha1) {
+                            image_fetch_timer = null;
+                            $scope.select_classification($scope.selected_classification);
+                        } else if (data.fetch_status !== 'failed') {
+                            poll_image_fetch(image_id, image_fetch_poll_interval);
+                        }
+                    }, function (error) {
+                        // transient error, keep polling
+                        poll_image_fetch(image_id, image_fetch_poll_interval);
+                    });
+                }, delay);
+            }
+
             $scope.select_classification = function(classification) {
                 $scope.selected_classification = classification;
 
@@ -320,6 +368,8 @@ app.controller(
                     return false;
                 }
 
+                // every sub-region of the anatomy is loaded rather than only those
+                // in view (the API's bbox filter), as post_regions replaces them all
                 var existing_sub_regions = Subregion.query(
                     {
                         'image': $scope.selected_image.id,
@@ -499,18 +549,9 @@ app.controller(
                 );
 
                 response.$promise.then(function (data) {
-                    var response2 = ImageSet.get(
-                        {
-                            'image_set_id': $routeParams.image_set_id
-                        }
-                    );
-                    //TODO: attempting to make the transition from delete to train not 'jump'
-                    response2.$promise.then(function(data) {
-                        $scope.image_set = data;
-                        $scope.currently_training = false;
-
-                        }
-                    );
+                    // training happens in the background, the response is the queued job
+                    $scope.training_job = data;
+                    poll_training_job(data.job_id);
                 }, function (error) {
                     $scope.currently_training = false;
                     $scope.modal_title = 'Error';
@@ -519,6 +560,57 @@ app.controller(
                 });
             };
 
+            function poll_training_job(job_id) {
+                training_job_timer = $timeout(function () {
+                    var job_response = TrainingJob.get({'id': job_id});
+
+                    job_response.$promise.then(function (job) {
+                        $scope.training_job = job;
+
+                        if (job.status === 'queued' || job.status === 'running') {
+                            poll_training_job(job_id);
+                            return;
+                        }
+
+                        if (job.status === 'failed') {
+                            $scope.currently_training = false;
+                            $scope.training_job = null;
+                            $scope.modal_title = 'Error';
+                            $scope.modal_items = [job.detail];
+                            $scope.open_modal();
+                            return;
+                        }
+
+                        var response2 = ImageSet.get(
+                            {
+                                'image_set_id': $routeParams.image_set_id
+                            }
+                        );
+                        //TODO: attempting to make the transition from delete to train not 'jump'
+                        response2.$promise.then(function(data) {
+                            $scope.image_set = data;
+                            $scope.currently_training = false;
+                            $scope.training_job = null;
+                        });
+                    }, function (error) {
+                        // transient error, keep polling
+                        poll_training_job(job_id);
+                    });
+                }, training_job_poll_interval);
+            }
+
+            $scope.$on('$destroy', function () {
+                if (training_job_timer !== null) {
+                    $timeout.cancel(training_job_timer);
+                }
+                if (image_fetch_timer !== null) {
+                    $timeout.cancel(image_fetch_timer);
+                }
+                if (classification_job_timer !== null) {
+                    $timeout.cancel(classification_job_timer);
+                }
+            });
+
             $scope.launch_delete_trained_model_modal = function() {
                 $scope.modal_title = 'Delete Trained Model?';
                 $scope.modal_items = ['Are you sure you want to delete this trained model?'];
@@ -541,11 +633,81 @@ app.controller(
                 });
             }
 
+            $scope.classify_image = function () {
+                var response = ClassifyImage.save(
+                    {
+                        'image_id': $scope.selected_image.id
+                    }
+                );
+
+                response.$promise.then(function (job) {
+                    $scope.classification_job = job;
+                    poll_classification_job(job.job_id);
+                }, function (error) {
+                    $scope.modal_title = 'Error';
+                    $scope.modal_items = [error.data['detail']];
+                    $scope.open_modal();
+                });
+            };
+
+            function poll_classification_job(job_id) {
+                classification_job_timer = $timeout(function () {
+                    var job_response = ClassificationJob.get({'id': job_id});
+
+                    job_response.$promise.then(function (job) {
+                        if (job.status === 'queued' || job.status === 'running') {
+                            $scope.classification_job = job;
+                            poll_classification_job(job_id);
+                            return;
+                        }
+
+                        classification_job_timer = null;
+                        $scope.classification_job = null;
+
+                        if (job.status === 'failed') {
+                            $scope.modal_title = 'Error';
+                            $scope.modal_items = [job.detail];
+                            $scope.open_modal();
+                            return;
+                        }
+
+                        if ($scope.selected_image === null || $scope.selected_image.id !== job.image) {
+                            // a different image was selected meanwhile
+                            return;
+                        }
+
+                        // show the regions found & a count per anatomy
+                        var counts = {};
+                        $scope.regions.svg = [];
+
+                        job.regions.forEach(function (region) {
+                            $scope.regions.svg.push(
+                                region.points.map(function (p) {
+                                    return [p.x, p.y];
+                                })
+                            );
+                            counts[region.anatomy] = (counts[region.anatomy] || 0) + 1;
+                        });
+
+                        $scope.modal_title = 'Regions Found';
+                        $scope.modal_items = Object.keys(counts).map(function (anatomy) {
+                            return {
+                                anatomy: anatomy,
+                                probability: counts[anatomy]
+                            };
+                        });
+                        $scope.open_modal(undefined, 'custom', undefined, 'static/ng-app/partials/classify_region_modal.html');
+                    }, function (error) {
+                        // transient error, keep polling
+                        poll_classification_job(job_id);
+                    });
+                }, classification_job_poll_interval);
+            }
+
             $scope.classify_region = function () {
-                var classify_promises = [];
+                var polygons = [];
 
                 $scope.regions.svg.forEach(function (region) {
-                    var payload = {};
                     var points = [];
 
                     //Get points
@@ -558,23 +720,40 @@ app.controller(
                             }
                         );
                     }
-                    payload.image_id = $scope.selected_image.id;
-                    payload.points = points;
 
-                    // How to get results of post to conditionally get ready for next
-                    classify_promises.push(Classify.save(payload).$promise);
+                    polygons.push(points);
                 });
 
-                $q.all(classify_promises).then(function (results) {
+                // all regions are scored in a single request
+                var response = ClassifyBatch.save(
+                    {
+                        'image_id': $scope.selected_image.id,
+                        'polygons': polygons
+                    }
+                );
+
+                response.$promise.then(function (data) {
                     $scope.modal_title = 'Classification Results';
                     $scope.modal_items = [];
-                    results[0].results.forEach(function(r) {
-                        $scope.modal_items.push({
-                            anatomy: Object.keys(r)[0],
-                            probability: (r[Object.keys(r)[0]] * 100).toFixed(2)*1
-                        })
+                    data.results.forEach(function(region_results, region_index) {
+                        region_results.forEach(function(r) {
+                            var anatomy = Object.keys(r)[0];
+
+                            if (data.results.length > 1) {
+                                anatomy = 'Region ' + (region_index + 1) + ': ' + anatomy;
+                            }
+
+                            $scope.modal_items.push({
+                                anatomy: anatomy,
+                                probability: (r[Object.keys(r)[0]] * 100).toFixed(2)*1
+                            });
+                        });
                     });
                     $scope.open_modal(undefined, 'custom', undefined, 'static/ng-app/partials/classify_region_modal.html');
+                }, function (error) {
+                    $scope.modal_title = 'Error';
+                    $scope.modal_items = [error.data['detail']];
+                    $scope.open_modal();
                 });
             }
         }
@@ -6,10 +6,14 @@ var URLS = {
     'probes': '/api/probes/',
     'images': '/api/images/',
     'classify': '/api/classify/',
+    'classify_batch': '/api/classify/batch/',
+    'classify_image': '/api/classify/image/',
+    'classification_jobs': '/api/classify/image/jobs/',
     'subregions': '/api/subregions/',
     'image_sets': '/api/image-sets/',
     'anatomy_probe_map': '/api/anatomy-probe-map/',
-    'train_model': '/api/train-model/'
+    'train_model': '/api/train-model/',
+    'training_jobs': '/api/train-model/jobs/'
 };
 
 var service = angular.module('IHCApp');
@@ -85,6 +89,31 @@ service.factory(
             {}
         );
     }
+).factory('ClassifyBatch',
+    function($resource) {
+        return $resource(
+            URLS.classify_batch,
+            {},
+            {}
+        );
+    }
+).factory('ClassifyImage',
+    function($resource) {
+        return $resource(
+            URLS.classify_image,
+            {},
+            {}
+        );
+    }
+).factory(
+    'ClassificationJob',
+    function ($resource) {
+        return  $resource(
+            URLS.classification_jobs + ':id',
+            {},
+            {}
+        );
+    }
 ).factory(
     'Subregion',
     function($resource) {
@@ -117,4 +146,13 @@ service.factory(
             {}
         );
     }
+).factory(
+    'TrainingJob',
+    function ($resource) {
+        return  $resource(
+            URLS.training_jobs + ':id',
+            {},
+            {}
+        );
+    }
 );